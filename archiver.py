@@ -7,9 +7,31 @@ import jinja2
 import argparse
 import logging
 import time
+import random
+import asyncio
+import aiohttp
+import aiohttp.web
+import hashlib
+import heapq
+import gzip
+import shutil
+import signal
+import threading
+from itertools import islice
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from slack import WebClient
+from slack.web.async_client import AsyncWebClient
 from slack.errors import SlackApiError
+from storage import JSONStore, atomic_write, open_store, ts_key
+from metrics import metrics
+from files import FileArchive, FileLinks, message_files, parse_size, objects_dir, thumbnail_dir
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 script_dir = os.path.split(os.path.realpath(__file__))[0]
 
@@ -23,10 +45,11 @@ def create_client(token:str) -> WebClient:
 
     client = WebClient(token = token)
     try:
-        client.auth_test()
+        with metrics.timer('auth'):
+            RequestScheduler(client).call('auth.test')
         archive_logger.info('Slack authentication successful.')
     except SlackApiError as e:
-        if e.response['error'] == 'invalid_auth':
+        if error_code(e) == 'invalid_auth':
             archive_logger.error('Authentication failed. Check slack bot token.')
             sys.exit(2)
         else:
@@ -34,136 +57,926 @@ def create_client(token:str) -> WebClient:
 
     return client
 
-# Scraping ----------------------------------------------------------------
-
-class Scraper(object):
-    def __init__(self, previous_data:dict, client:WebClient, targets:list, no_connection = False) -> None:
-        self.emoji_dict = {}
-        with open(os.path.join(script_dir, 'emoji.json'), 'r') as f:
-            emoji_list = json.load(f)
-        for emoji in emoji_list:
-            self.emoji_dict[emoji['short_name']] = ''.join(
-                # get the emoji list into something a browser can read
-                [f'&#x{e};' for e in emoji['unified'].split('-')]
+# Rate limiting -----------------------------------------------------------
+
+# Slack's per-minute request limits for each API tier, and the tier of
+# each method we call. https://api.slack.com/docs/rate-limits
+tier_limits = {1: 1, 2: 20, 3: 50, 4: 100}
+method_tiers = {
+    'auth.test': 4,
+    'conversations.history': 3,
+    'conversations.list': 2,
+    'conversations.replies': 3,
+    'emoji.list': 2,
+    'users.info': 4,
+    'users.list': 2
+}
+
+class RateLimiter(object):
+    # One token bucket per API method, shared by every worker. Each call
+    # reserves the next free slot for its method, so adding workers
+    # never sends requests faster than the method's tier allows.
+    def __init__(self, burst:int = 3) -> None:
+        self.burst = burst
+        self.next_slot = {}
+
+    def interval(self, method:str) -> float:
+        return 60 / tier_limits[method_tiers.get(method, 3)]
+
+    def reserve(self, method:str) -> float:
+        # reserve a slot and return how long to wait for it
+        now = time.monotonic()
+        interval = self.interval(method)
+        allowance = (self.burst - 1) * interval
+        slot = max(self.next_slot.get(method, now), now)
+        self.next_slot[method] = slot + interval
+        return max(0, slot - allowance - now)
+
+    def penalize(self, method:str, delay:float) -> None:
+        # slack told us to back off: nobody calls this method for delay seconds
+        now = time.monotonic()
+        allowance = (self.burst - 1) * self.interval(method)
+        self.next_slot[method] = max(self.next_slot.get(method, now), now + delay + allowance)
+
+    def wait(self, method:str) -> float:
+        wait = self.reserve(method)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire(self, method:str) -> float:
+        wait = self.reserve(method)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+# errors worth retrying that never reach slack's API layer
+transient_errors = (OSError, asyncio.TimeoutError, aiohttp.ClientError)
+
+# A response whose body isn't slack's JSON, like a gateway's HTML error
+# page, leaves SlackApiError holding the raw HTTP response (a dict, or
+# aiohttp's response) rather than a SlackResponse, with no error code.
+def error_code(error:SlackApiError) -> str:
+    data = getattr(error.response, 'data', None)
+    return data.get('error') if isinstance(data, dict) else None
+
+def error_status(error:SlackApiError) -> int:
+    response = error.response
+    if isinstance(response, dict):
+        return int(response.get('status') or 0)
+    return getattr(response, 'status_code', None) or getattr(response, 'status', 0)
+
+def error_headers(error:SlackApiError) -> dict:
+    response = error.response
+    if isinstance(response, dict):
+        return response.get('headers') or {}
+    return getattr(response, 'headers', None) or {}
+
+class RequestScheduler(object):
+    # Every Slack API call goes through here. Calls are paced by a
+    # RateLimiter, and failed calls are retried up to max_retries times:
+    # after Retry-After for 429s, or with jittered exponential backoff
+    # for 5xx responses and network errors. Other API errors are raised
+    # straight away. Calls, retries and time spent waiting are counted
+    # per method.
+    def __init__(self, client, max_retries:int = 5, rate_limiter:RateLimiter = None) -> None:
+        self.client = client
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.request_slots = None
+        self.stats = {}
+
+    def count(self, method:str, stat:str, amount:float = 1) -> None:
+        method_stats = self.stats.setdefault(method, {'calls': 0, 'retries': 0, 'wait': 0})
+        method_stats[stat] += amount
+        metrics.count_api(method, stat, amount)
+
+    def describe(self, error:Exception) -> str:
+        if isinstance(error, SlackApiError):
+            return error_code(error) or f'HTTP {error_status(error)}'
+        return repr(error)
+
+    def backoff(self, attempt:int) -> float:
+        return min(60, 2 ** attempt) * random.uniform(0.5, 1)
+
+    def retry_delay(self, method:str, error:Exception, attempt:int) -> float:
+        # how long to wait before retrying, or None if we shouldn't
+        if attempt >= self.max_retries:
+            return None
+
+        if isinstance(error, SlackApiError):
+            status = error_status(error)
+            if status == 429 or error_code(error) == 'ratelimited':
+                delay = int(error_headers(error).get('Retry-After', 1))
+                self.rate_limiter.penalize(method, delay)
+                return delay
+            if status >= 500:
+                return self.backoff(attempt)
+            return None
+
+        return self.backoff(attempt)
+
+    def call(self, method:str, **kwargs) -> dict:
+        api_method = getattr(self.client, method.replace('.', '_'))
+        attempt = 0
+        while True:
+            self.count(method, 'wait', self.rate_limiter.wait(method))
+            self.count(method, 'calls')
+            try:
+                return api_method(**kwargs)
+            except (SlackApiError, *transient_errors) as e:
+                delay = self.retry_delay(method, e, attempt)
+                if delay is None:
+                    raise e
+                attempt += 1
+                archive_logger.info(f'{method} failed ({self.describe(e)}). Retry {attempt} of {self.max_retries} in {delay:.1f} seconds.')
+
+            self.count(method, 'retries')
+            self.count(method, 'wait', delay)
+            time.sleep(delay)
+
+    async def call_async(self, client:AsyncWebClient, method:str, **kwargs) -> dict:
+        # request_slots, if set, limits how many calls are in flight
+        api_method = getattr(client, method.replace('.', '_'))
+        attempt = 0
+        while True:
+            self.count(method, 'wait', await self.rate_limiter.acquire(method))
+            self.count(method, 'calls')
+            try:
+                if self.request_slots is None:
+                    return await api_method(**kwargs)
+                async with self.request_slots:
+                    return await api_method(**kwargs)
+            except (SlackApiError, *transient_errors) as e:
+                delay = self.retry_delay(method, e, attempt)
+                if delay is None:
+                    raise e
+                attempt += 1
+                archive_logger.info(f'{method} failed ({self.describe(e)}). Retry {attempt} of {self.max_retries} in {delay:.1f} seconds.')
+
+            self.count(method, 'retries')
+            self.count(method, 'wait', delay)
+            await asyncio.sleep(delay)
+
+    def report(self) -> None:
+        for method, method_stats in sorted(self.stats.items()):
+            archive_logger.info(
+                f"{method}: {method_stats['calls']} calls, {method_stats['retries']} retries, "
+                f"{method_stats['wait']:.1f} seconds waiting (summed over workers)"
             )
 
-        self.message_data = previous_data
+# Emoji -------------------------------------------------------------------
+
+# emoji.json is big and slow to parse, so the shortcode -> HTML entity
+# table built from it is cached next to it, tagged with the size and
+# mtime of the emoji.json it came from.
+emoji_source = os.path.join(script_dir, 'emoji.json')
+emoji_table_cache = os.path.join(script_dir, 'emoji_table.json')
+custom_emoji_ttl = 24 * 60 * 60
+
+def build_emoji_table(emoji_list:list) -> dict:
+    table = {}
+    for emoji in emoji_list:
+        # get the emoji list into something a browser can read
+        table[emoji['short_name']] = ''.join(
+            [f'&#x{e};' for e in emoji['unified'].split('-')]
+        )
 
-        if not no_connection:
-            self.client = client
-            channels = client.conversations_list(
-                types = 'public_channel, private_channel'
-            )
-            self.channel_dict = {c['name']: c['id'] for c in channels['channels']}
-                
-            if targets == 'all':
-                self.targets = list(self.channel_dict.keys())
+    # aliases never override a primary short name
+    for emoji in emoji_list:
+        for name in emoji['short_names']:
+            table.setdefault(name, table[emoji['short_name']])
+
+    return table
+
+def load_emoji_table() -> dict:
+    source_stat = os.stat(emoji_source)
+    source_tag = [source_stat.st_size, source_stat.st_mtime_ns]
+
+    try:
+        with open(emoji_table_cache, 'r') as f:
+            cached = json.load(f)
+        if cached['source'] == source_tag:
+            return cached['emoji']
+        archive_logger.debug('emoji.json changed. Rebuilding emoji table.')
+    except (FileNotFoundError, ValueError, KeyError):
+        archive_logger.debug('No usable emoji table cache. Building it.')
+
+    with open(emoji_source, 'r') as f:
+        table = build_emoji_table(json.load(f))
+
+    try:
+        with atomic_write(emoji_table_cache) as f:
+            json.dump({'source': source_tag, 'emoji': table}, f, separators = (',', ':'))
+    except OSError:
+        archive_logger.warning(f'Could not write emoji table cache to {emoji_table_cache}.')
+
+    return table
+
+def custom_emoji_html(name:str, url:str) -> str:
+    # no colons in alt, so the markup can't be taken for a shortcode
+    return f'<img class="emoji" src="{url}" alt="{name}">'
+
+def resolve_custom_emoji(custom:dict, standard:dict) -> dict:
+    # custom emoji are either image URLs or "alias:other_name", where
+    # other_name can be a standard or another custom emoji
+    resolved = {}
+    for name, value in custom.items():
+        seen = {name}
+        while value is not None and value.startswith('alias:'):
+            target = value[len('alias:'):]
+            if target in custom and target not in seen:
+                seen.add(target)
+                value = custom[target]
+            elif target in standard:
+                value = None
+                resolved[name] = standard[target]
             else:
-                good_targets = []
-                for target in targets:
-                    if target in self.channel_dict.values():
-                        archive_logger.error('Give channel names, not IDs')
-                        sys.exit(4)
-                    elif target in self.channel_dict:
-                        good_targets.append(target)
-                    else:
-                        archive_logger.error(f'Channel "{target}" not found.')
-                        sys.exit(4)
-                self.targets = good_targets
+                value = None
+
+        if value is not None:
+            resolved[name] = custom_emoji_html(name, value)
+
+    return resolved
+
+# Users -------------------------------------------------------------------
+
+user_cache_ttl = 86400
+users_page_size = 200
+
+def message_user_ids(message:dict) -> set:
+    # everyone a message refers to: its author, mentions and reactions
+    user_ids = {message.get('user')}
+    user_ids.update(mention_pattern.findall(message.get('text') or ''))
+    for reaction in message.get('reactions', []):
+        user_ids.update(reaction['users'])
+    user_ids.discard(None)
+    return user_ids
+
+def user_name(user:dict) -> str:
+    profile = user.get('profile', {})
+    return profile.get('real_name') or profile.get('display_name') or user.get('real_name') or user.get('name') or user['id']
+
+class UserDirectory(object):
+    # Maps user IDs to names. The whole directory comes from users.list, a
+    # page at a time, and is kept in cache_path for ttl seconds so most
+    # runs don't download it at all. IDs that aren't in it (people who
+    # joined since, or from other workspaces in shared channels) are looked
+    # up one at a time with users.info, and the ones that can't be found
+    # are remembered so they're only asked about once.
+    def __init__(self, scheduler = None, cache_path:str = None, ttl:float = user_cache_ttl) -> None:
+        self.scheduler = scheduler
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.names = {}
+        self.missing = set()
+        self.fetched = None
+        self.changed = False
+        self.lookups = 0
+
+    def load(self) -> None:
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path, 'r') as f:
+                    cached = json.load(f)
+                if time.time() - cached['fetched'] < self.ttl:
+                    self.names = cached['users']
+                    self.fetched = cached['fetched']
+                    archive_logger.info(f'Loaded {len(self.names)} users from {self.cache_path}.')
+                    return
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+
+        self.fetch_all()
+
+    def fetch_all(self) -> None:
+        archive_logger.info('Fetching user list.')
+        self.names = {}
+        page = {}
+        while True:
+            user_response = self.scheduler.call('users.list', limit = users_page_size, **page)
+            for user in user_response['members']:
+                self.names[user['id']] = user_name(user)
+
+            cursor = user_response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+            page = {'cursor': cursor}
+
+        self.fetched = time.time()
+        self.changed = True
+
+    def unknown(self, user_ids) -> set:
+        return {
+            user_id for user_id in user_ids
+            if user_id is not None and user_id not in self.names and user_id not in self.missing
+        }
+
+    def add(self, user_id:str, user:dict) -> None:
+        # user is the users.info response, or None if there wasn't one
+        self.lookups += 1
+        if user is None:
+            self.missing.add(user_id)
+        else:
+            self.names[user_id] = user_name(user)
+            self.changed = True
 
+    def get(self, user_id:str) -> str:
+        # the user's name, or None if we can't find out
+        if user_id in self.names:
+            return self.names[user_id]
+        if self.scheduler is None or user_id in self.missing:
+            return None
+
+        try:
+            self.add(user_id, self.scheduler.call('users.info', user = user_id)['user'])
+        except SlackApiError as e:
+            archive_logger.debug(f"Couldn't look up user {user_id}: {error_code(e)}")
+            self.add(user_id, None)
+        return self.names.get(user_id)
+
+    def name(self, user_id:str) -> str:
+        name = self.get(user_id)
+        return name if name is not None else user_id
+
+    def author(self, message:dict) -> str:
+        # bot and app messages often have no user, just a bot profile or
+        # the username the integration posted as
+        if message.get('user'):
+            return self.name(message['user'])
+        if message.get('bot_profile', {}).get('name'):
+            return message['bot_profile']['name']
+        return message.get('username') or message.get('bot_id') or 'Unknown user'
+
+    def save(self) -> None:
+        if self.cache_path is None or not self.changed or self.fetched is None:
+            return
+        with atomic_write(self.cache_path) as f:
+            json.dump({'fetched': self.fetched, 'users': self.names}, f)
+        self.changed = False
+
+    def report(self) -> None:
+        if self.lookups:
+            archive_logger.info(f'Looked up {self.lookups} users not in the user list, {len(self.missing)} not found.')
+
+# Channels ----------------------------------------------------------------
+
+channel_cache_ttl = 3600
+channels_page_size = 1000
+channel_types = ['public_channel', 'private_channel', 'mpim', 'im']
+dm_types = {'mpim', 'im'}
+archive_name_pattern = re.compile(r'[^a-z0-9_-]+')
+
+def channel_type(channel:dict) -> str:
+    if channel.get('is_im'):
+        return 'im'
+    if channel.get('is_mpim'):
+        return 'mpim'
+    if channel.get('is_private') or channel.get('is_group'):
+        return 'private_channel'
+    return 'public_channel'
+
+class ChannelRegistry(object):
+    # Every conversation the bot can see, keyed by ID. The list comes from
+    # conversations.list a page at a time and is kept in cache_path for
+    # ttl seconds, so most runs don't list the workspace at all. Archived
+    # channels are left out unless include_archived is set. Without the
+    # im:read and mpim:read scopes, DMs are left out with a warning.
+    #
+    # Each conversation is archived under a name: a channel's own name, or
+    # for a DM "dm-" and the other person's name from the user directory.
+    # DM names are kept in the cache once given, so a DM stays in one place
+    # in the archive when someone changes their name.
+    def __init__(self, scheduler = None, directory:UserDirectory = None, cache_path:str = None, ttl:float = channel_cache_ttl, types:list = channel_types, include_archived:bool = False) -> None:
+        self.scheduler = scheduler
+        self.directory = directory
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.types = list(types)
+        self.include_archived = include_archived
+        self.channels = {}
+        self.dm_names = {}
+        self.fetched = None
+        # whether the list has been fetched in this run, rather than cached
+        self.listed = False
+        self.changed = False
+
+    def load(self) -> None:
+        cached = {}
+        if self.cache_path is not None:
             try:
-                user_response = client.users_list()
+                with open(self.cache_path, 'r') as f:
+                    cached = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        self.dm_names = cached.get('dm_names', {})
+
+        if (
+            cached.get('fetched') is not None and time.time() - cached['fetched'] < self.ttl and
+            cached.get('types') == self.types and cached.get('include_archived') == self.include_archived
+        ):
+            self.channels = cached['channels']
+            self.fetched = cached['fetched']
+            archive_logger.info(f'Loaded {len(self.channels)} channels from {self.cache_path}.')
+            return
+
+        self.fetch_all()
+
+    def fetch_all(self) -> None:
+        archive_logger.info('Fetching channel list.')
+        types = list(self.types)
+        channels = {}
+        page = {}
+        while True:
+            try:
+                channel_response = self.scheduler.call(
+                    'conversations.list',
+                    types = ','.join(types),
+                    exclude_archived = not self.include_archived,
+                    limit = channels_page_size,
+                    **page
+                )
             except SlackApiError as e:
-                    if e.response['error'] == 'ratelimited':
-                        delay = int(e.response.headers['Retry-After'])
-                        archive_logger.debug(f"Rate limited. Retrying in {delay} seconds")
-                        time.sleep(delay)
-                        user_response = client.users_list()
+                if error_code(e) != 'missing_scope' or not dm_types & set(types):
+                    raise e
+                archive_logger.warning('Bot lacks the im:read or mpim:read scope. DMs will not be archived.')
+                types = [t for t in types if t not in dm_types]
+                channels = {}
+                page = {}
+                continue
 
-            self.users = {user['id']: user['profile']['real_name'] for user in user_response["members"]}
-        else:
-            archive_logger.info('Making no-client scraper for conversion purposes.')
-            self.channel_dict = {}
-            self.users = {}
-
-
-    def write_json(self, out_file:str) -> None:
-        with open(out_file, 'w') as f:
-            json.dump(self.message_data, f)
-
-    def username_replace(self, text:str) -> str:
-        archive_logger.debug('Replacing usernames')
-        for user_id, user_name in self.users.items():
-            text = re.sub(f'<@{user_id}>', f'@{user_name}', text)
-
-        archive_logger.debug(f"New text: {text}")
-        return text
-
-    def url_replace(self, text:str) -> str:
-        archive_logger.debug('Replacing URLs')
-        url_pattern = re.compile('<(https?:\/\/[^<>]*?\.[^<>]*?\.[^<>]{3,}?)>')
-        url_search = re.search(url_pattern, text)
-        while url_search:
-            archive_logger.debug(f'Found url: {url_search.group(0)}')
-            text = text.replace(
-                url_search.group(0),
-                f'<a href="{url_search.group(1)}">{url_search.group(1)}</a>'
-            )
-            url_search = re.search(url_pattern, text)
-
-        archive_logger.debug(f"New text: {text}")
-        return text
-
-
-    def emoji_replace(self, text:str) -> str:
-        archive_logger.debug('Replacing emoji')
-        # first remove all URLs so we can trust that colons are
-        # more-or-less only for emoji
-        # 
-        # we can handle likely ratio colons (i.e., 1:10) in
-        # the regex itself
-
-        no_url_text = text[:]
-        url_search = re.search('<a href.*<\/a>', no_url_text)
-        while url_search:
-            no_url_text = no_url_text.replace(url_search.group(0), '')
-            url_search = re.search('<a href.*<\/a>', no_url_text)
-
-        # now search the no-url text but replace in both
-        e_pattern = re.compile(':([^0-9 ].*?[^ ]):')
-        e_match = re.search(e_pattern, no_url_text)
-        while e_match:
-            try:
-                unicode_emoji = self.emoji_dict[e_match.group(1)]
-                archive_logger.debug(f'Replacing an emoji in {text}')
-                archive_logger.debug(f'No url text: {no_url_text}')
-                text = text.replace(':' + e_match.group(1) + ':', unicode_emoji)
-                no_url_text = no_url_text.replace(':' + e_match.group(1) + ':', unicode_emoji)
-                archive_logger.debug(f'Emoji replaced: {text}')
-            except KeyError:
-                archive_logger.debug('Emoji replacement failed. Adding brackets.')
-                text = text.replace(e_match.group(0), f"<{e_match.group(1)}>")
-                no_url_text = no_url_text.replace(e_match.group(0), f"<{e_match.group(1)}>")
+            for channel in channel_response['channels']:
+                channels[channel['id']] = {
+                    'name': channel.get('name'),
+                    'type': channel_type(channel),
+                    'user': channel.get('user'),
+                    'archived': channel.get('is_archived', False)
+                }
+
+            cursor = channel_response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+            page = {'cursor': cursor}
+
+        self.channels = channels
+        self.fetched = time.time()
+        self.listed = True
+        self.changed = True
+
+    def archive_name(self, channel_id:str) -> str:
+        channel = self.channels[channel_id]
+        if channel['type'] != 'im':
+            return channel['name']
+        if channel_id not in self.dm_names:
+            person = self.directory.name(channel['user']) if self.directory is not None else channel['user']
+            name = 'dm-' + archive_name_pattern.sub('-', person.lower()).strip('-')
+            if name in self.dm_names.values():
+                name = f'{name}-{channel_id.lower()}'
+            self.dm_names[channel_id] = name
+            self.changed = True
+        return self.dm_names[channel_id]
+
+    def archive_names(self) -> dict:
+        # archive name -> ID for every conversation
+        return {self.archive_name(channel_id): channel_id for channel_id in self.channels}
+
+    def find(self, target:str) -> str:
+        # the archive name of a conversation given by archive name or ID,
+        # or None if there's no such conversation
+        if target in self.channels:
+            return self.archive_name(target)
+        names = self.archive_names()
+        return target if target in names else None
+
+    def save(self) -> None:
+        if self.cache_path is None or not self.changed or self.fetched is None:
+            return
+        with atomic_write(self.cache_path) as f:
+            json.dump({
+                'fetched': self.fetched,
+                'types': self.types,
+                'include_archived': self.include_archived,
+                'channels': self.channels,
+                'dm_names': self.dm_names
+            }, f)
+        self.changed = False
 
-            e_match = re.search(e_pattern, no_url_text)
+# Scraping ----------------------------------------------------------------
 
-        # lazy, bad, naughty, etc.
-        text.replace(':100:', self.emoji_dict['100'])
+class Checkpoint(object):
+    # Progress of a scrape: the channels finished so far and, for channels
+    # part way through, the arguments and cursor for their next page of
+    # history. It's written, along with the archive so far, every
+    # every_messages messages or every_seconds seconds, so a crashed run
+    # can be resumed. A Checkpoint without a path never writes anything.
+    def __init__(self, path:str = None, archive:str = None, every_messages:int = None, every_seconds:float = None) -> None:
+        self.path = path
+        self.archive = archive
+        self.every_messages = every_messages
+        self.every_seconds = every_seconds
+        self.completed = []
+        self.cursors = {}
+        self.high_water = None
+        self.messages = 0
+        self.last_write = time.monotonic()
+
+    @classmethod
+    def load(cls, path:str, **kwargs):
+        with open(path, 'r') as f:
+            saved = json.load(f)
+        checkpoint = cls(path, saved['archive'], **kwargs)
+        checkpoint.completed = saved['completed']
+        checkpoint.cursors = saved['cursors']
+        checkpoint.high_water = saved['high_water']
+        return checkpoint
+
+    def due(self) -> bool:
+        if self.path is None:
+            return False
+        if self.every_messages and self.messages >= self.every_messages:
+            return True
+        return bool(self.every_seconds) and time.monotonic() - self.last_write >= self.every_seconds
+
+    def write(self, high_water:dict) -> None:
+        if self.path is None:
+            return
+        with atomic_write(self.path) as f:
+            json.dump({
+                'archive': self.archive,
+                'completed': self.completed,
+                'cursors': self.cursors,
+                'high_water': high_water
+            }, f)
+        self.messages = 0
+        self.last_write = time.monotonic()
+
+    def remove(self) -> None:
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+# message text transformation. Mentions, links and emoji shortcodes are
+# all found by one compiled pattern in a single pass over the text.
+link = r'<https?:\/\/[^<>]*?\.[^<>]*?\.[^<>]{3,}?>'
+mention_pattern = re.compile(r'<@(?P<user>\w+)>')
+# a shortcode can't hold colons, spaces or angle brackets, so it never
+# reaches into a link, and each stretch of text is only looked at once
+text_pattern = re.compile(
+    mention_pattern.pattern +
+    f'|<(?P<url>{link[1:-1]})>' +
+    r'|:(?P<emoji>[^:\s<>]+):'
+)
 
-        return text
+def message_fingerprint(message:dict) -> tuple:
+    # what can change about a message once it's archived, cheap to compare:
+    # edits, reaction counts, its thread, and deletion of a thread's parent
+    # (which leaves a tombstone). Transforming a message doesn't change any
+    # of these, so stored and fresh copies compare equal.
+    if message.get('deleted') or message.get('subtype') == 'tombstone':
+        # all that's left to change is the thread
+        return None, (), message.get('reply_count'), message.get('latest_reply'), 'deleted'
+    return (
+        (message.get('edited') or {}).get('ts'),
+        tuple(reaction.get('count') for reaction in message.get('reactions') or []),
+        message.get('reply_count'),
+        message.get('latest_reply'),
+        message.get('subtype')
+    )
 
+class Scraper(object):
+    def __init__(self, previous_data, client:WebClient, targets:list, no_connection = False, high_water:dict = None, rescan_days:float = 0, emoji_cache:str = None, max_retries:int = 5, checkpoint:Checkpoint = None, user_cache:str = None, raw:bool = False, files:FileArchive = None, channel_cache:str = None, channel_types:list = channel_types, include_archived:bool = False) -> None:
+        # the emoji table is only loaded when emoji_dict is first used
+        self._emoji_dict = None
+        self.emoji_cache = emoji_cache
+
+        # previous_data is either the archive dict or a store from storage.py
+        if isinstance(previous_data, dict):
+            previous_data = JSONStore(previous_data)
+        self.store = previous_data
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint()
+
+        # incremental mode: high_water maps channel -> newest ts we have,
+        # and we only ask slack for messages after it. rescan_days pulls
+        # the window back so late replies, edits and deletions are still
+        # picked up.
+        self.incremental = high_water is not None
+        self.high_water = high_water if high_water is not None else {}
+        self.rescan_days = rescan_days
+        self.rescan_cutoff = {}
+        # channel -> ts of every message slack sent from the rescan window
+        self.window_seen = {}
+        self.reply_calls_saved = 0
+
+        # raw mode stores messages as slack sends them, and visualize does
+        # the transformations instead
+        self.raw = raw
+        # files shared in messages are downloaded in the background as
+        # messages come in, if there's a FileArchive to put them in
+        self.files = files
 
-    def timestamps(self, channel:str) -> list:
+        if not no_connection:
+            self.client = client
+            self.scheduler = RequestScheduler(client, max_retries = max_retries)
+
+            # DMs are named after the other person, so users come first
+            self.directory = UserDirectory(self.scheduler, user_cache)
+            with metrics.timer('users'):
+                self.directory.load()
+
+            self.registry = ChannelRegistry(
+                self.scheduler,
+                self.directory,
+                channel_cache,
+                types = channel_types,
+                include_archived = include_archived
+            )
+            self.load_channels(targets)
+        else:
+            archive_logger.info('Making no-client scraper for conversion purposes.')
+            self.client = None
+            self.channel_dict = {}
+            self.directory = UserDirectory()
+            self.registry = ChannelRegistry()
+
+    def load_channels(self, targets, refresh:bool = False) -> None:
+        # archive names -> IDs, and which of them to scrape. The watcher
+        # calls this again with refresh to pick up new channels.
+        with metrics.timer('channels'):
+            if refresh:
+                self.registry.fetch_all()
+            else:
+                self.registry.load()
+            # a channel that isn't in a cached list may be newer than it
+            if targets != 'all' and not self.registry.listed and any(self.registry.find(t) is None for t in targets):
+                self.registry.fetch_all()
+        self.channel_dict = self.registry.archive_names()
+
+        if targets == 'all':
+            self.targets = list(self.channel_dict.keys())
+        else:
+            good_targets = []
+            for target in targets:
+                name = self.registry.find(target)
+                if name is None and refresh:
+                    # archived or deleted since the watcher started
+                    archive_logger.warning(f'Channel "{target}" not found. Skipping it.')
+                    continue
+                if name is None:
+                    archive_logger.error(f'Channel "{target}" not found.')
+                    sys.exit(4)
+                good_targets.append(name)
+            self.targets = good_targets
+
+    @property
+    def users(self) -> dict:
+        return self.directory.names
+
+    @users.setter
+    def users(self, names:dict) -> None:
+        self.directory.names = names
+
+    @property
+    def emoji_dict(self) -> dict:
+        if self._emoji_dict is None:
+            self.load_emoji()
+
+        return self._emoji_dict
+
+    def load_emoji(self, refresh:bool = False) -> None:
+        table = load_emoji_table()
+        if self.client is not None:
+            table.update(resolve_custom_emoji(self.custom_emoji(refresh), table))
+        self._emoji_dict = table
+
+    def custom_emoji(self, refresh:bool = False) -> dict:
+        # the workspace's custom emoji, from emoji_cache if it's fresh and
+        # we weren't asked to fetch them again
+        if self.emoji_cache is not None and not refresh:
+            try:
+                if time.time() - os.path.getmtime(self.emoji_cache) < custom_emoji_ttl:
+                    with open(self.emoji_cache, 'r') as f:
+                        return json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+        archive_logger.info('Fetching custom emoji.')
         try:
-            return self.message_data[channel].keys()
-        except KeyError:
-            return []
+            emoji_response = self.scheduler.call('emoji.list')
+        except SlackApiError as e:
+            if error_code(e) == 'missing_scope':
+                archive_logger.warning('Bot lacks the emoji:read scope. Custom emoji will not be replaced.')
+                return {}
+            else:
+                raise e
+
+        custom = emoji_response['emoji']
+        if self.emoji_cache is not None:
+            with atomic_write(self.emoji_cache) as f:
+                json.dump(custom, f)
+
+        return custom
+
+
+    def save(self, out_file:str) -> None:
+        with metrics.timer('write'):
+            self.store.put_users(self.users)
+            self.store.save(out_file)
+            self.directory.save()
+            self.registry.save()
+            if self.files is not None:
+                self.files.save()
+        if os.path.exists(out_file):
+            metrics.count('archive_bytes', os.path.getsize(out_file))
+
+    def write_state(self, state_file:str) -> None:
+        with open(state_file, 'w') as f:
+            json.dump({'high_water': self.high_water}, f)
+
+    def mention_replace(self, match:re.Match) -> str:
+        name = self.directory.get(match.group('user'))
+        return match.group(0) if name is None else '@' + name
+
+    def transform_text(self, text:str) -> str:
+        # Replace mentions, URLs and emoji in one pass, with dict lookups
+        # for users and emoji. A :word: that isn't an emoji is left as it
+        # is, and its closing colon can still open the next shortcode.
+        pieces = []
+        position = 0
+        match = text_pattern.search(text)
+        while match is not None:
+            if match.group('user') is not None:
+                replacement = self.mention_replace(match)
+            elif match.group('url') is not None:
+                href = match.group('url')
+                replacement = f'<a href="{href}">{href}</a>'
+            else:
+                replacement = self.emoji_dict.get(match.group('emoji'))
+                if replacement is None:
+                    match = text_pattern.search(text, match.end() - 1)
+                    continue
+
+            pieces.append(text[position:match.start()])
+            pieces.append(replacement)
+            position = match.end()
+            match = text_pattern.search(text, position)
+
+        pieces.append(text[position:])
+        return ''.join(pieces)
+
+    def newest_ts(self, channel:str) -> str:
+        if channel in self.high_water:
+            return self.high_water[channel]
+
+        return self.store.newest_ts(channel)
+
+    def oldest(self, channel:str) -> str:
+        # the `oldest` argument for conversations_history, or None to
+        # download the channel's full history
+        if not self.incremental:
+            return None
+
+        newest = self.newest_ts(channel)
+        if newest is None:
+            return None
+
+        oldest = float(newest) - self.rescan_days * 86400
+        if self.rescan_days > 0:
+            self.rescan_cutoff[channel] = oldest
+
+        return f'{oldest:.6f}'
+
+    def in_window(self, channel:str, ts:str) -> bool:
+        return channel in self.rescan_cutoff and float(ts) > self.rescan_cutoff[channel]
+
+    def plan_message(self, channel:str, message:dict) -> tuple:
+        # (process, fetch_thread, stored thread): whether a message from
+        # history needs processing and storing, and whether its thread
+        # needs fetching. Messages in the rescan window are compared with
+        # the stored copy by fingerprint, so only ones that were edited,
+        # reacted to, replied to or deleted are processed again. A parent's
+        # fingerprint doesn't show replies being edited, reacted to or
+        # deleted, so a thread whose latest reply is in the window is
+        # fetched again too, and its replies compared in thread_replies.
+        # Threads started before the window aren't in the history we get,
+        # so changes to their replies are missed.
+        if channel in self.window_seen:
+            self.window_seen[channel].add(message['ts'])
+        if self.in_window(channel, message['ts']):
+            stored = self.store.get_thread(channel, message['ts'])
+            if stored is not None:
+                old, new = message_fingerprint(stored['message']), message_fingerprint(message)
+                # the thread changed if its reply count or latest reply did
+                fetch_thread = old[2:4] != new[2:4] or (
+                    bool(message.get('reply_count')) and self.in_window(channel, message.get('latest_reply') or '0')
+                )
+                if old == new and not fetch_thread:
+                    return False, False, stored
+                if old != new:
+                    metrics.count('messages_reconciled')
+                return True, fetch_thread, stored
+
+        fetch_thread = self.thread_changed(channel, message)
+        return fetch_thread or not self.store.has_message(channel, message['ts']), fetch_thread, None
+
+    def reconciled_message(self, message:dict, stored:dict) -> dict:
+        # deleting a message with replies leaves a tombstone in its place.
+        # Keep what we had, marked deleted, rather than the tombstone.
+        if message.get('subtype') == 'tombstone' and stored is not None and stored['message'].get('subtype') != 'tombstone':
+            metrics.count('messages_deleted')
+            return dict(stored['message'], deleted = True)
+        # an unchanged parent whose thread is only being checked
+        if stored is not None and message_fingerprint(stored['message']) == message_fingerprint(message):
+            return stored['message']
+        return self.prepare_message(message)
+
+    def thread_replies(self, channel:str, ts:str, fetched:list) -> list:
+        # the fetched replies, in order, and the stored ones slack no
+        # longer sent: marked deleted if they're in the rescan window, and
+        # kept as they were if they're older, as they've probably only
+        # fallen out of the workspace's retention period. Fetched replies
+        # are compared with the stored copies by fingerprint, like messages
+        # in the rescan window, and only new or changed ones are processed.
+        stored = {reply['ts']: reply for reply in self.stored_replies(channel, ts)}
+        replies = []
+        for reply in fetched:
+            old = stored.pop(reply['ts'], None)
+            if old is not None and message_fingerprint(old) == message_fingerprint(reply):
+                replies.append(old)
+                continue
+            if old is not None:
+                metrics.count('replies_reconciled')
+            replies.append(self.prepare_message(reply))
+        missing = list(stored.values())
+        for i, reply in enumerate(missing):
+            if self.in_window(channel, reply['ts']) and not reply.get('deleted'):
+                metrics.count('replies_deleted')
+                missing[i] = dict(reply, deleted = True)
+        # stored replies are already in order. Slack sends replies oldest
+        # first, so sorting new ones is usually a single pass.
+        return sorted(replies + missing, key = lambda d: ts_key(d['ts']))
+
+    def mark_deletions(self, channel:str) -> None:
+        # messages in the rescan window that slack didn't send this time
+        # have been deleted. They're marked, not dropped from the archive.
+        seen = self.window_seen.pop(channel, None)
+        if seen is None:
+            return
+        deleted = {}
+        for ts in self.store.timestamps_after(channel, f'{self.rescan_cutoff[channel]:.6f}'):
+            if ts in seen:
+                continue
+            thread = self.store.get_thread(channel, ts)
+            if not thread['message'].get('deleted'):
+                thread['message']['deleted'] = True
+                deleted[ts] = thread
+        if deleted:
+            archive_logger.info(f'{len(deleted)} messages in {channel} have been deleted since the last scrape.')
+            metrics.count('messages_deleted', len(deleted))
+            self.store.put_threads(channel, deleted)
+
+    def stored_replies(self, channel:str, ts:str) -> list:
+        thread = self.store.get_thread(channel, ts)
+        return thread['replies'] if thread is not None else []
+
+    def thread_changed(self, channel:str, message:dict) -> bool:
+        # Does this message's thread have replies we haven't stored?
+        # History messages carry reply_count and latest_reply for threads,
+        # so messages without a thread never need a replies call.
+        if not message.get('reply_count') or 'latest_reply' not in message:
+            return False
+
+        stored = self.stored_replies(channel, message['ts'])
+        if not stored:
+            return True
+
+        newest_stored = max(float(reply['ts']) for reply in stored)
+        return float(message['latest_reply']) > newest_stored
+
+    def update_high_water(self, channel:str) -> None:
+        newest = self.store.newest_ts(channel)
+        if newest is None:
+            return
+
+        if channel not in self.high_water or float(newest) > float(self.high_water[channel]):
+            self.high_water[channel] = newest
+
+    def prepare_message(self, message:dict) -> dict:
+        metrics.count('messages_processed')
+        metrics.count('text_characters', len(message.get('text') or ''))
+        if self.files is not None and 'files' in message:
+            self.files.add(message_files(message))
+        with metrics.timer('text'):
+            if not self.raw:
+                return self.process_message_object(message)
+
+            # visualize gets names from the user list, so make sure
+            # everyone in the message is in it
+            for user_id in message_user_ids(message):
+                self.directory.get(user_id)
+            return message
 
     def process_message_object(self, message:dict) -> dict:
-        message['text'] = self.username_replace(message['text'])
-        message['text'] = self.url_replace(message['text'])
-        message['text'] = self.emoji_replace(message['text'])
-        message['user'] = self.users[message['user']]
+        message['text'] = self.transform_text(message.get('text') or '')
+        message['user'] = self.directory.author(message)
         message['format_ts'] = datetime.fromtimestamp(
             float(message['ts'])
         ).strftime('%Y-%m-%d %H:%M:%S')
@@ -171,92 +984,68 @@ class Scraper(object):
         archive_logger.debug('Perform emoji replacement')
         if 'reactions' in message:
             for reaction in message['reactions']:
-                reaction['name'] = self.emoji_replace(f":{reaction['name']}:")
-                reaction['users'] = [self.users[x] for x in reaction['users']]
+                reaction['name'] = self.transform_text(f":{reaction['name']}:")
+                reaction['users'] = [self.directory.name(x) for x in reaction['users']]
 
         archive_logger.debug('Done processing.')
         return message
 
+    def fetch_replies(self, channel:str, message:dict) -> list:
+        archive_logger.debug('Getting replies to %s', message['text'])
+        with metrics.timer('replies'):
+            reply_request = self.scheduler.call(
+                'conversations.replies',
+                channel = self.channel_dict[channel],
+                ts = message['ts']
+            )
+
+        # the first message in the replies is the original (parent)
+        # message, so we leave it out
+        reply_batch = reply_request['messages'][1:]
+        archive_logger.debug('Got replies. Contains %d replies', len(reply_batch))
+        replies = reply_batch
+
+        while reply_request['has_more']:
+            archive_logger.debug('Getting more replies to %s', message['text'])
+            with metrics.timer('replies'):
+                reply_request = self.scheduler.call(
+                    'conversations.replies',
+                    channel = self.channel_dict[channel],
+                    ts = message['ts'],
+                    cursor = reply_request['response_metadata']['next_cursor']
+                )
+            replies.extend(reply_request['messages'])
+
+        archive_logger.debug('No more replies.')
+        return replies
+
     def process_messages(self, channel:str, messages:list) -> dict:
         processed_messages = {}
-        archive_logger.debug(f'Begin processing messages:')
-        archive_logger.debug('\n  '.join([m['text'] for m in messages]))
+        # debug messages are only built when debug logging is on
+        if archive_logger.isEnabledFor(logging.DEBUG):
+            archive_logger.debug('Begin processing messages:')
+            archive_logger.debug('\n  '.join([m.get('text', '') for m in messages]))
         for message in messages:
-            archive_logger.debug(f'Now on {message}')
-            if message['ts'] in self.timestamps(channel):
-                archive_logger.debug(f'Message already in database.')
+            archive_logger.debug('Now on %s', message)
+            process, fetch_thread, stored = self.plan_message(channel, message)
+            if not process:
+                archive_logger.debug('Message already in database.')
                 continue
 
             archive_logger.debug('Process message')
-            message = self.process_message_object(message)
+            message = self.reconciled_message(message, stored)
 
             message_dict = {
                 'message': message
             }
 
-            replies = []
-            try:
-                archive_logger.debug(f"Getting replies to {message['text']}")
-                reply_request = self.client.conversations_replies(
-                    channel = self.channel_dict[channel],
-                    ts = message['ts']
-                )
-            except SlackApiError as e:
-                if e.response['error'] == 'ratelimited':
-                    delay = int(e.response.headers['Retry-After'])
-                    archive_logger.debug(f'Rate limited while fetching messages. Trying again in {delay} seconds.')
-                    time.sleep(delay)
-                    reply_request = self.client.conversations_replies(
-                        channel = self.channel_dict[channel],
-                        ts = message['ts']
-                    )
-                else:
-                    raise e
-
-            reply_batch = reply_request['messages']
-            archive_logger.debug(f'Got replies. Contains {len(reply_batch) - 1} replies')
-
-            if len(reply_batch) != 1:
-                
-                # the first message in the replies is the original (parent)
-                # message, so we need to delete it
-                del reply_batch[0]
-                archive_logger.debug('Processing initial replies.')
-                for reply in reply_batch:
-                    reply = self.process_message_object(reply)
-                    replies.append(reply)
-                archive_logger.debug('Done processing initial replies. Moving on.')
-
-            while reply_request['has_more']:
-                try:
-                    archive_logger.debug(f"Getting more replies to {message['text']}")
-                    reply_request = self.client.conversations_replies(
-                        channel = self.channel_dict[channel],
-                        ts = message['ts'],
-                        cursor = reply_request['reponse_metadata']['next_cursor']
-                    )
-
-                    archive_logger.debug('Got more replies. Processing.')
-
-                    for reply in reply_request['messages']:
-                        reply = self.process_message_object(reply)
-                        replies.append(reply)
-
-                    archive_logger.debug('Done processing. Checking for more replies')
-
-                except SlackApiError as e:
-                    if e.response['error'] == 'ratelimited':
-                        delay = int(e.response.headers['Retry-After'])
-                        archive_logger.debug(f'Rate limited while fetching messages. Trying again in {delay} seconds.')
-                        time.sleep(delay)
-                        continue
-                    else:
-                        raise e
+            if fetch_thread:
+                message_dict['replies'] = self.thread_replies(channel, message['ts'], self.fetch_replies(channel, message))
+            else:
+                archive_logger.debug('No new replies. Not fetching thread.')
+                self.reply_calls_saved += 1
+                message_dict['replies'] = self.stored_replies(channel, message['ts'])
 
-            archive_logger.debug('No more replies. Adding to message dict')
-            
-            message_dict['replies'] = sorted(replies, key = lambda d: d['ts'])
-            archive_logger.debug('Sorted.')
             processed_messages[message['ts']] = message_dict
             archive_logger.debug('Added to message dict.')
 
@@ -265,111 +1054,1042 @@ class Scraper(object):
 
 
     def scrape_channel(self, channel:str) -> None:
-        # this function could likely improve. Rather than downloading
-        # all the messages we have access to and checking if they're already
-        # in the old data, we should start after the latest message for which
-        # we have data. However, I ran into a bunch of API issues doing this
-        # with the old script and gave up, since this is fast enough and also
-        # speed doesn't really matter.
+        # in incremental mode we only ask for messages after the newest
+        # one we have (minus the rescan window). Otherwise we download
+        # everything we have access to and skip messages already stored.
 
         archive_logger.info(f'Scraping {channel}')
-        message_batch = False
-        while not message_batch:
-            try:
-                archive_logger.debug('Getting new messages')
-                message_batch = self.client.conversations_history(
-                    channel = self.channel_dict[channel]
-                )
-            except SlackApiError as e:
-                if e.response['error'] == 'ratelimited':
-                    delay = int(e.response.headers['Retry-After'])
-                    archive_logger.info(f'Rate limited while fetching messages. Trying again in {delay} seconds.')
-                    time.sleep(delay)
-                    continue
-                elif e.response['error'] == 'not_in_channel':
-                    archive_logger.warning(f"Bot not in channel {channel}. Add it by tagging in the channel.")
-                    self.message_data[channel] = {}
-                    return
-                else:
-                    raise e
+        history_args, page = self.start_channel(channel)
+
+        try:
+            archive_logger.debug('Getting new messages')
+            with metrics.timer('history'):
+                message_batch = self.scheduler.call('conversations.history', **history_args, **page)
+        except SlackApiError as e:
+            if error_code(e) == 'not_in_channel':
+                archive_logger.warning(f"Bot not in channel {channel}. Add it by tagging in the channel.")
+                self.store.add_channel(channel)
+                return
+            else:
+                raise e
 
-        if channel not in self.message_data:
-            self.message_data[channel] = {}
+        self.store.add_channel(channel)
 
         archive_logger.debug('Processing message batch.')
-        self.message_data[channel].update(
+        self.store.put_threads(
+            channel,
             self.process_messages(channel, message_batch['messages'])
         )
+        self.finish_page(channel, history_args, message_batch)
 
         while message_batch['has_more']:
-            try:
-                archive_logger.debug('Getting more messages')
-                message_batch = self.client.conversations_history(
-                    channel = self.channel_dict[channel],
+            archive_logger.debug('Getting more messages')
+            with metrics.timer('history'):
+                message_batch = self.scheduler.call(
+                    'conversations.history',
+                    **history_args,
                     cursor = message_batch['response_metadata']['next_cursor']
                 )
-            except SlackApiError as e:
-                if e.response['error'] == 'ratelimited':
-                    delay = int(e.response.headers['Retry-After'])
-                    archive_logger.info(f'Rate limited while fetching messages. Trying again in {delay} seconds.')
-                    time.sleep(delay)
-                    continue
-                else:
-                    raise e
-
-            if channel not in self.message_data:
-                self.message_data[channel] = {}
 
             archive_logger.debug('Processing message batch')
-            self.message_data[channel].update(
+            self.store.put_threads(
+                channel,
                 self.process_messages(channel, message_batch['messages'])
             )
-
+            self.finish_page(channel, history_args, message_batch)
 
         archive_logger.debug(f'Done with {channel}. Sorting and saving.')
-        # sort by key
-        self.message_data[channel] = dict(sorted(self.message_data[channel].items()))
+        self.finish_channel(channel)
+
+    def start_channel(self, channel:str) -> tuple:
+        # the conversations_history arguments for this channel, and the
+        # cursor of the first page to fetch if we're resuming
+        if channel in self.checkpoint.cursors:
+            saved = self.checkpoint.cursors[channel]
+            archive_logger.info(f'Resuming {channel} from checkpoint.')
+            if saved['rescan_cutoff'] is not None:
+                self.rescan_cutoff[channel] = saved['rescan_cutoff']
+            return saved['args'], {'cursor': saved['cursor']}
+
+        history_args = {'channel': self.channel_dict[channel]}
+        oldest = self.oldest(channel)
+        if oldest is not None:
+            archive_logger.info(f'Only fetching messages after {oldest}')
+            history_args['oldest'] = oldest
+        # what's missing from the window once the channel is done was deleted
+        if channel in self.rescan_cutoff:
+            self.window_seen[channel] = set()
+
+        return history_args, {}
+
+    def finish_page(self, channel:str, history_args:dict, message_batch:dict) -> None:
+        if message_batch['has_more']:
+            self.checkpoint.cursors[channel] = {
+                'args': history_args,
+                'cursor': message_batch['response_metadata']['next_cursor'],
+                'rescan_cutoff': self.rescan_cutoff.get(channel)
+            }
+
+        self.checkpoint.messages += len(message_batch['messages'])
+        metrics.count('messages_fetched', len(message_batch['messages']))
+        if self.checkpoint.due():
+            self.write_checkpoint()
+
+    def finish_channel(self, channel:str) -> None:
+        with metrics.timer('sort'):
+            self.store.finish_channel(channel)
+        self.mark_deletions(channel)
+        self.update_high_water(channel)
+        self.checkpoint.cursors.pop(channel, None)
+        self.checkpoint.completed.append(channel)
+
+    def write_checkpoint(self) -> None:
+        archive_logger.info('Writing checkpoint.')
+        self.save(self.checkpoint.archive)
+        # a full scrape has no high water to resume from, even though
+        # scraping fills it in as it goes
+        self.checkpoint.write(self.high_water if self.incremental else None)
+
+    def remaining_targets(self) -> list:
+        remaining = [channel for channel in self.targets if channel not in self.checkpoint.completed]
+        if len(remaining) < len(self.targets):
+            archive_logger.info(f'Skipping {len(self.targets) - len(remaining)} channels finished before the checkpoint.')
+        return remaining
 
     def scrape_targets(self):
-        for channel in self.targets:
+        for channel in self.remaining_targets():
             self.scrape_channel(channel)
-            
 
-def scrape_session(args):
+        self.finish_files()
+        self.report()
+
+    def queue_stored_files(self) -> None:
+        # files in messages archived before files were being downloaded,
+        # or that failed to download last time
+        stored_channels = set(self.store.channels())
+        for channel in self.targets:
+            if channel not in stored_channels:
+                continue
+            for thread in self.store.threads(channel):
+                for message in [thread['message']] + thread['replies']:
+                    if 'files' in message:
+                        self.files.add(message_files(message))
+
+    def finish_files(self) -> None:
+        if self.files is not None:
+            with metrics.timer('files'):
+                self.files.finish()
+            metrics.count('files_downloaded', self.files.downloaded)
+            metrics.count('file_bytes', self.files.downloaded_bytes)
+
+    def report(self) -> None:
+        archive_logger.info(f'Skipped {self.reply_calls_saved} conversations.replies calls for threads without new replies.')
+        self.directory.report()
+        self.scheduler.report()
+        if self.files is not None:
+            self.files.report()
+
+class AsyncScraper(Scraper):
+    # Scrapes several channels, and the threads in each channel, at once
+    # with the async slack client. Requests go through the scheduler's
+    # RateLimiter, shared by all the workers, and at most `concurrency`
+    # are in flight. The resulting archive is the same as Scraper's.
+    def __init__(self, *args, concurrency:int = 4, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+
+    def scrape_targets(self):
+        # emoji_dict would otherwise fetch the custom emoji with a blocking
+        # call the first time a message needs it, stalling every worker
+        if not self.raw and self._emoji_dict is None:
+            self.load_emoji()
+        asyncio.run(self.scrape_targets_async())
+
+    async def scrape_targets_async(self):
+        self.async_client = AsyncWebClient(token = self.client.token, base_url = self.client.base_url)
+        self.scheduler.request_slots = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.scrape_channel_async(channel) for channel in self.remaining_targets()])
+        self.finish_files()
+        self.report()
+
+    async def call(self, method:str, **kwargs) -> dict:
+        return await self.scheduler.call_async(self.async_client, method, **kwargs)
+
+    async def fetch_replies_async(self, channel:str, ts:str) -> list:
+        with metrics.timer('replies'):
+            reply_request = await self.call(
+                'conversations.replies',
+                channel = self.channel_dict[channel],
+                ts = ts
+            )
+        # the first message in the replies is the original (parent)
+        # message, so we leave it out
+        replies = reply_request['messages'][1:]
+
+        while reply_request['has_more']:
+            with metrics.timer('replies'):
+                reply_request = await self.call(
+                    'conversations.replies',
+                    channel = self.channel_dict[channel],
+                    ts = ts,
+                    cursor = reply_request['response_metadata']['next_cursor']
+                )
+            replies.extend(reply_request['messages'])
+
+        return replies
+
+    async def look_up_user_async(self, user_id:str) -> None:
+        try:
+            user_response = await self.call('users.info', user = user_id)
+            self.directory.add(user_id, user_response['user'])
+        except SlackApiError as e:
+            archive_logger.debug(f"Couldn't look up user {user_id}: {error_code(e)}")
+            self.directory.add(user_id, None)
+
+    async def look_up_users_async(self, messages:list) -> None:
+        # look up everyone in a page the user list doesn't have at once,
+        # rather than one at a time as process_message_object finds them
+        user_ids = set()
+        for message in messages:
+            user_ids.update(message_user_ids(message))
+
+        await asyncio.gather(*[self.look_up_user_async(user_id) for user_id in self.directory.unknown(user_ids)])
+
+    async def process_messages_async(self, channel:str, messages:list) -> dict:
+        to_process = []
+        for message in messages:
+            process, fetch_thread, stored = self.plan_message(channel, message)
+            if process:
+                to_process.append((message, fetch_thread, stored))
+                if not fetch_thread:
+                    self.reply_calls_saved += 1
+
+        threads = [message['ts'] for message, fetch_thread, _ in to_process if fetch_thread]
+        reply_batches = await asyncio.gather(
+            *[self.fetch_replies_async(channel, ts) for ts in threads]
+        )
+        reply_batches = dict(zip(threads, reply_batches))
+
+        await self.look_up_users_async(
+            [message for message, _, _ in to_process] +
+            [reply for replies in reply_batches.values() for reply in replies]
+        )
+
+        processed_messages = {}
+        for message, fetch_thread, stored in to_process:
+            message = self.reconciled_message(message, stored)
+            if fetch_thread:
+                replies = self.thread_replies(channel, message['ts'], reply_batches[message['ts']])
+            else:
+                replies = self.stored_replies(channel, message['ts'])
+
+            processed_messages[message['ts']] = {
+                'message': message,
+                'replies': replies
+            }
+
+        return processed_messages
+
+    async def scrape_channel_async(self, channel:str) -> None:
+        archive_logger.info(f'Scraping {channel}')
+        history_args, page = self.start_channel(channel)
+
+        try:
+            with metrics.timer('history'):
+                message_batch = await self.call('conversations.history', **history_args, **page)
+        except SlackApiError as e:
+            if error_code(e) == 'not_in_channel':
+                archive_logger.warning(f"Bot not in channel {channel}. Add it by tagging in the channel.")
+                self.store.add_channel(channel)
+                return
+            raise e
+
+        self.store.add_channel(channel)
+
+        while True:
+            self.store.put_threads(
+                channel,
+                await self.process_messages_async(channel, message_batch['messages'])
+            )
+            self.finish_page(channel, history_args, message_batch)
+            if not message_batch['has_more']:
+                break
+
+            with metrics.timer('history'):
+                message_batch = await self.call(
+                    'conversations.history',
+                    **history_args,
+                    cursor = message_batch['response_metadata']['next_cursor']
+                )
+
+        archive_logger.debug(f'Done with {channel}. Sorting and saving.')
+        self.finish_channel(channel)
+
+
+def load_previous_data(path:str):
     try:
-        with open(os.path.realpath(args.input), 'r') as f:
-            previous_data = json.load(f)
+        return open_store(os.path.realpath(path))
     except FileNotFoundError:
         archive_logger.warning("Input JSON not found. If this is the first time you're running the archiver that's fine.")
-        previous_data = {}
+        return JSONStore()
 
-    client = create_client(args.token)
+def load_high_water(state_file:str) -> dict:
+    try:
+        with open(os.path.realpath(state_file), 'r') as f:
+            return json.load(f)['high_water']
+    except FileNotFoundError:
+        archive_logger.info('No state file found. Using the newest message in the input JSON for each channel.')
+        return {}
+
+def make_file_archive(args, client:WebClient) -> FileArchive:
+    if not args.download_files:
+        return None
+    return FileArchive(
+        args.files_dir,
+        token = client.token,
+        concurrency = args.files_concurrency,
+        max_bytes = args.files_max_bytes
+    )
+
+def target_channels(args):
     if args.archive_all:
-        targets = 'all'
+        return 'all'
+    return args.select_channels
+
+def common_scraper_options(args, files:FileArchive) -> dict:
+    # the Scraper options scrape and watch share
+    return {
+        'rescan_days': args.rescan_days,
+        'emoji_cache': args.emoji_cache,
+        'max_retries': args.max_retries,
+        'user_cache': args.user_cache,
+        'raw': args.raw,
+        'files': files,
+        'channel_cache': args.channel_cache,
+        'channel_types': args.channel_types,
+        'include_archived': args.include_archived
+    }
+
+def scrape_session(args):
+    # a database input is updated in place unless a different output is given
+    if args.output is None:
+        args.output = args.input
+
+    checkpoint_options = {
+        'every_messages': args.checkpoint_messages,
+        'every_seconds': args.checkpoint_seconds
+    }
+    checkpoint = None
+    resumed = False
+    if args.resume:
+        try:
+            checkpoint = Checkpoint.load(args.checkpoint, **checkpoint_options)
+            archive_logger.info(f'Resuming from checkpoint. {len(checkpoint.completed)} channels already done.')
+            args.input = args.output = checkpoint.archive
+            resumed = True
+        except FileNotFoundError:
+            archive_logger.warning('No checkpoint found. Starting from the beginning.')
+    elif os.path.exists(args.checkpoint):
+        archive_logger.warning('Found a checkpoint from an interrupted run. Use --resume to continue it. Starting over.')
+
+    if checkpoint is None:
+        checkpoint = Checkpoint(args.checkpoint, os.path.realpath(args.output), **checkpoint_options)
+
+    previous_data = load_previous_data(args.input)
+
+    # a resumed run is incremental if and only if the run it continues was
+    high_water = None
+    if resumed:
+        high_water = checkpoint.high_water
+    elif args.incremental:
+        high_water = load_high_water(args.state)
+
+    client = create_client(args.token)
+    files = make_file_archive(args, client)
+    targets = target_channels(args)
+    scraper_options = dict(
+        common_scraper_options(args, files),
+        high_water = high_water,
+        checkpoint = checkpoint
+    )
+    if args.concurrency > 1:
+        scraper = AsyncScraper(
+            previous_data,
+            client,
+            targets,
+            concurrency = args.concurrency,
+            **scraper_options
+        )
     else:
-        targets = args.select_channels
-    scraper = Scraper(previous_data, client, targets)
+        scraper = Scraper(previous_data, client, targets, **scraper_options)
+    if files is not None:
+        scraper.queue_stored_files()
     scraper.scrape_targets()
 
-    scraper.write_json(args.output)
+    scraper.save(args.output)
+    scraper.store.close()
+    if scraper.incremental:
+        scraper.write_state(args.state)
+    checkpoint.remove()
+
+# Watching ----------------------------------------------------------------
+
+class Watcher(object):
+    # Keeps one incremental Scraper, with its client, user directory and
+    # channel list, for as long as it runs, and polls each channel again
+    # after an interval that grows with how long the channel has been
+    # quiet: activity_factor times the age of its newest message, kept
+    # between min_interval and max_interval. Polls share a token bucket of
+    # `budget` Slack calls a minute, replies and user lookups included, on
+    # top of the per-method tier limits the scheduler already keeps to.
+    # The archive and state file are saved every save_seconds if anything
+    # changed, and the channel list, user list and custom emoji are
+    # refreshed every refresh_seconds.
+    def __init__(self, scraper:Scraper, targets, output:str, state_file:str, budget:float = 30, activity_factor:float = 0.1, min_interval:float = 60, max_interval:float = 6 * 3600, save_seconds:float = 300, refresh_seconds:float = 3600, on_save = None) -> None:
+        self.scraper = scraper
+        self.targets = targets
+        self.output = output
+        self.state_file = state_file
+        self.budget = budget
+        self.activity_factor = activity_factor
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.save_seconds = save_seconds
+        self.refresh_seconds = refresh_seconds
+        # called with the set of channels that changed after each save
+        self.on_save = on_save
+
+        self.stopping = threading.Event()
+        # (due, channel) heap. due is also kept per channel; heap entries
+        # that don't match it are stale and skipped.
+        self.schedule = []
+        self.due = {}
+        self.failures = {}
+        self.changed = set()
+        self.tokens = budget
+        self.tokens_time = time.monotonic()
+        self.last_save = time.monotonic()
+        self.last_refresh = time.monotonic()
+        self.polls = 0
+
+        # every channel is polled once at the start, as fast as the budget allows
+        for channel in scraper.targets:
+            self.reschedule(channel, 0)
+
+    def reschedule(self, channel:str, delay:float) -> None:
+        self.due[channel] = time.monotonic() + delay
+        heapq.heappush(self.schedule, (self.due[channel], channel))
+
+    def interval(self, channel:str) -> float:
+        if self.failures.get(channel):
+            return min(self.max_interval, self.min_interval * 2 ** self.failures[channel])
+        newest = self.scraper.newest_ts(channel)
+        if newest is None:
+            return self.max_interval
+        age = max(0, time.time() - float(newest))
+        return min(self.max_interval, max(self.min_interval, age * self.activity_factor))
+
+    def api_calls(self) -> int:
+        return sum(method_stats['calls'] for method_stats in self.scraper.scheduler.stats.values())
+
+    def changes(self) -> int:
+        # messages stored or marked deleted so far. Messages already
+        # archived aren't processed again unless they've changed.
+        return sum(metrics.counters.get(name, 0) for name in ('messages_processed', 'messages_deleted', 'replies_deleted'))
+
+    def budget_wait(self) -> float:
+        # seconds until the bucket has a call in it. A poll that used more
+        # calls than were there leaves it negative, and later polls wait.
+        now = time.monotonic()
+        self.tokens = min(self.budget, self.tokens + (now - self.tokens_time) * self.budget / 60)
+        self.tokens_time = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) * 60 / self.budget
+
+    def poll(self, channel:str) -> None:
+        changes = self.changes()
+        calls = self.api_calls()
+        try:
+            self.scraper.scrape_channel(channel)
+            self.failures.pop(channel, None)
+        except (SlackApiError, *transient_errors) as e:
+            self.failures[channel] = self.failures.get(channel, 0) + 1
+            archive_logger.warning(f'Polling {channel} failed ({self.scraper.scheduler.describe(e)}). Trying again later.')
+        finally:
+            self.tokens -= self.api_calls() - calls
+
+        # nothing needs the list of finished channels, and it would grow forever
+        self.scraper.checkpoint.completed.clear()
+        self.polls += 1
+        metrics.count('watch_polls')
+        if self.changes() > changes:
+            self.changed.add(channel)
+            metrics.count('watch_channels_changed')
+
+        interval = self.interval(channel)
+        archive_logger.debug('Next poll of %s in %.0f seconds.', channel, interval)
+        self.reschedule(channel, interval)
+
+    def refresh(self) -> None:
+        archive_logger.info('Refreshing the channel list, user list and custom emoji.')
+        calls = self.api_calls()
+        try:
+            self.scraper.load_channels(self.targets, refresh = True)
+            # the caches are usually younger than their TTLs, so fetch both
+            # lists again rather than loading them
+            directory = self.scraper.directory
+            known = directory.names
+            with metrics.timer('users'):
+                directory.fetch_all()
+            # people from other workspaces were looked up one at a time
+            for user_id, name in known.items():
+                directory.names.setdefault(user_id, name)
+            directory.save()
+            self.scraper.load_emoji(refresh = True)
+        except (SlackApiError, *transient_errors) as e:
+            archive_logger.warning(f'Refreshing failed ({self.scraper.scheduler.describe(e)}). Trying again later.')
+        else:
+            for channel in self.scraper.targets:
+                if channel not in self.due:
+                    archive_logger.info(f'Found new channel {channel}.')
+                    self.reschedule(channel, 0)
+            for channel in set(self.due) - set(self.scraper.targets):
+                archive_logger.info(f'{channel} is gone. No longer watching it.')
+                del self.due[channel]
+        self.tokens -= self.api_calls() - calls
+        self.last_refresh = time.monotonic()
+
+    def save(self) -> None:
+        if self.changed:
+            archive_logger.info(f'Saving {len(self.changed)} changed channels after {self.polls} polls.')
+            self.scraper.save(self.output)
+            self.scraper.write_state(self.state_file)
+            changed, self.changed = self.changed, set()
+            if self.on_save is not None:
+                self.on_save(changed)
+        self.last_save = time.monotonic()
+
+    def next_poll(self) -> tuple:
+        # (channel, seconds until it's due), skipping stale heap entries
+        while self.schedule:
+            due, channel = self.schedule[0]
+            if self.due.get(channel) != due:
+                heapq.heappop(self.schedule)
+                continue
+            return channel, due - time.monotonic()
+        return None, self.max_interval
+
+    def stop(self, *args) -> None:
+        self.stopping.set()
+
+    def run(self) -> None:
+        archive_logger.info(f'Watching {len(self.due)} channels. Stop with Ctrl-C or SIGTERM.')
+        try:
+            while not self.stopping.is_set():
+                now = time.monotonic()
+                if now - self.last_refresh >= self.refresh_seconds:
+                    self.refresh()
+                if now - self.last_save >= self.save_seconds:
+                    self.save()
+
+                channel, wait = self.next_poll()
+                wait = max(wait, self.budget_wait())
+                if wait > 0:
+                    # wake up for the next save or refresh too
+                    wait = min(
+                        wait,
+                        self.last_save + self.save_seconds - now,
+                        self.last_refresh + self.refresh_seconds - now
+                    )
+                    self.stopping.wait(max(wait, 0.01))
+                    continue
+
+                heapq.heappop(self.schedule)
+                self.poll(channel)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # whatever stopped it, don't lose the polls since the last save
+            archive_logger.info('Stopping. Saving what we have.')
+            self.save()
+            self.scraper.finish_files()
+            self.scraper.report()
+
+def watch_session(args):
+    if args.output is None:
+        args.output = args.input
+    if args.visualize is not None and args.workspace is None:
+        archive_logger.error('--visualize needs --workspace for the page titles.')
+        sys.exit(1)
+
+    previous_data = load_previous_data(args.input)
+    client = create_client(args.token)
+    files = make_file_archive(args, client)
+    targets = target_channels(args)
+    scraper = Scraper(
+        previous_data,
+        client,
+        targets,
+        high_water = load_high_water(args.state),
+        **common_scraper_options(args, files)
+    )
+    if files is not None:
+        scraper.queue_stored_files()
+
+    command = args.func.__name__.split('_')[0]
+
+    def on_save(changed:set) -> None:
+        if args.metrics:
+            metrics.write_json(args.metrics, command)
+        if args.metrics_prometheus:
+            metrics.write_prometheus(args.metrics_prometheus, command)
+        if args.visualize is not None:
+            os.makedirs(args.visualize, exist_ok = True)
+            visualize_args = parser.parse_args([
+                'visualize', args.output, args.workspace,
+                '--output', args.visualize,
+                '--user-cache', args.user_cache,
+                '--emoji-cache', args.emoji_cache,
+                '--files-dir', args.files_dir
+            ])
+            visualize_data(visualize_args, changed)
+
+    watcher = Watcher(
+        scraper,
+        targets,
+        args.output,
+        args.state,
+        budget = args.budget,
+        activity_factor = args.activity_factor,
+        min_interval = args.min_interval,
+        max_interval = args.max_interval,
+        save_seconds = args.save_seconds,
+        refresh_seconds = args.refresh_seconds,
+        on_save = on_save
+    )
+    signal.signal(signal.SIGTERM, watcher.stop)
+    watcher.run()
+    scraper.store.close()
 
 
 # Visualization ---------------------------------------------------------------
 
-templateLoader = jinja2.FileSystemLoader(searchpath = os.path.join(script_dir, 'templates'))
+template_dir = os.path.join(script_dir, 'templates')
+templateLoader = jinja2.FileSystemLoader(searchpath = template_dir)
 templateEnv = jinja2.Environment(loader = templateLoader)
 template = templateEnv.get_template('channel.html')
 index = templateEnv.get_template('index.html')
 
-def visualize_data(args):
+def load_store(path:str):
+    if not os.path.exists(path):
+        archive_logger.error(f'Input file "{path}" does not exist.')
+        sys.exit(5)
+
+    return open_store(path)
+
+# Archives scraped with --raw hold messages as slack sent them, and they're
+# transformed here as they're rendered, by the same code the scraper uses.
+# Changing the rules only means running visualize again, not scraping.
+# Messages transformed while scraping have a format_ts and are left alone,
+# so an archive can have both. Transformed text is cached, keyed by the
+# text and transform_version, which goes up whenever the output changes.
+transform_version = 3
+transform_cache_size = 100000
+
+def is_raw(message:dict) -> bool:
+    return 'format_ts' not in message
+
+class MessageRenderer(Scraper):
+    def __init__(self, users:dict, custom_emoji:dict, file_links:FileLinks = None, cache_size:int = transform_cache_size) -> None:
+        super().__init__({}, None, [], no_connection = True)
+        self.users = users
+        self.custom_emoji_table = custom_emoji
+        self.file_links = file_links
+        self.cache_size = cache_size
+        self.text_cache = {}
+
+    @property
+    def emoji_dict(self) -> dict:
+        if self._emoji_dict is None:
+            self._emoji_dict = load_emoji_table()
+            self._emoji_dict.update(resolve_custom_emoji(self.custom_emoji_table, self._emoji_dict))
+        return self._emoji_dict
+
+    def transform_text(self, text:str) -> str:
+        # least recently used text is dropped first. dicts keep insertion
+        # order, so a hit is moved to the end by putting it back.
+        key = (transform_version, text)
+        try:
+            output = self.text_cache.pop(key)
+        except KeyError:
+            output = super().transform_text(text)
+            if len(self.text_cache) >= self.cache_size:
+                del self.text_cache[next(iter(self.text_cache))]
+        self.text_cache[key] = output
+        return output
+
+    def render_message(self, message:dict) -> dict:
+        if is_raw(message):
+            # the archive's copy is left as it is
+            message = dict(message)
+            if 'reactions' in message:
+                message['reactions'] = [dict(reaction) for reaction in message['reactions']]
+            message = self.process_message_object(message)
+
+        if message.get('files'):
+            message = dict(message, local_files = [self.local_file(f) for f in message['files']])
+        return message
+
+    def local_file(self, f:dict) -> dict:
+        # what the templates show for a file: a link to the downloaded copy
+        # and a thumbnail for images, or just the name
+        local = self.file_links.local_file(f) if self.file_links is not None else None
+        if local is None:
+            return {'name': f.get('name') or f.get('title') or 'file', 'href': None, 'thumb': None}
+        return local
+
+    def render_thread(self, thread:dict) -> dict:
+        return {
+            'message': self.render_message(thread['message']),
+            'replies': [self.render_message(reply) for reply in thread['replies']]
+        }
+
+# each process rendering pages has its own renderer, and its own cache
+renderer = None
+
+def start_renderer(users:dict, custom_emoji:dict, file_links:FileLinks = None) -> None:
+    global renderer
+    renderer = MessageRenderer(users, custom_emoji, file_links)
+
+def load_render_inputs(store, user_cache:str, emoji_cache:str) -> tuple:
+    # names and custom emoji for raw messages: the users saved in the
+    # archive and the scraper's user and emoji caches
+    users = store.users()
+    custom_emoji = {}
+    try:
+        with open(user_cache, 'r') as f:
+            users.update(json.load(f)['users'])
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    try:
+        with open(emoji_cache, 'r') as f:
+            custom_emoji = json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return users, custom_emoji
+
+# visualize keeps a manifest in the output directory of what each page was
+# built from, so channels whose messages and templates haven't changed
+# aren't rendered again.
+manifest_name = '.build_manifest.json'
+
+def templates_hash(workspace:str, channels:list, page_by:str, page_size:int, precompress:list, compact:bool) -> str:
+    # everything every page depends on: the templates, the workspace
+    # name and channel list in the header and sidebar, the page breaks,
+    # which compressed copies are made and whether pages are compact
+    digest = hashlib.sha256(json.dumps([workspace, channels, page_by, page_size, sorted(precompress), compact]).encode())
+    for name in sorted(os.listdir(template_dir)):
+        with open(os.path.join(template_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def page_name(channel:str, key:str, last:bool) -> str:
+    # the newest page keeps the plain channel name, so links from the
+    # sidebar and index always land on the latest messages
+    return f'{channel}.html' if last else f'{channel}.{key}.html'
+
+def plan_pages(threads, page_by:str, page_size:int) -> tuple:
+    # one pass over a channel that hashes its content and works out where
+    # the page breaks fall, without holding on to the threads themselves,
+    # and whether any of its messages are raw or have files. Each page is
+    # [key, number of threads, [month, ts of its first thread] for each
+    # month starting on the page].
+    digest = hashlib.sha256()
+    pages = []
+    month = None
+    raw = False
+    has_files = False
+    for thread in threads:
+        digest.update(json.dumps(thread).encode())
+        raw = raw or is_raw(thread['message']) or any(is_raw(reply) for reply in thread['replies'])
+        has_files = has_files or 'files' in thread['message'] or any('files' in reply for reply in thread['replies'])
+        thread_month = datetime.fromtimestamp(float(thread['message']['ts'])).strftime('%Y-%m')
+        if page_by == 'month':
+            new_page = thread_month != month
+        elif page_by == 'size':
+            new_page = not pages or pages[-1][1] == page_size
+        else:
+            new_page = not pages
+
+        if new_page:
+            key = thread_month if page_by == 'month' else str(len(pages) + 1)
+            pages.append([key, 0, []])
+        if thread_month != month:
+            pages[-1][2].append([thread_month, thread['message']['ts']])
+            month = thread_month
+        pages[-1][1] += 1
+
+    if not pages:
+        pages.append(['1', 0, []])
+
+    return digest.hexdigest(), pages, raw, has_files
+
+def channel_pages(channel:str, pages:list) -> list:
+    # what the template needs to know about each page of a channel: its
+    # file, its neighbours, and where every month in the channel starts
+    files = [page_name(channel, key, i == len(pages) - 1) for i, (key, _, _) in enumerate(pages)]
+    months = [
+        (month, f'{name}#{ts}')
+        for name, (_, _, page_months) in zip(files, pages)
+        for month, ts in page_months
+    ]
+    return [
+        {
+            'file': files[i],
+            'page': i + 1,
+            'page_count': len(pages),
+            'previous_page': files[i - 1] if i > 0 else None,
+            'next_page': files[i + 1] if i < len(pages) - 1 else None,
+            'months': months
+        }
+        for i in range(len(pages))
+    ]
+
+def load_manifest(output_dir:str) -> dict:
     try:
-        with open(os.path.realpath(args.input), 'r') as f:
-            slack_data = json.load(f)
+        with open(os.path.join(output_dir, manifest_name), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'templates': None, 'channels': {}}
+
+# With --precompress, every page and search file gets compressed copies
+# next to it (page.html.gz, page.html.br) for web servers that serve those
+# instead of compressing each response (nginx's gzip_static and
+# brotli_static, for example). Copies in formats that weren't asked for
+# are removed, so a server never finds a stale one.
+precompress_extensions = {'gzip': '.gz', 'br': '.br'}
+# brotli's top quality, 11, is several times slower for a few percent
+brotli_quality = 9
+
+def precompress_file(path:str, formats:list) -> None:
+    for kind, extension in precompress_extensions.items():
+        out_path = path + extension
+        if kind not in formats:
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            continue
+
+        temp_path = out_path + '.tmp'
+        with open(path, 'rb') as source, open(temp_path, 'wb') as out:
+            if kind == 'gzip':
+                with gzip.GzipFile(filename = '', mode = 'wb', fileobj = out, compresslevel = 9, mtime = 0) as compressed:
+                    shutil.copyfileobj(source, compressed)
+            else:
+                compressor = brotli.Compressor(mode = brotli.MODE_TEXT, quality = brotli_quality)
+                for chunk in iter(lambda: source.read(1 << 16), b''):
+                    out.write(compressor.process(chunk))
+                out.write(compressor.finish())
+        os.replace(temp_path, out_path)
+
+def remove_output(path:str) -> None:
+    # a file and any compressed copies of it
+    for name in [path] + [path + extension for extension in precompress_extensions.values()]:
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+# With --compact, pages are smaller to send and to parse:
+#  - people are named by their place in a table of the page's users, kept
+#    once as JSON at the end of the page, rather than in full in every
+#    message header and reaction. main.js puts the names back.
+#  - the templates' own whitespace is taken out as they're loaded, so the
+#    messages themselves are left as they are.
+#  - visualize writes minified copies of style.css, index.css and main.js
+#    next to the pages, which all of them share.
+class MinifyingLoader(jinja2.FileSystemLoader):
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return minify_markup(source), filename, uptodate
+
+# line breaks and indentation between tags and template statements
+markup_whitespace = re.compile(r'(>|%\}|\}\})\s*\n\s*(?=<|\{%|\{\{)')
+css_comment = re.compile(r'/\*.*?\*/', re.S)
+css_space = re.compile(r'\s*([{};,>])\s*')
+asset_files = ['style.css', 'index.css', 'main.js']
+
+def minify_markup(source:str) -> str:
+    return markup_whitespace.sub(r'\1', source).strip()
+
+compactEnv = jinja2.Environment(loader = MinifyingLoader(searchpath = template_dir))
+compact_template = compactEnv.get_template('channel.html')
+compact_index = compactEnv.get_template('index.html')
+
+def minify_asset(name:str) -> str:
+    with open(os.path.join(script_dir, name), 'r') as f:
+        text = f.read()
+    if name.endswith('.css'):
+        text = css_space.sub(r'\1', css_comment.sub('', text))
+        text = re.sub(r':\s+', ':', re.sub(r'\s+', ' ', text)).replace(';}', '}')
+    else:
+        # comments are only ever on lines of their own, and keeping the
+        # line breaks keeps the semicolons javascript inserts
+        lines = (line.strip() for line in text.splitlines())
+        text = '\n'.join(line for line in lines if line and not line.startswith('//'))
+    return text.strip()
+
+def write_assets(output_dir:str, precompress:list) -> None:
+    # pages opened from the repository use the originals
+    if os.path.realpath(output_dir) == script_dir:
+        return
+    for name in asset_files:
+        path = os.path.join(output_dir, name)
+        text = minify_asset(name)
+        try:
+            with open(path, 'r') as f:
+                if f.read() == text:
+                    continue
+        except FileNotFoundError:
+            pass
+        with atomic_write(path) as f:
+            f.write(text)
+        precompress_file(path, precompress)
+
+def compact_context(threads:list) -> dict:
+    # the page's users, most often named first so they get the shortest
+    # indexes, and what the templates need to refer to them
+    names = Counter()
+    for thread in threads:
+        for message in [thread['message']] + thread['replies']:
+            names[message.get('user')] += 1
+            for reaction in message.get('reactions') or []:
+                names.update(reaction['users'])
+    user_index = {name: i for i, (name, _) in enumerate(names.most_common())}
+    return {
+        'compact': True,
+        'user_index': user_index,
+        'user_refs': lambda users: ','.join(str(user_index[user]) for user in users),
+        # </script> in a name would end the table early
+        'users_json': json.dumps(list(user_index), ensure_ascii = False).replace('</', '<\\/')
+    }
+
+# visualize also writes a search index to search/ in the output directory.
+# Terms are sharded by their first two characters, so the browser only
+# fetches the shards for the words it's looking up, and each page gets a
+# file of message snippets to show with the results. Each channel's share
+# of the index is kept in search/channels/, so when only some channels
+# change, only those are tokenized again. The shards are still merged
+# from every channel's share each time, since postings number the files
+# across all channels, but only shards that come out different are
+# written.
+search_dir = 'search'
+tag_pattern = re.compile(r'<[^>]+>')
+term_pattern = re.compile(r'\w{2,}')
+shard_prefix = 2
+snippet_length = 120
+
+def write_search_file(output_dir:str, name:str, data, precompress:list) -> int:
+    # search files are scripts rather than JSON, so search works on pages
+    # opened straight from disk, where browsers won't fetch() files
+    path = os.path.join(output_dir, search_dir, name + '.js')
+    # keys are sorted so the same archive always gives the same bytes
+    text = f"searchFileLoaded({json.dumps(name)}, {json.dumps(data, separators = (',', ':'), sort_keys = True)});\n"
+    # and a file that comes out the same isn't written or compressed
+    # again, so deploys only see the shards whose terms changed
+    try:
+        with open(path, 'r') as f:
+            unchanged = f.read() == text
     except FileNotFoundError:
-        archive_logger.error(f'Input JSON file "{os.path.realpath(args.input)}" does not exist.')
-        sys.exit(5)
+        unchanged = False
+    if not unchanged or any(os.path.exists(path + extension) != (kind in precompress) for kind, extension in precompress_extensions.items()):
+        with atomic_write(path) as f:
+            f.write(text)
+        precompress_file(path, precompress)
+    return len(text.encode())
+
+def search_terms(text:str) -> set:
+    return set(term_pattern.findall(tag_pattern.sub(' ', text or '').lower()))
+
+def shard_name(term:str) -> str:
+    # anything but a-z and 0-9 is spelled out, to keep file names safe.
+    # main.js builds the same names.
+    return ''.join(
+        c if c.isascii() and c.isalnum() else f'_{ord(c):x}'
+        for c in term[:shard_prefix]
+    )
+
+def index_page(threads:list, output_dir:str, page_file:str, precompress:list) -> dict:
+    # terms from a thread's message and replies all point at the thread
+    terms = {}
+    docs = {}
+    for thread in threads:
+        ts = thread['message']['ts']
+        text = tag_pattern.sub(' ', thread['message'].get('text') or '')
+        docs[ts] = ' '.join(text.split())[:snippet_length]
+
+        thread_terms = search_terms(thread['message'].get('text'))
+        for reply in thread['replies']:
+            thread_terms |= search_terms(reply.get('text'))
+        for term in sorted(thread_terms):
+            terms.setdefault(term, []).append(ts)
+
+    write_search_file(output_dir, 'docs/' + page_file[:-len('.html')], docs, precompress)
+
+    return terms
+
+def write_search_index(output_dir:str, channels:list, precompress:list) -> tuple:
+    # merge the per channel indexes into shards. Postings are
+    # [file number, ts], with the files listed in meta.js.
+    files = []
+    shards = {}
+    for channel in channels:
+        with open(os.path.join(output_dir, search_dir, 'channels', f'{channel}.json'), 'r') as f:
+            channel_index = json.load(f)
+        offset = len(files)
+        files.extend([channel, name] for name in channel_index['files'])
+        for term, postings in channel_index['terms'].items():
+            shards.setdefault(shard_name(term), {}).setdefault(term, []).extend(
+                [offset + i, ts] for i, ts in postings
+            )
+
+    shard_dir = os.path.join(output_dir, search_dir, 'shards')
+    written = 0
+    for name, terms in shards.items():
+        written += write_search_file(output_dir, 'shards/' + name, terms, precompress)
+    for name in os.listdir(shard_dir):
+        # shard names have no dots, so this also finds compressed copies
+        if name.split('.', 1)[0] not in shards:
+            os.remove(os.path.join(shard_dir, name))
+
+    written += write_search_file(output_dir, 'meta', {'files': files, 'prefix': shard_prefix}, precompress)
+
+    return sum(len(terms) for terms in shards.values()), len(shards), written
+
+def render_page(workspace:str, channel:str, channels:list, threads:list, output_dir:str, page:dict, search:bool, precompress:list, compact:bool) -> tuple:
+    # runs in the worker processes, so it gets one page of messages as a
+    # list. The template is streamed to the file, so the rendered page is
+    # never held in memory as a whole.
+    start = time.perf_counter()
+    threads = [renderer.render_thread(thread) for thread in threads]
+
+    path = os.path.join(output_dir, page['file'])
+    with atomic_write(path) as f:
+        (compact_template if compact else template).stream(
+            workspace = workspace,
+            channel = channel,
+            channels = channels,
+            messages = threads,
+            **page,
+            **(compact_context(threads) if compact else {})
+        ).dump(f)
+    precompress_file(path, precompress)
 
-    # format for the JSON file is
+    terms = index_page(threads, output_dir, page['file'], precompress) if search else None
+
+    return channel, page['page'], time.perf_counter() - start, os.path.getsize(path), terms
+
+def visualize_data(args, changed:set = None):
+    # format for the archive is
     # { 'channel': 
     #   {'timestamp':
     #       {
@@ -381,32 +2101,393 @@ def visualize_data(args):
     #       }
     #   }
     # }
+    slack_data = load_store(os.path.realpath(args.input))
 
-    sorted_channels = list(slack_data.keys())
+    sorted_channels = slack_data.channels()
     sorted_channels.sort()
 
-    for channel, channel_data in slack_data.items():
-        output_text = template.render(
-            workspace = args.workspace,
-            channel = channel,
-            channels = sorted_channels,
-            messages = channel_data.values()
+    manifest = load_manifest(args.output)
+    if 'br' in args.precompress and brotli is None:
+        archive_logger.error('--precompress br needs the brotli package: pip install brotli')
+        sys.exit(1)
+    site_hash = templates_hash(args.workspace, sorted_channels, args.page_by, args.page_size, args.precompress, args.compact)
+    rebuild_all = args.force or manifest['templates'] != site_hash
+    new_manifest = {'templates': site_hash, 'channels': {}, 'pages': {}}
+
+    # channels are read twice: once to hash them and plan the pages, and
+    # once to render a page at a time. Only the pages in flight are held
+    # in memory, so with a database memory use depends on the page size.
+    users, custom_emoji = load_render_inputs(slack_data, args.user_cache, args.emoji_cache)
+    # channels with raw messages also depend on the names, emoji and rules
+    render_inputs_hash = hashlib.sha256(
+        json.dumps([transform_version, users, custom_emoji], sort_keys = True).encode()
+    ).hexdigest()
+    # and channels with files on which of them have been downloaded
+    file_links = FileLinks(os.path.realpath(args.files_dir), os.path.realpath(args.output))
+    files_hash = file_links.index_hash()
+    new_manifest['inputs'] = [render_inputs_hash, files_hash]
+    # the watcher passes the channels it's seen change since the last
+    # build. The others keep their old entries without being read at all.
+    reuse_manifest = changed is not None and not rebuild_all and manifest.get('inputs') == new_manifest['inputs']
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(
+            max_workers = args.jobs,
+            initializer = start_renderer,
+            initargs = (users, custom_emoji, file_links)
         )
+    else:
+        pool = None
+        start_renderer(users, custom_emoji, file_links)
+    start = time.perf_counter()
+    search = not args.no_search
+    if search:
+        for name in ('channels', 'docs', 'shards'):
+            os.makedirs(os.path.join(args.output, search_dir, name), exist_ok = True)
+
+    pending = []
+    results = []
+    for channel in slack_data.channels():
+        if reuse_manifest and channel not in changed and channel in manifest.get('pages', {}):
+            new_manifest['channels'][channel] = manifest['channels'][channel]
+            new_manifest['pages'][channel] = manifest['pages'][channel]
+            continue
+        with metrics.timer('plan'):
+            content_hash, pages, raw, has_files = plan_pages(slack_data.threads(channel), args.page_by, args.page_size)
+        if raw:
+            content_hash = hashlib.sha256((content_hash + render_inputs_hash).encode()).hexdigest()
+        if has_files:
+            content_hash = hashlib.sha256((content_hash + files_hash).encode()).hexdigest()
+        page_list = channel_pages(channel, pages)
+        files = [page['file'] for page in page_list]
+        new_manifest['channels'][channel] = content_hash
+        new_manifest['pages'][channel] = files
+        if (
+            not rebuild_all and
+            manifest['channels'].get(channel) == content_hash and
+            all(os.path.exists(os.path.join(args.output, name)) for name in files) and
+            (not search or os.path.exists(os.path.join(args.output, search_dir, 'channels', f'{channel}.json')))
+        ):
+            continue
+
+        threads = slack_data.threads(channel)
+        for page, (_, count, _) in zip(page_list, pages):
+            job = (
+                args.workspace, channel, sorted_channels, list(islice(threads, count)), args.output, page,
+                search, args.precompress, args.compact
+            )
+            if pool is not None:
+                # don't queue up more pages than the workers can take,
+                # or the whole archive ends up waiting in memory
+                if len(pending) >= 2 * args.jobs:
+                    results.append(pending.pop(0).result())
+                pending.append(pool.submit(render_page, *job))
+            else:
+                results.append(render_page(*job))
+
+        # pages left over from an earlier build with different page breaks
+        for name in set(manifest.get('pages', {}).get(channel, [])) - set(files):
+            for path in (name, os.path.join(search_dir, 'docs', name[:-len('.html')] + '.js')):
+                remove_output(os.path.join(args.output, path))
+
+    if pool is not None:
+        results.extend(future.result() for future in pending)
+        pool.shutdown()
+
+    channel_results = {}
+    channel_indexes = {}
+    for channel, page_number, seconds, written, terms in results:
+        totals = channel_results.setdefault(channel, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += written
+        if terms is not None:
+            channel_index = channel_indexes.setdefault(channel, {})
+            for term, timestamps in terms.items():
+                channel_index.setdefault(term, []).extend([page_number - 1, ts] for ts in timestamps)
+
+    for channel, (n_pages, seconds, written) in sorted(channel_results.items(), key = lambda r: -r[1][1]):
+        archive_logger.info(f'{channel}: {n_pages} pages, {seconds:.2f} seconds, {written} bytes')
+    # render times come back from the workers, so they're summed over them
+    metrics.add_time('render', sum(r[2] for r in results), len(results))
+    metrics.count('pages_rendered', len(results))
+    metrics.count('html_bytes', sum(r[3] for r in results))
+    archive_logger.info(
+        f'Rendered {len(channel_results)} of {len(sorted_channels)} channels ({len(results)} pages), '
+        f'{sum(r[3] for r in results)} bytes, in {time.perf_counter() - start:.2f} seconds.'
+    )
 
-        with open(os.path.join(args.output, f'{channel}.html'), 'w', encoding='utf-8') as f:
-            f.write(output_text)
-    
-    sorted_channels = list(slack_data.keys())
-    sorted_channels.sort()
+    if search:
+        start = time.perf_counter()
+        for channel, terms in channel_indexes.items():
+            with atomic_write(os.path.join(args.output, search_dir, 'channels', f'{channel}.json')) as f:
+                json.dump({'files': new_manifest['pages'][channel], 'terms': terms}, f, sort_keys = True)
+        for name in os.listdir(os.path.join(args.output, search_dir, 'channels')):
+            if name[:-len('.json')] not in new_manifest['pages']:
+                os.remove(os.path.join(args.output, search_dir, 'channels', name))
+
+        n_terms, n_shards, written = write_search_index(args.output, sorted_channels, args.precompress)
+        seconds = time.perf_counter() - start
+        metrics.add_time('search_index', seconds)
+        metrics.count('search_index_bytes', written)
+        archive_logger.info(
+            f'Search index: {n_terms} terms in {n_shards} shards, {written} bytes, '
+            f'in {seconds:.2f} seconds.'
+        )
 
-    index_text = index.render(
-        workspace = args.workspace,
-        channels = sorted_channels
+    with metrics.timer('render'):
+        if args.compact:
+            write_assets(args.output, args.precompress)
+        with atomic_write(os.path.join(args.output, 'index.html')) as f:
+            (compact_index if args.compact else index).stream(
+                workspace = args.workspace,
+                channels = sorted_channels
+            ).dump(f)
+        precompress_file(os.path.join(args.output, 'index.html'), args.precompress)
+
+    with atomic_write(os.path.join(args.output, manifest_name)) as f:
+        json.dump(new_manifest, f)
+
+# Export ----------------------------------------------------------------------
+
+def export_data(args):
+    store = load_store(os.path.realpath(args.input))
+    store.save(args.output)
+    store.close()
+    archive_logger.info(f'Exported {args.input} to {args.output}.')
+
+# Serve -----------------------------------------------------------------------
+
+# serve renders pages from the archive when they're asked for, rather than
+# writing them all out first. A JSON archive is read once; a SQLite one is
+# only queried for the channels people look at. Pages are planned a
+# channel at a time the first time one of its pages is asked for, with
+# the same page breaks as visualize, and rendered pages are kept in a
+# least recently used cache of --cache-mb, gzipped alongside. The archive
+# and the caches it's rendered with are checked before each request, and
+# when any of them changes it's opened again and the cache emptied, so a
+# scraper or watcher can keep writing to it while it's served.
+#
+# The store and renderer are only used from one worker thread: SQLite
+# connections belong to the thread that made them, and rendering would
+# hold up the event loop.
+static_files = {
+    'style.css': 'text/css',
+    'index.css': 'text/css',
+    'main.js': 'application/javascript'
+}
+serve_gzip_level = 6
+
+class PageServer(object):
+    def __init__(self, args) -> None:
+        self.args = args
+        self.input = os.path.realpath(args.input)
+        self.files_dir = os.path.realpath(args.files_dir)
+        self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'render')
+        self.lock = asyncio.Lock()
+        self.store = None
+        self.version = None
+        self.max_bytes = int(args.cache_mb * 2 ** 20)
+        # name -> (body, gzipped body, etag), least recently used first
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        # name -> future, so a page asked for by several clients at once
+        # is only rendered once
+        self.rendering = {}
+        self.assets = {name: minify_asset(name).encode() for name in static_files} if args.compact else {}
+
+    def archive_version(self) -> tuple:
+        # everything the pages are rendered from. Commits to a SQLite
+        # archive go to its write-ahead log, and only reach the database
+        # itself when the log is checkpointed.
+        paths = [
+            self.input, self.input + '-wal', self.args.user_cache, self.args.emoji_cache,
+            os.path.join(self.files_dir, 'index.json')
+        ]
+        version = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def load(self) -> None:
+        # runs in the worker thread
+        if self.store is not None:
+            self.store.close()
+        with metrics.timer('load'):
+            self.store = load_store(self.input)
+        self.channels = sorted(self.store.channels())
+        users, custom_emoji = load_render_inputs(self.store, self.args.user_cache, self.args.emoji_cache)
+        # downloaded files are served from files_dir, so links are relative to it
+        start_renderer(users, custom_emoji, FileLinks(self.files_dir, self.files_dir))
+        # channel -> {page file: (index into the channel's threads, page)}
+        self.plans = {}
+        archive_logger.info(f'Loaded {self.input}: {len(self.channels)} channels.')
+
+    async def check_archive(self) -> None:
+        version = self.archive_version()
+        if version == self.version:
+            return
+        async with self.lock:
+            if version == self.version:
+                return
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+            self.version = version
+            self.cache.clear()
+            self.cache_bytes = 0
+            metrics.count('archive_loads')
+
+    def plan(self, channel:str) -> dict:
+        # runs in the worker thread
+        if channel not in self.plans:
+            with metrics.timer('plan'):
+                _, pages, _, _ = plan_pages(self.store.threads(channel), self.args.page_by, self.args.page_size)
+            plan = {}
+            start = 0
+            for page, (_, count, _) in zip(channel_pages(channel, pages), pages):
+                plan[page['file']] = (start, count, page)
+                start += count
+            self.plans[channel] = plan
+        return self.plans[channel]
+
+    def page_channel(self, name:str) -> str:
+        # the channel a page belongs to: general.html, general.2021-03.html
+        if name == 'index.html':
+            return None
+        channel = name[:-len('.html')]
+        while channel not in self.channels:
+            if '.' not in channel:
+                raise KeyError(name)
+            channel = channel.rsplit('.', 1)[0]
+        return channel
+
+    def render(self, name:str) -> bytes:
+        # runs in the worker thread. KeyError if there's no such page.
+        start = time.perf_counter()
+        channel = self.page_channel(name)
+        compact = self.args.compact
+        if channel is None:
+            html = (compact_index if compact else index).render(workspace = self.args.workspace, channels = self.channels)
+        else:
+            first, count, page = self.plan(channel)[name]
+            threads = [renderer.render_thread(thread) for thread in self.store.threads(channel, first, count)]
+            html = (compact_template if compact else template).render(
+                workspace = self.args.workspace,
+                channel = channel,
+                channels = self.channels,
+                messages = threads,
+                **page,
+                **(compact_context(threads) if compact else {})
+            )
+        metrics.add_time('render', time.perf_counter() - start)
+        metrics.count('pages_rendered')
+        return html.encode()
+
+    def cache_page(self, name:str, body:bytes) -> tuple:
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        entry = (body, gzip.compress(body, serve_gzip_level), etag)
+        size = len(entry[0]) + len(entry[1])
+        if size <= self.max_bytes:
+            self.cache[name] = entry
+            self.cache_bytes += size
+            while self.cache_bytes > self.max_bytes:
+                _, (old_body, old_gzipped, _) = self.cache.popitem(last = False)
+                self.cache_bytes -= len(old_body) + len(old_gzipped)
+                metrics.count('cache_evictions')
+        return entry
+
+    async def page(self, name:str) -> tuple:
+        await self.check_archive()
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            metrics.count('cache_hits')
+            return self.cache[name]
+        if name not in self.rendering:
+            version = self.version
+            self.rendering[name] = asyncio.get_running_loop().run_in_executor(self.executor, self.render, name)
+            try:
+                body = await self.rendering[name]
+            finally:
+                del self.rendering[name]
+            metrics.count('cache_misses')
+            if version != self.version:
+                # the archive changed while it was rendering
+                return await self.page(name)
+            return self.cache_page(name, body)
+        await asyncio.shield(self.rendering[name])
+        return await self.page(name)
+
+    async def handle_page(self, request):
+        name = request.match_info.get('name') or 'index.html'
+        try:
+            body, gzipped, etag = await self.page(name)
+        except KeyError:
+            raise aiohttp.web.HTTPNotFound()
+
+        gzip_ok = 'gzip' in request.headers.get('Accept-Encoding', '')
+        if gzip_ok:
+            # the compressed and plain bodies are different representations
+            etag = etag[:-1] + '-gzip"'
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if etag in request.headers.get('If-None-Match', ''):
+            metrics.count('not_modified')
+            return aiohttp.web.Response(status = 304, headers = headers)
+        if gzip_ok:
+            headers['Content-Encoding'] = 'gzip'
+            body = gzipped
+        return aiohttp.web.Response(body = body, content_type = 'text/html', charset = 'utf-8', headers = headers)
+
+    async def handle_static(self, request):
+        name = request.match_info['name']
+        if self.args.compact:
+            return aiohttp.web.Response(body = self.assets[name], headers = {'Content-Type': static_files[name]})
+        return aiohttp.web.FileResponse(os.path.join(script_dir, name), headers = {'Content-Type': static_files[name]})
+
+    def app(self):
+        app = aiohttp.web.Application()
+        for name in static_files:
+            app.router.add_get('/{name:' + re.escape(name) + '}', self.handle_static)
+        app.router.add_get('/', self.handle_page)
+        app.router.add_get(r'/{name:[^/]+\.html}', self.handle_page)
+        # downloaded files and their thumbnails
+        for name in (objects_dir, thumbnail_dir):
+            os.makedirs(os.path.join(self.files_dir, name), exist_ok = True)
+            app.router.add_static(f'/{name}', os.path.join(self.files_dir, name))
+        if self.args.search_from is not None:
+            app.router.add_static(f'/{search_dir}', os.path.join(self.args.search_from, search_dir))
+        return app
+
+def serve_archive(args):
+    if not os.path.exists(args.input):
+        archive_logger.error(f'Input file "{args.input}" does not exist.')
+        sys.exit(5)
+    if args.search_from is not None and not os.path.isdir(os.path.join(args.search_from, search_dir)):
+        archive_logger.error(f'No search index in {args.search_from}. Run visualize there first.')
+        sys.exit(1)
+
+    server = PageServer(args)
+    app = server.app()
+
+    async def start(app) -> None:
+        await server.check_archive()
+
+    async def stop(app) -> None:
+        if server.store is not None:
+            await asyncio.get_running_loop().run_in_executor(server.executor, server.store.close)
+        server.executor.shutdown()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    aiohttp.web.run_app(
+        app,
+        host = args.host,
+        port = args.port,
+        access_log = archive_logger if args.access_log else None,
+        print = lambda text: archive_logger.info(text.strip())
     )
 
-    with open(os.path.join(args.output, 'index.html'), 'w') as f:
-        f.write(index_text)
-
 # Argparse --------------------------------------------------------------------
 
 parser = argparse.ArgumentParser(
@@ -437,8 +2518,117 @@ vxg.add_argument(
     const = 'd'
 )
 
+parser.add_argument(
+    '--metrics',
+    help = 'Write timings, API calls and counts for the run to this JSON file'
+)
+parser.add_argument(
+    '--metrics-prometheus',
+    help = 'Write the same metrics in Prometheus textfile format, e.g. for node_exporter\'s textfile collector. Use a name ending in .prom'
+)
+
 subparsers = parser.add_subparsers()
 
+def add_scrape_arguments(subparser:argparse.ArgumentParser) -> None:
+    # the options scrape and watch share
+    subparser.add_argument(
+        '-t',
+        '--token',
+        help = 'Slack bot token. Should start with "xoxb". If not provided, will be pulled from $SLACK_TOKEN'
+    )
+    subparser.add_argument(
+        '-i',
+        '--input',
+        help = 'Input JSON data file, or SQLite database (.db, .sqlite). Default is slack_data.json in current directory',
+        default = 'slack_data.json'
+    )
+    subparser.add_argument(
+        '-o',
+        '--output',
+        help = 'Output JSON file or SQLite database. Default is the input file'
+    )
+    subparser.add_argument(
+        '--state',
+        help = 'State file recording the newest message per channel, for --incremental and watch. Default is slack_state.json in current directory',
+        default = 'slack_state.json'
+    )
+    subparser.add_argument(
+        '--rescan-days',
+        type = float,
+        help = 'With --incremental, or when watching, also re-fetch the last N days so late replies and edits are picked up. Default 0',
+        default = 0
+    )
+    subparser.add_argument(
+        '--max-retries',
+        type = int,
+        help = 'How many times to retry a failed Slack request before giving up. Default 5',
+        default = 5
+    )
+    subparser.add_argument(
+        '--emoji-cache',
+        help = 'File to cache the workspace\'s custom emoji in. Default is slack_emoji.json in current directory',
+        default = 'slack_emoji.json'
+    )
+    subparser.add_argument(
+        '--raw',
+        action = 'store_true',
+        help = 'Store messages as Slack sends them and transform them when visualizing, so changes to the transformations don\'t need a new scrape'
+    )
+    subparser.add_argument(
+        '--user-cache',
+        help = 'File to cache the workspace\'s user list in. It\'s downloaded again once a day. Default is slack_users.json in current directory',
+        default = 'slack_users.json'
+    )
+    subparser.add_argument(
+        '--channel-cache',
+        help = 'File to cache the list of channels in. It\'s listed again once it\'s an hour old, or when a channel given to --select-channels isn\'t in it. Default is slack_channels.json in current directory',
+        default = 'slack_channels.json'
+    )
+    subparser.add_argument(
+        '--channel-types',
+        nargs = '+',
+        choices = channel_types,
+        help = 'Kinds of conversation to archive. Default all of them; DMs (im, mpim) need the im:read and mpim:read scopes and are skipped without them',
+        default = channel_types
+    )
+    subparser.add_argument(
+        '--include-archived',
+        action = 'store_true',
+        help = 'Also archive channels that have been archived in Slack'
+    )
+    subparser.add_argument(
+        '--download-files',
+        action = 'store_true',
+        help = 'Also download the files shared in messages, including ones in messages already archived. Needs the files:read scope'
+    )
+    subparser.add_argument(
+        '--files-dir',
+        help = 'Directory to keep downloaded files in. Each file is stored once, however many times it was shared. Default is slack_files in current directory',
+        default = 'slack_files'
+    )
+    subparser.add_argument(
+        '--files-concurrency',
+        type = int,
+        help = 'Number of files to download at once. Default 4',
+        default = 4
+    )
+    subparser.add_argument(
+        '--files-max-bytes',
+        type = parse_size,
+        help = 'Download at most this much per run, e.g. 500M or 2G. Files left over are downloaded on later runs. Default no limit'
+    )
+    channels = subparser.add_mutually_exclusive_group(required = True)
+    channels.add_argument(
+        '--archive-all',
+        action = 'store_true',
+        help = 'Archive all channels for which the bot is a member'
+    )
+    channels.add_argument(
+        '--select-channels',
+        nargs = '+',
+        help = 'Space-separated list of channels, by name or ID. DMs go by the name they\'re archived under, e.g. dm-jane-doe'
+    )
+
 # Scrape parser -------------------------------------------------------------
 
 scrape = subparsers.add_parser(
@@ -446,34 +2636,92 @@ scrape = subparsers.add_parser(
     help = 'Scrape the Slack workspace'
 )
 scrape.set_defaults(func = scrape_session)
+add_scrape_arguments(scrape)
 scrape.add_argument(
-    '-t',
-    '--token',
-    help = 'Slack bot token. Should start with "xoxb". If not provided, will be pulled from $SLACK_TOKEN'
+    '--incremental',
+    action = 'store_true',
+    help = 'Only fetch messages newer than the last scrape of each channel'
 )
 scrape.add_argument(
-    '-i',
-    '--input',
-    help = 'Input JSON data file. Default is slack_data.json in current directory',
-    default = 'slack_data.json'
+    '--concurrency',
+    type = int,
+    help = 'Number of Slack requests to have in flight at once. Above 1, channels and threads are scraped concurrently. Default 1',
+    default = 1
 )
 scrape.add_argument(
-    '-o',
-    '--output',
-    help = 'Output JSON file. Default is slack_data.json in current directory',
-    default = 'slack_data.json'
+    '--checkpoint',
+    help = 'Checkpoint file for resuming interrupted scrapes. Default is slack_checkpoint.json in current directory',
+    default = 'slack_checkpoint.json'
 )
-
-channels = scrape.add_mutually_exclusive_group(required = True)
-channels.add_argument(
-    '--archive-all',
+scrape.add_argument(
+    '--checkpoint-seconds',
+    type = float,
+    help = 'Save the archive and a checkpoint at most this many seconds apart. 0 to turn off. Default 300',
+    default = 300
+)
+scrape.add_argument(
+    '--checkpoint-messages',
+    type = int,
+    help = 'Also save a checkpoint every this many messages.'
+)
+scrape.add_argument(
+    '--resume',
     action = 'store_true',
-    help = 'Archive all channels for which the bot is a member'
+    help = 'Continue an interrupted scrape from its checkpoint'
 )
-channels.add_argument(
-    '--select-channels',
-    nargs = '+',
-    help = 'Space-separated list of channel names'
+
+# Watch parser ----------------------------------------------------------------
+
+watch = subparsers.add_parser(
+    'watch',
+    help = 'Keep running, polling each channel more often the busier it is'
+)
+watch.set_defaults(func = watch_session)
+add_scrape_arguments(watch)
+watch.add_argument(
+    '--budget',
+    type = float,
+    help = 'Slack calls per minute to spend on polling, across all channels. Default 30',
+    default = 30
+)
+watch.add_argument(
+    '--activity-factor',
+    type = float,
+    help = 'Poll a channel again after this fraction of the time since its newest message. Default 0.1, so a channel last active 10 hours ago is polled hourly',
+    default = 0.1
+)
+watch.add_argument(
+    '--min-interval',
+    type = float,
+    help = 'Seconds between polls of even the busiest channel. Default 60',
+    default = 60
+)
+watch.add_argument(
+    '--max-interval',
+    type = float,
+    help = 'Seconds between polls of even the quietest channel. Default 21600 (6 hours)',
+    default = 6 * 3600
+)
+watch.add_argument(
+    '--save-seconds',
+    type = float,
+    help = 'Save the archive and state file at most this many seconds apart, if anything changed. Default 300',
+    default = 300
+)
+watch.add_argument(
+    '--refresh-seconds',
+    type = float,
+    help = 'Look for new channels, and refresh the user list and custom emoji, this many seconds apart. Default 3600',
+    default = 3600
+)
+watch.add_argument(
+    '--visualize',
+    metavar = 'DIR',
+    help = 'After each save, update the HTML in this directory for the channels that changed'
+)
+watch.add_argument(
+    '--workspace',
+    help = 'Name of the workspace, for the HTML titles with --visualize'
 )
 
 # Visualization parser ---------------------------------------------------------
@@ -485,7 +2733,7 @@ visualize = subparsers.add_parser(
 visualize.set_defaults(func = visualize_data)
 visualize.add_argument(
     'input',
-    help = 'Input JSON data file.'
+    help = 'Input JSON data file or SQLite database.'
 )
 visualize.add_argument (
     'workspace',
@@ -497,9 +2745,158 @@ visualize.add_argument(
     help = 'Output directory for HTML files. Default is current directory.',
     default = os.getcwd()
 )
+visualize.add_argument(
+    '-j',
+    '--jobs',
+    type = int,
+    help = 'Number of processes to render channels with. Default 1',
+    default = 1
+)
+visualize.add_argument(
+    '--force',
+    action = 'store_true',
+    help = 'Render every channel, even ones that haven\'t changed since the last run'
+)
+visualize.add_argument(
+    '--page-by',
+    choices = ['none', 'month', 'size'],
+    help = 'Split channels into a page per month, or pages of --page-size threads. Default none, one page per channel',
+    default = 'none'
+)
+visualize.add_argument(
+    '--page-size',
+    type = int,
+    help = 'Threads per page with --page-by size. Default 500',
+    default = 500
+)
+visualize.add_argument(
+    '--user-cache',
+    help = 'The scraper\'s user cache, for names in archives scraped with --raw. Default is slack_users.json in current directory',
+    default = 'slack_users.json'
+)
+visualize.add_argument(
+    '--files-dir',
+    help = 'Where the scraper downloaded files to, with --download-files. Pages link to the copies there. Default is slack_files in current directory',
+    default = 'slack_files'
+)
+visualize.add_argument(
+    '--emoji-cache',
+    help = 'The scraper\'s custom emoji cache, for archives scraped with --raw. Default is slack_emoji.json in current directory',
+    default = 'slack_emoji.json'
+)
+visualize.add_argument(
+    '--no-search',
+    action = 'store_true',
+    help = 'Don\'t build the search index'
+)
+visualize.add_argument(
+    '--compact',
+    action = 'store_true',
+    help = 'Write smaller pages: users in one table per page instead of names repeated in every message, no template whitespace, and minified CSS and JavaScript next to the pages'
+)
+visualize.add_argument(
+    '--precompress',
+    nargs = '+',
+    choices = list(precompress_extensions),
+    help = 'Also write compressed copies of the pages and search files (.gz, .br) for web servers to send as they are. br needs the brotli package',
+    default = []
+)
+
+# Export parser ----------------------------------------------------------------
+
+export = subparsers.add_parser(
+    'export',
+    help = 'Convert an archive between the JSON and SQLite formats'
+)
+export.set_defaults(func = export_data)
+export.add_argument(
+    'input',
+    help = 'Input JSON data file or SQLite database.'
+)
+export.add_argument(
+    'output',
+    help = 'Output file. Ending in .db, .sqlite or .sqlite3 makes a SQLite database, anything else JSON.'
+)
+
+# Serve parser -----------------------------------------------------------------
+
+serve = subparsers.add_parser(
+    'serve',
+    help = 'Serve the archive as HTML, rendering pages as they\'re asked for'
+)
+serve.set_defaults(func = serve_archive)
+serve.add_argument(
+    'input',
+    help = 'Input JSON data file or SQLite database.'
+)
+serve.add_argument(
+    'workspace',
+    help = 'Name of the workspace. For HTML titles'
+)
+serve.add_argument(
+    '--host',
+    help = 'Address to listen on. Default 127.0.0.1, only this machine',
+    default = '127.0.0.1'
+)
+serve.add_argument(
+    '--port',
+    type = int,
+    help = 'Port to listen on. Default 8000',
+    default = 8000
+)
+serve.add_argument(
+    '--cache-mb',
+    type = float,
+    help = 'Memory for rendered pages, in megabytes. The least recently used are dropped first. Default 64',
+    default = 64
+)
+serve.add_argument(
+    '--page-by',
+    choices = ['none', 'month', 'size'],
+    help = 'Split channels into a page per month, or pages of --page-size threads. Default none, one page per channel',
+    default = 'none'
+)
+serve.add_argument(
+    '--page-size',
+    type = int,
+    help = 'Threads per page with --page-by size. Default 500',
+    default = 500
+)
+serve.add_argument(
+    '--user-cache',
+    help = 'The scraper\'s user cache, for names in archives scraped with --raw. Default is slack_users.json in current directory',
+    default = 'slack_users.json'
+)
+serve.add_argument(
+    '--emoji-cache',
+    help = 'The scraper\'s custom emoji cache, for archives scraped with --raw. Default is slack_emoji.json in current directory',
+    default = 'slack_emoji.json'
+)
+serve.add_argument(
+    '--files-dir',
+    help = 'Where the scraper downloaded files to, with --download-files. They\'re served from there. Default is slack_files in current directory',
+    default = 'slack_files'
+)
+serve.add_argument(
+    '--search-from',
+    help = 'Output directory of visualize to serve the search index from. Give visualize the same --page-by. Without it the search box finds nothing'
+)
+serve.add_argument(
+    '--compact',
+    action = 'store_true',
+    help = 'Serve smaller pages, like visualize --compact'
+)
+serve.add_argument(
+    '--access-log',
+    action = 'store_true',
+    help = 'Log every request'
+)
 
 def make_logger(level):
-    archive_logger = logging.getLogger(__name__)
+    # named, rather than __name__, so the other modules can log to it too
+    archive_logger = logging.getLogger('archiver')
+    if archive_logger.handlers:
+        return archive_logger
     logging_handler = logging.StreamHandler()
     logging_file_handler = logging.FileHandler('archive.log')
     logging_formatter = logging.Formatter('%(levelname)s: %(message)s')
@@ -530,3 +2927,10 @@ if __name__ == '__main__':
     archive_logger.setLevel(level)
 
     args.func(args)
+
+    command = args.func.__name__.split('_')[0]
+    archive_logger.info(f'Time by phase: {metrics.describe()}')
+    if args.metrics:
+        metrics.write_json(args.metrics, command)
+    if args.metrics_prometheus:
+        metrics.write_prometheus(args.metrics_prometheus, command)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Load and save times of a JSON archive, plain and compressed. A synthetic
+# workspace from workspace.py is turned into an archive, which is saved
+# and loaded again as .json, .json.gz and, if zstandard is installed,
+# .json.zst. Reports the best time of --repeat runs and the file sizes.
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+benchmark_dir = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, os.path.split(benchmark_dir)[0])
+from workspace import make_workspace, count_messages, add_workspace_arguments
+from storage import JSONStore, open_store, zstandard
+
+def make_archive(workspace:dict) -> JSONStore:
+    # the workspace as the scraper would have stored it with --raw
+    data = {}
+    for channel in workspace['channels']:
+        threads = data[channel['name']] = {}
+        for message in workspace['history'][channel['id']]:
+            thread = workspace['replies'].get((channel['id'], message['ts']), [message])
+            threads[message['ts']] = {'message': message, 'replies': thread[1:]}
+    return JSONStore(data)
+
+def best_time(repeat:int, function, *args) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main(args):
+    workspace = make_workspace(args)
+    n_messages = count_messages(workspace)
+    store = make_archive(workspace)
+    print(f"{len(workspace['channels'])} channels, {n_messages} messages")
+
+    extensions = ['.json', '.json.gz']
+    if zstandard is not None:
+        extensions.append('.json.zst')
+    else:
+        print('zstandard is not installed; skipping .json.zst')
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'archiver-io-benchmark-')
+    results = []
+    for extension in extensions:
+        path = os.path.join(work_dir, 'archive' + extension)
+        save_seconds = best_time(args.repeat, store.save, path)
+        load_seconds = best_time(args.repeat, open_store, path)
+        results.append({
+            'format': extension,
+            'bytes': os.path.getsize(path),
+            'save_seconds': save_seconds,
+            'load_seconds': load_seconds
+        })
+
+    plain = results[0]
+    print(f"{'format':<11}{'size':>12}{'ratio':>8}{'save':>10}{'load':>10}")
+    for result in results:
+        print(
+            f"{result['format']:<11}{result['bytes'] / 2 ** 20:>9.1f} MB{plain['bytes'] / result['bytes']:>7.1f}x"
+            f"{result['save_seconds']:>9.2f}s{result['load_seconds']:>9.2f}s"
+        )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'workspace': vars(args), 'messages': n_messages, 'results': results}, f, indent = 2)
+
+    if args.work_dir is None:
+        for result in results:
+            os.remove(os.path.join(work_dir, 'archive' + result['format']))
+        os.rmdir(work_dir)
+
+parser = argparse.ArgumentParser(
+    description = 'Benchmark saving and loading a JSON archive, plain and compressed'
+)
+parser.add_argument(
+    '--repeat',
+    type = int,
+    help = 'Times to save and load each format. The best time is reported. Default 3',
+    default = 3
+)
+parser.add_argument(
+    '--work-dir',
+    help = 'Directory to keep the archives in. Default is a temporary directory, removed afterwards'
+)
+parser.add_argument(
+    '--json',
+    help = 'Also write the results to this JSON file, to compare runs'
+)
+add_workspace_arguments(parser)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
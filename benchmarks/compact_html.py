@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Size and parse time of visualize's pages, as they are and with
+# --compact. A synthetic workspace from workspace.py is saved as a raw
+# archive and visualized both ways, and for each the report gives the
+# bytes of all the pages and shared CSS and JavaScript, plain and gzipped,
+# and how long they take to parse with Python's html.parser. That only
+# tokenizes them, so with --browser (which needs playwright and its
+# chromium: pip install playwright && playwright install chromium) each
+# page is also opened in a headless browser and timed from the end of the
+# response to DOMContentLoaded, which takes in building the DOM and
+# running main.js.
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+from html.parser import HTMLParser
+
+benchmark_dir = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, os.path.split(benchmark_dir)[0])
+from workspace import make_workspace, count_messages, add_workspace_arguments
+from archive_io import make_archive
+
+try:
+    from playwright.sync_api import sync_playwright
+except ImportError:
+    sync_playwright = None
+
+modes = {'current': [], 'compact': ['--compact']}
+
+class TagCounter(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.tags = 0
+
+    def handle_starttag(self, tag, attrs) -> None:
+        self.tags += 1
+
+def visualize(args, archive:str, user_cache:str, output_dir:str, options:list) -> None:
+    import archiver
+
+    archiver.archive_logger.setLevel(logging.WARNING)
+    visualize_args = archiver.parser.parse_args([
+        'visualize', archive, 'Benchmark',
+        '--output', output_dir,
+        '--page-by', args.page_by,
+        '--page-size', str(args.page_size),
+        '--user-cache', user_cache,
+        '--no-search',
+        '--force'
+    ] + options)
+    visualize_args.func(visualize_args)
+
+def parse_seconds(paths:list, repeat:int) -> tuple:
+    # best of repeat, and the number of elements
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tags = 0
+        for path in paths:
+            parser = TagCounter()
+            with open(path, 'r') as f:
+                parser.feed(f.read())
+            parser.close()
+            tags += parser.tags
+        times.append(time.perf_counter() - start)
+    return min(times), tags
+
+def browser_ms(paths:list, repeat:int) -> float:
+    # median over the pages of each page's best time
+    timing = '''() => {
+        const [entry] = performance.getEntriesByType('navigation');
+        return entry.domContentLoadedEventEnd - entry.responseEnd;
+    }'''
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch()
+        page = browser.new_page()
+        times = []
+        for path in paths:
+            best = None
+            for _ in range(repeat):
+                page.goto('file://' + os.path.realpath(path), wait_until = 'domcontentloaded')
+                ms = page.evaluate(timing)
+                best = ms if best is None else min(best, ms)
+            times.append(best)
+        browser.close()
+    return statistics.median(times)
+
+def measure(args, output_dir:str) -> dict:
+    pages = sorted(
+        os.path.join(output_dir, name) for name in os.listdir(output_dir)
+        if name.endswith('.html') and name != 'index.html'
+    )
+    assets = [os.path.join(output_dir, name) for name in ('style.css', 'index.css', 'main.js')]
+    page_bytes = [os.path.getsize(path) for path in pages]
+    gzip_bytes = 0
+    for path in pages + assets:
+        with open(path, 'rb') as f:
+            gzip_bytes += len(gzip.compress(f.read(), 6))
+    seconds, tags = parse_seconds(pages, args.repeat)
+    result = {
+        'pages': len(pages),
+        'page_bytes': sum(page_bytes),
+        'largest_page_bytes': max(page_bytes),
+        'asset_bytes': sum(os.path.getsize(path) for path in assets),
+        'gzip_bytes': gzip_bytes,
+        'elements': tags,
+        'parse_seconds': seconds
+    }
+    if args.browser:
+        result['browser_ms'] = browser_ms(pages, args.repeat)
+    return result
+
+def main(args):
+    if args.browser and sync_playwright is None:
+        print('--browser needs playwright: pip install playwright && playwright install chromium')
+        sys.exit(1)
+
+    workspace = make_workspace(args)
+    print(f"{len(workspace['channels'])} channels, {count_messages(workspace)} messages")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'archiver-compact-benchmark-')
+    os.makedirs(work_dir, exist_ok = True)
+    archive = os.path.join(work_dir, 'archive.json')
+    make_archive(workspace).save(archive)
+    user_cache = os.path.join(work_dir, 'slack_users.json')
+    with open(user_cache, 'w') as f:
+        json.dump({'users': {user['id']: user['profile']['real_name'] for user in workspace['users']}}, f)
+
+    results = {}
+    for mode, options in modes.items():
+        output_dir = os.path.join(work_dir, mode)
+        os.makedirs(output_dir, exist_ok = True)
+        visualize(args, archive, user_cache, output_dir, options)
+        if mode == 'current':
+            # the pages link to the originals, which visualize leaves to you
+            for name in ('style.css', 'index.css', 'main.js'):
+                shutil.copy(os.path.join(os.path.split(benchmark_dir)[0], name), output_dir)
+        results[mode] = measure(args, output_dir)
+
+    current = results['current']
+    header = f"{'output':<9}{'pages':>7}{'page MB':>10}{'assets':>9}{'gzip MB':>10}{'elements':>10}{'parse':>9}"
+    print(header + (f"{'browser':>10}" if args.browser else ''))
+    for mode, result in results.items():
+        line = (
+            f"{mode:<9}{result['pages']:>7}{result['page_bytes'] / 2 ** 20:>10.2f}{result['asset_bytes']:>9}"
+            f"{result['gzip_bytes'] / 2 ** 20:>10.2f}{result['elements']:>10}{result['parse_seconds']:>8.2f}s"
+        )
+        if args.browser:
+            line += f"{result['browser_ms']:>8.1f}ms"
+        print(line)
+    compact = results['compact']
+    print(
+        f"compact is {1 - compact['page_bytes'] / current['page_bytes']:.0%} smaller, "
+        f"{1 - compact['gzip_bytes'] / current['gzip_bytes']:.0%} gzipped, and parses in "
+        f"{compact['parse_seconds'] / current['parse_seconds']:.0%} of the time"
+    )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'workspace': vars(args), 'results': results}, f, indent = 2)
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir)
+
+parser = argparse.ArgumentParser(
+    description = 'Compare the size and parse time of visualize\'s pages with and without --compact'
+)
+parser.add_argument(
+    '--page-by',
+    choices = ['none', 'month', 'size'],
+    help = 'visualize\'s --page-by. Default size',
+    default = 'size'
+)
+parser.add_argument(
+    '--page-size',
+    type = int,
+    help = 'visualize\'s --page-size. Default 500',
+    default = 500
+)
+parser.add_argument(
+    '--repeat',
+    type = int,
+    help = 'Times to parse the pages. The best time is reported. Default 3',
+    default = 3
+)
+parser.add_argument(
+    '--browser',
+    action = 'store_true',
+    help = 'Also time each page in headless chromium. Needs playwright'
+)
+parser.add_argument(
+    '--work-dir',
+    help = 'Directory for the archive and HTML. Default is a temporary directory, removed afterwards'
+)
+parser.add_argument(
+    '--json',
+    help = 'Also write the results to this JSON file, to compare runs'
+)
+add_workspace_arguments(parser)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
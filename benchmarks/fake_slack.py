@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# A local stand-in for the parts of the Slack Web API the archiver uses,
+# serving a workspace from workspace.py. Point a client at it with
+# WebClient(token, base_url = server.url). Every response can be delayed
+# by `latency` seconds, and a `rate_limit_ratio` fraction of requests get
+# a 429 with Retry-After: `retry_after`, like Slack's rate limiting.
+# Requests and 429s are counted per method. The workspace's files are
+# served too, as random bytes of the right size, to requests with a token;
+# without one, like Slack, the response is a login page.
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from workspace import make_workspace, add_workspace_arguments
+
+default_limits = {
+    'conversations.history': 100,
+    'conversations.list': 100,
+    'conversations.replies': 100,
+    'users.list': 100
+}
+
+def channel_type(channel:dict) -> str:
+    if channel.get('is_im'):
+        return 'im'
+    if channel.get('is_mpim'):
+        return 'mpim'
+    return 'private_channel' if channel.get('is_private') else 'public_channel'
+
+def page(items:list, cursor:str, limit:int, key:str) -> dict:
+    # cursors are just offsets into the list
+    start = int(cursor or 0)
+    chunk = items[start:start + limit]
+    more = start + limit < len(items)
+    return {
+        'ok': True,
+        key: chunk,
+        'has_more': more,
+        'response_metadata': {'next_cursor': str(start + limit) if more else ''}
+    }
+
+class FakeSlack(object):
+    def __init__(self, workspace:dict, latency:float = 0, rate_limit_ratio:float = 0, retry_after:int = 1, seed:int = 0) -> None:
+        self.workspace = workspace
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.users = {user['id']: user for user in workspace['users']}
+        # history is served newest first, like slack
+        self.history = {
+            channel: list(reversed(messages))
+            for channel, messages in workspace['history'].items()
+        }
+        self.reset()
+
+        handler = type('Handler', (FakeSlackHandler,), {'slack': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.root = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.url = self.root + 'api/'
+        self.thread = None
+
+        self.files = {}
+        for f in workspace.get('files', []):
+            for key in ('url_private', 'url_private_download'):
+                if not f[key].startswith('http'):
+                    f[key] = self.root + f[key]
+            self.files[f['id']] = f
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.calls = {}
+            self.rate_limited = {}
+
+    def count(self, counter:dict, method:str) -> None:
+        with self.lock:
+            counter[method] = counter.get(method, 0) + 1
+
+    def should_rate_limit(self) -> bool:
+        with self.lock:
+            return self.rng.random() < self.rate_limit_ratio
+
+    def respond(self, method:str, params:dict) -> tuple:
+        # (status, headers, body)
+        self.count(self.calls, method)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.should_rate_limit():
+            self.count(self.rate_limited, method)
+            return 429, {'Retry-After': str(self.retry_after)}, {'ok': False, 'error': 'ratelimited'}
+
+        handler = getattr(self, method.replace('.', '_'), None)
+        if handler is None:
+            return 200, {}, {'ok': False, 'error': 'unknown_method'}
+
+        limit = int(params.get('limit') or default_limits.get(method, 100))
+        return 200, {}, handler(params, limit)
+
+    def auth_test(self, params:dict, limit:int) -> dict:
+        return {'ok': True, 'team': 'Benchmark', 'user_id': 'U00BOT', 'bot_id': 'B00BOT'}
+
+    def conversations_list(self, params:dict, limit:int) -> dict:
+        types = set((params.get('types') or 'public_channel').split(','))
+        exclude_archived = str(params.get('exclude_archived')).lower() in ('1', 'true')
+        channels = [
+            c for c in self.workspace['channels']
+            if channel_type(c) in types and not (exclude_archived and c.get('is_archived'))
+        ]
+        return page(channels, params.get('cursor'), limit, 'channels')
+
+    def conversations_history(self, params:dict, limit:int) -> dict:
+        if params.get('channel') not in self.history:
+            return {'ok': False, 'error': 'channel_not_found'}
+        messages = self.history[params['channel']]
+        if params.get('oldest'):
+            oldest = float(params['oldest'])
+            messages = [m for m in messages if float(m['ts']) > oldest]
+        return page(messages, params.get('cursor'), limit, 'messages')
+
+    def conversations_replies(self, params:dict, limit:int) -> dict:
+        key = (params.get('channel'), params.get('ts'))
+        if key not in self.workspace['replies']:
+            # a message without a thread only has itself
+            messages = [m for m in self.history.get(key[0], []) if m['ts'] == key[1]]
+            if not messages:
+                return {'ok': False, 'error': 'thread_not_found'}
+            return page(messages, None, limit, 'messages')
+        return page(self.workspace['replies'][key], params.get('cursor'), limit, 'messages')
+
+    def users_list(self, params:dict, limit:int) -> dict:
+        response = page(self.workspace['users'], params.get('cursor'), limit, 'members')
+        del response['has_more']
+        return response
+
+    def users_info(self, params:dict, limit:int) -> dict:
+        if params.get('user') not in self.users:
+            return {'ok': False, 'error': 'user_not_found'}
+        return {'ok': True, 'user': self.users[params['user']]}
+
+    def emoji_list(self, params:dict, limit:int) -> dict:
+        return {'ok': True, 'emoji': self.workspace['emoji']}
+
+    def file_content(self, file_id:str) -> bytes:
+        # the same bytes every time, so a file can be checked
+        f = self.files[file_id]
+        seed = hashlib.sha256(file_id.encode()).digest()
+        return (seed * (f['size'] // len(seed) + 1))[:f['size']]
+
+    def respond_file(self, path:str, authorized:bool) -> tuple:
+        # (status, headers, body bytes) for /files/<id>/[download/]<name>
+        self.count(self.calls, 'files')
+        if self.latency:
+            time.sleep(self.latency)
+        if self.should_rate_limit():
+            self.count(self.rate_limited, 'files')
+            return 429, {'Retry-After': str(self.retry_after)}, b''
+        if not authorized:
+            return 200, {'Content-Type': 'text/html'}, b'<html>Sign in to Slack</html>'
+        parts = path.split('/')
+        if len(parts) < 3 or parts[2] not in self.files:
+            return 404, {'Content-Type': 'text/plain'}, b'not found'
+        return 200, {'Content-Type': self.files[parts[2]]['mimetype']}, self.file_content(parts[2])
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'rate_limited': dict(self.rate_limited)
+            }
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    slack = None
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self) -> None:
+        url = urlsplit(self.path)
+        if url.path.startswith('/files/'):
+            authorized = self.headers.get('Authorization', '').startswith('Bearer ')
+            status, headers, data = self.slack.respond_file(url.path, authorized)
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        if body:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+
+        status, headers, response = self.slack.respond(method, params)
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+def add_server_arguments(parser:argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--latency',
+        type = float,
+        help = 'Seconds added to every response. Default 0',
+        default = 0
+    )
+    parser.add_argument(
+        '--rate-limit-ratio',
+        type = float,
+        help = 'Fraction of requests answered with a 429. Default 0',
+        default = 0
+    )
+    parser.add_argument(
+        '--retry-after',
+        type = int,
+        help = 'Retry-After seconds sent with 429s. Default 1',
+        default = 1
+    )
+
+parser = argparse.ArgumentParser(
+    description = 'Serve a synthetic workspace over a fake Slack Web API'
+)
+add_workspace_arguments(parser)
+add_server_arguments(parser)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    slack = FakeSlack(make_workspace(args), args.latency, args.rate_limit_ratio, args.retry_after, args.seed)
+    print(f'Serving on {slack.url}')
+    try:
+        slack.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(slack.report(), indent = 2))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# End to end benchmarks that need no Slack workspace. A synthetic workspace
+# from workspace.py is served by fake_slack.py on localhost, and each
+# scenario runs in its own process so its peak RSS can be measured:
+#   scrape        Scraper.scrape_targets into a new archive
+#   scrape-async  AsyncScraper.scrape_targets into a new archive
+#   scrape-files  scrape-async downloading files too (give --file-ratio);
+#                 not run unless asked for
+#   rescrape      incremental scrape of the same workspace, nothing new
+#   visualize     visualize_data on the scraped archive
+#   convert-old   convert_old.main on the workspace as the old loose files
+# Reports time, messages per second, API calls, 429s and peak RSS.
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import tempfile
+import multiprocessing
+
+benchmark_dir = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, os.path.split(benchmark_dir)[0])
+from workspace import make_workspace, count_messages, write_loose_files, add_workspace_arguments
+from fake_slack import FakeSlack, add_server_arguments
+
+scenario_names = ['scrape', 'scrape-async', 'scrape-files', 'rescrape', 'visualize', 'convert-old']
+default_scenarios = [name for name in scenario_names if name != 'scrape-files']
+
+def peak_rss() -> int:
+    # bytes, for this process or the biggest of its finished children
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+def archive_path(args, work_dir:str, name:str) -> str:
+    return os.path.join(work_dir, name + ('.db' if args.store == 'sqlite' else '.json'))
+
+def scrape(args, url:str, work_dir:str, archive:str, concurrency:int = 1, incremental:bool = False, files_dir:str = None) -> None:
+    import archiver
+    from slack import WebClient
+    from storage import JSONStore, open_store
+    from files import FileArchive
+
+    if not args.real_limits:
+        # measure the archiver, not slack's tier limits
+        archiver.tier_limits = {tier: 10 ** 9 for tier in archiver.tier_limits}
+
+    client = WebClient(token = 'xoxb-benchmark', base_url = url)
+    store = open_store(archive) if os.path.exists(archive) else JSONStore()
+    options = {'high_water': {} if incremental else None}
+    if files_dir is not None:
+        options['files'] = FileArchive(files_dir, token = client.token, concurrency = args.files_concurrency)
+    if concurrency > 1:
+        scraper = archiver.AsyncScraper(store, client, 'all', concurrency = concurrency, **options)
+    else:
+        scraper = archiver.Scraper(store, client, 'all', **options)
+
+    scraper.scrape_targets()
+    scraper.save(archive)
+    scraper.store.close()
+
+def visualize(args, work_dir:str, archive:str) -> None:
+    import archiver
+
+    output_dir = os.path.join(work_dir, 'html')
+    os.makedirs(output_dir, exist_ok = True)
+    visualize_args = archiver.parser.parse_args([
+        'visualize', archive, 'Benchmark',
+        '--output', output_dir,
+        '--jobs', str(args.jobs),
+        '--force'
+    ])
+    visualize_args.func(visualize_args)
+
+def convert_old(args, work_dir:str) -> None:
+    import convert_old
+
+    convert_args = convert_old.parser.parse_args([
+        os.path.join(work_dir, 'loose'),
+        '--output', archive_path(args, work_dir, 'converted'),
+        '--jobs', str(args.jobs)
+    ])
+    convert_old.main(convert_args)
+
+def run_scenario(name:str, args, url:str, work_dir:str, results) -> None:
+    # runs in a fresh process
+    os.chdir(work_dir)
+    from archiver import archive_logger
+    if not args.verbose:
+        archive_logger.setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    if name == 'scrape':
+        scrape(args, url, work_dir, archive_path(args, work_dir, 'scraped'))
+    elif name == 'scrape-async':
+        scrape(args, url, work_dir, archive_path(args, work_dir, 'archive'), concurrency = args.concurrency)
+    elif name == 'scrape-files':
+        scrape(
+            args, url, work_dir, archive_path(args, work_dir, 'with_files'),
+            concurrency = args.concurrency, files_dir = os.path.join(work_dir, 'files')
+        )
+    elif name == 'rescrape':
+        scrape(args, url, work_dir, archive_path(args, work_dir, 'archive'), concurrency = args.concurrency, incremental = True)
+    elif name == 'visualize':
+        visualize(args, work_dir, archive_path(args, work_dir, 'archive'))
+    elif name == 'convert-old':
+        convert_old(args, work_dir)
+    seconds = time.perf_counter() - start
+
+    results.put({'seconds': seconds, 'peak_rss': peak_rss()})
+
+def main(args):
+    unknown = set(args.scenarios) - set(scenario_names)
+    if unknown:
+        print(f"Unknown scenarios: {', '.join(sorted(unknown))}. Choose from {', '.join(scenario_names)}")
+        sys.exit(2)
+    # visualize and rescrape work on the archive scrape-async makes
+    scenarios = [name for name in scenario_names if name in args.scenarios]
+    if {'visualize', 'rescrape'} & set(scenarios) and 'scrape-async' not in scenarios:
+        scenarios.insert(0, 'scrape-async')
+
+    workspace = make_workspace(args)
+    n_messages = count_messages(workspace)
+    print(
+        f"{len(workspace['channels'])} channels, {n_messages} messages, "
+        f"{len(workspace['replies'])} threads, {len(workspace['users'])} users"
+    )
+
+    slack = FakeSlack(workspace, args.latency, args.rate_limit_ratio, args.retry_after, args.seed)
+    slack.start()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'archiver-benchmark-')
+    os.makedirs(os.path.join(work_dir, 'loose'), exist_ok = True)
+    if 'convert-old' in scenarios:
+        write_loose_files(workspace, os.path.join(work_dir, 'loose'))
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name in scenarios:
+        slack.reset()
+        queue = context.Queue()
+        process = context.Process(target = run_scenario, args = (name, args, slack.url, work_dir, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f'{name} failed with exit code {process.exitcode}')
+            sys.exit(1)
+
+        result = queue.get()
+        api = slack.report()
+        results.append({
+            'scenario': name,
+            'seconds': result['seconds'],
+            'messages_per_second': n_messages / result['seconds'],
+            'api_calls': sum(api['calls'].values()),
+            'rate_limited': sum(api['rate_limited'].values()),
+            'calls_by_method': api['calls'],
+            'peak_rss_mb': result['peak_rss'] / 2 ** 20
+        })
+
+    slack.stop()
+
+    print(f"{'scenario':<14}{'seconds':>10}{'messages/s':>12}{'API calls':>11}{'429s':>7}{'peak RSS':>12}")
+    for result in results:
+        print(
+            f"{result['scenario']:<14}{result['seconds']:>10.2f}{result['messages_per_second']:>12.0f}"
+            f"{result['api_calls']:>11}{result['rate_limited']:>7}{result['peak_rss_mb']:>9.1f} MB"
+        )
+    if args.verbose:
+        for result in results:
+            print(f"{result['scenario']}: {json.dumps(result['calls_by_method'])}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'workspace': vars(args), 'messages': n_messages, 'results': results}, f, indent = 2)
+
+    if args.work_dir is None:
+        print(f'Files are in {work_dir}')
+
+parser = argparse.ArgumentParser(
+    description = 'Benchmark scraping, visualizing and converting against a local fake Slack API'
+)
+parser.add_argument(
+    'scenarios',
+    nargs = '*',
+    help = f"Scenarios to run: {', '.join(scenario_names)}. Default all but scrape-files",
+    default = default_scenarios
+)
+parser.add_argument(
+    '--store',
+    choices = ['json', 'sqlite'],
+    help = 'Archive format to scrape into. Default json',
+    default = 'json'
+)
+parser.add_argument(
+    '--concurrency',
+    type = int,
+    help = 'Concurrency for scrape-async and rescrape. Default 4',
+    default = 4
+)
+parser.add_argument(
+    '--files-concurrency',
+    type = int,
+    help = 'Concurrent downloads for scrape-files. Default 4',
+    default = 4
+)
+parser.add_argument(
+    '--jobs',
+    type = int,
+    help = 'Processes for visualize and convert-old. Default 1',
+    default = 1
+)
+parser.add_argument(
+    '--real-limits',
+    action = 'store_true',
+    help = 'Keep Slack\'s per-method rate limits. By default they are lifted, to measure the archiver itself'
+)
+parser.add_argument(
+    '--work-dir',
+    help = 'Directory for the archives and HTML. Default is a new temporary directory'
+)
+parser.add_argument(
+    '--json',
+    help = 'Also write the results to this JSON file, to compare runs'
+)
+parser.add_argument(
+    '--verbose',
+    action = 'store_true',
+    help = 'Show the archiver\'s logging and API calls by method'
+)
+add_workspace_arguments(parser)
+add_server_arguments(parser)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Request latency and throughput of archiver.py serve. A synthetic
+# workspace from workspace.py is saved as a raw archive and served on
+# localhost, or give --url to load test a server that's already running.
+# The pages are found by following links from the index, then requested:
+#   cold        each page once, one at a time, as the links are followed,
+#               so each is rendered (unless a --url server has it cached)
+#   warm        --requests random pages from --concurrency clients, gzipped
+#   revalidate  the same with If-None-Match, so each is a 304
+# Reports requests per second and latency percentiles for each.
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import aiohttp
+
+benchmark_dir = os.path.split(os.path.realpath(__file__))[0]
+sys.path.insert(0, os.path.split(benchmark_dir)[0])
+from workspace import make_workspace, count_messages, add_workspace_arguments
+from archive_io import make_archive
+
+link_pattern = re.compile(r'href="([^"/#?]+\.html)')
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(args, work_dir:str, workspace:dict) -> tuple:
+    archive = os.path.join(work_dir, 'archive' + ('.db' if args.store == 'sqlite' else '.json'))
+    make_archive(workspace).save(archive)
+    user_cache = os.path.join(work_dir, 'slack_users.json')
+    with open(user_cache, 'w') as f:
+        json.dump({'users': {user['id']: user['name'] for user in workspace['users']}}, f)
+
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, os.path.join(os.path.split(benchmark_dir)[0], 'archiver.py'), '-q', 'serve', archive, 'Benchmark',
+            '--port', str(port),
+            '--cache-mb', str(args.cache_mb),
+            '--page-by', args.page_by,
+            '--page-size', str(args.page_size),
+            '--user-cache', user_cache,
+            '--emoji-cache', os.path.join(work_dir, 'slack_emoji.json'),
+            '--files-dir', os.path.join(work_dir, 'files')
+        ],
+        cwd = work_dir
+    )
+    return server, f'http://127.0.0.1:{port}'
+
+async def wait_for(session:aiohttp.ClientSession, url:str, timeout:float = 120) -> None:
+    # the archive is loaded before the server starts listening
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url + '/style.css') as response:
+                await response.read()
+                return
+        except aiohttp.ClientConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+async def find_pages(session:aiohttp.ClientSession, url:str) -> tuple:
+    # every page linked from the index, and the first request for each,
+    # which has to render it
+    pages = ['index.html']
+    results = []
+    for page in pages:
+        headers = {'Accept-Encoding': 'gzip'}
+        start = time.perf_counter()
+        async with session.get(f'{url}/{page}', headers = headers, auto_decompress = False) as response:
+            body = await response.read()
+            results.append((time.perf_counter() - start, response.status, len(body), response.headers.get('ETag')))
+            if response.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+        for link in link_pattern.findall(body.decode()):
+            if link not in pages:
+                pages.append(link)
+    return pages, results
+
+async def fetch(session:aiohttp.ClientSession, url:str, etag:str = None) -> tuple:
+    # seconds, status, bytes on the wire, etag
+    headers = {'Accept-Encoding': 'gzip'}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    start = time.perf_counter()
+    async with session.get(url, headers = headers, auto_decompress = False) as response:
+        body = await response.read()
+        seconds = time.perf_counter() - start
+        return seconds, response.status, len(body), response.headers.get('ETag')
+
+def percentile(values:list, fraction:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def phase_result(name:str, results:list, seconds:float) -> dict:
+    latencies = [r[0] for r in results]
+    return {
+        'phase': name,
+        'requests': len(results),
+        'errors': sum(1 for r in results if r[1] not in (200, 304)),
+        'requests_per_second': len(results) / seconds,
+        'mb_per_second': sum(r[2] for r in results) / seconds / 2 ** 20,
+        'p50_ms': 1000 * percentile(latencies, 0.5),
+        'p90_ms': 1000 * percentile(latencies, 0.9),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+        'max_ms': 1000 * max(latencies)
+    }
+
+async def load(session:aiohttp.ClientSession, url:str, pages:list, etags:dict, args, revalidate:bool) -> list:
+    rng = random.Random(args.seed)
+    choices = [rng.choice(pages) for _ in range(args.requests)]
+    results = []
+
+    async def client(worker:int) -> None:
+        for page in choices[worker::args.concurrency]:
+            results.append(await fetch(session, f'{url}/{page}', etags[page] if revalidate else None))
+
+    await asyncio.gather(*(client(i) for i in range(args.concurrency)))
+    return results
+
+async def run(args, url:str) -> list:
+    connector = aiohttp.TCPConnector(limit = args.concurrency)
+    async with aiohttp.ClientSession(connector = connector) as session:
+        await wait_for(session, url)
+        start = time.perf_counter()
+        pages, cold = await find_pages(session, url)
+        print(f'{len(pages)} pages')
+        phases = [phase_result('cold', cold, time.perf_counter() - start)]
+        etags = {page: result[3] for page, result in zip(pages, cold)}
+
+        for name, revalidate in (('warm', False), ('revalidate', True)):
+            start = time.perf_counter()
+            results = await load(session, url, pages, etags, args, revalidate)
+            phases.append(phase_result(name, results, time.perf_counter() - start))
+        return phases
+
+def main(args):
+    server = None
+    work_dir = None
+    url = args.url
+    if url is None:
+        workspace = make_workspace(args)
+        print(f"{len(workspace['channels'])} channels, {count_messages(workspace)} messages")
+        work_dir = args.work_dir or tempfile.mkdtemp(prefix = 'archiver-serve-benchmark-')
+        os.makedirs(work_dir, exist_ok = True)
+        server, url = start_server(args, work_dir, workspace)
+
+    try:
+        phases = asyncio.run(run(args, url.rstrip('/')))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if work_dir is not None and args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    print(f"{'phase':<12}{'requests':>9}{'errors':>8}{'req/s':>9}{'MB/s':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for phase in phases:
+        print(
+            f"{phase['phase']:<12}{phase['requests']:>9}{phase['errors']:>8}{phase['requests_per_second']:>9.0f}"
+            f"{phase['mb_per_second']:>8.1f}{phase['p50_ms']:>7.1f}ms{phase['p90_ms']:>7.1f}ms"
+            f"{phase['p99_ms']:>7.1f}ms{phase['max_ms']:>7.1f}ms"
+        )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': phases}, f, indent = 2)
+
+parser = argparse.ArgumentParser(
+    description = 'Load test archiver.py serve: request latency and throughput'
+)
+parser.add_argument(
+    '--url',
+    help = 'Test a server that\'s already running here instead of starting one on a synthetic archive'
+)
+parser.add_argument(
+    '--requests',
+    type = int,
+    help = 'Requests in each of the warm and revalidate phases. Default 2000',
+    default = 2000
+)
+parser.add_argument(
+    '--concurrency',
+    type = int,
+    help = 'Clients making requests at once. Default 16',
+    default = 16
+)
+parser.add_argument(
+    '--store',
+    choices = ['json', 'sqlite'],
+    help = 'Archive format to serve. Default json',
+    default = 'json'
+)
+parser.add_argument(
+    '--cache-mb',
+    type = float,
+    help = 'The server\'s --cache-mb. Default 64',
+    default = 64
+)
+parser.add_argument(
+    '--page-by',
+    choices = ['none', 'month', 'size'],
+    help = 'The server\'s --page-by. Default size',
+    default = 'size'
+)
+parser.add_argument(
+    '--page-size',
+    type = int,
+    help = 'The server\'s --page-size. Default 200',
+    default = 200
+)
+parser.add_argument(
+    '--work-dir',
+    help = 'Directory for the archive. Default is a new temporary directory'
+)
+parser.add_argument(
+    '--json',
+    help = 'Also write the results to this JSON file, to compare runs'
+)
+add_workspace_arguments(parser)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Compare Scraper.transform_text against the old
+# username_replace -> url_replace -> emoji_replace chain on a synthetic
+# corpus. Reports the timings, and the messages where the output differs:
+# the old chain puts angle brackets around colons it can't match to an
+# emoji (a:b becomes a<b), and skips shortcodes on lines with several
+# links, which transform_text doesn't copy. The old functions are kept
+# below as archiver.py had them, so this measures the same thing however
+# the archiver changes.
+import os
+import re
+import sys
+import random
+import argparse
+import logging
+import time
+
+sys.path.insert(0, os.path.split(os.path.split(os.path.realpath(__file__))[0])[0])
+from archiver import Scraper, archive_logger
+
+words = [
+    'the', 'results', 'are', 'in', 'gel', 'looks', 'good', 'see', 'figure',
+    'ratio', '1:10', '12:30', 'note:', 'meeting', 'tomorrow', 'at', 'ok',
+    'thanks!', 'lunch?', 'TODO:', 'a:b', 'x', 'https://not.a.link.com'
+]
+urls = [
+    'https://www.example.com/paper.pdf',
+    'http://docs.google.com/spreadsheets/d/abc',
+    'https://www.biorxiv.org/content/10.1101/2020.01.01|preprint',
+    'https://example.com/short'
+]
+
+# The original Scraper methods, with the scraper's users and emoji table
+# passed in. Nothing here should be changed.
+
+def username_replace(users:dict, text:str) -> str:
+    archive_logger.debug('Replacing usernames')
+    for user_id, user_name in users.items():
+        text = re.sub(f'<@{user_id}>', f'@{user_name}', text)
+
+    archive_logger.debug(f"New text: {text}")
+    return text
+
+def url_replace(text:str) -> str:
+    archive_logger.debug('Replacing URLs')
+    url_pattern = re.compile('<(https?:\/\/[^<>]*?\.[^<>]*?\.[^<>]{3,}?)>')
+    url_search = re.search(url_pattern, text)
+    while url_search:
+        archive_logger.debug(f'Found url: {url_search.group(0)}')
+        text = text.replace(
+            url_search.group(0),
+            f'<a href="{url_search.group(1)}">{url_search.group(1)}</a>'
+        )
+        url_search = re.search(url_pattern, text)
+
+    archive_logger.debug(f"New text: {text}")
+    return text
+
+def emoji_replace(emoji_dict:dict, text:str) -> str:
+    archive_logger.debug('Replacing emoji')
+    # first remove all URLs so we can trust that colons are
+    # more-or-less only for emoji
+    #
+    # we can handle likely ratio colons (i.e., 1:10) in
+    # the regex itself
+
+    no_url_text = text[:]
+    url_search = re.search('<a href.*<\/a>', no_url_text)
+    while url_search:
+        no_url_text = no_url_text.replace(url_search.group(0), '')
+        url_search = re.search('<a href.*<\/a>', no_url_text)
+
+    # now search the no-url text but replace in both
+    e_pattern = re.compile(':([^0-9 ].*?[^ ]):')
+    e_match = re.search(e_pattern, no_url_text)
+    while e_match:
+        try:
+            unicode_emoji = emoji_dict[e_match.group(1)]
+            archive_logger.debug(f'Replacing an emoji in {text}')
+            archive_logger.debug(f'No url text: {no_url_text}')
+            text = text.replace(':' + e_match.group(1) + ':', unicode_emoji)
+            no_url_text = no_url_text.replace(':' + e_match.group(1) + ':', unicode_emoji)
+            archive_logger.debug(f'Emoji replaced: {text}')
+        except KeyError:
+            archive_logger.debug('Emoji replacement failed. Adding brackets.')
+            text = text.replace(e_match.group(0), f"<{e_match.group(1)}>")
+            no_url_text = no_url_text.replace(e_match.group(0), f"<{e_match.group(1)}>")
+
+        e_match = re.search(e_pattern, no_url_text)
+
+    # lazy, bad, naughty, etc.
+    text.replace(':100:', emoji_dict['100'])
+
+    return text
+
+def make_corpus(scraper:Scraper, n_messages:int, n_users:int, seed:int) -> list:
+    rng = random.Random(seed)
+    user_ids = [f'U{i:08X}' for i in range(n_users)]
+    scraper.users = {user_id: f'User {i}' for i, user_id in enumerate(user_ids)}
+    shortcodes = list(scraper.emoji_dict.keys())[:300] + ['notanemoji', 'party-parrot']
+
+    corpus = []
+    for _ in range(n_messages):
+        tokens = []
+        for _ in range(rng.randint(3, 60)):
+            roll = rng.random()
+            if roll < 0.05:
+                tokens.append(f'<@{rng.choice(user_ids)}>')
+            elif roll < 0.07:
+                tokens.append(f'<@U{rng.randint(0, 2**32):08X}>')
+            elif roll < 0.10:
+                tokens.append(f'<{rng.choice(urls)}>')
+            elif roll < 0.16:
+                tokens.append(f':{rng.choice(shortcodes)}:')
+            elif roll < 0.18:
+                tokens.append('\n')
+            else:
+                tokens.append(rng.choice(words))
+        corpus.append(' '.join(tokens))
+
+    return corpus
+
+def main(args):
+    scraper = Scraper({}, None, [], no_connection = True)
+    corpus = make_corpus(scraper, args.messages, args.users, args.seed)
+    n_chars = sum(len(text) for text in corpus)
+    print(f'{len(corpus)} messages, {n_chars} characters, {args.users} users')
+
+    # the old functions log every step at debug level
+    archive_logger.setLevel(logging.ERROR)
+
+    users = scraper.users
+    emoji_dict = scraper.emoji_dict
+    start = time.perf_counter()
+    old_output = [
+        emoji_replace(emoji_dict, url_replace(username_replace(users, text)))
+        for text in corpus
+    ]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_output = [scraper.transform_text(text) for text in corpus]
+    new_time = time.perf_counter() - start
+
+    mismatches = [i for i, (old, new) in enumerate(zip(old_output, new_output)) if old != new]
+
+    print(f'old chain:      {old_time:8.3f} s  ({len(corpus) / old_time:10.0f} messages/s)')
+    print(f'transform_text: {new_time:8.3f} s  ({len(corpus) / new_time:10.0f} messages/s)')
+    print(f'speedup:        {old_time / new_time:8.1f}x')
+    print(f'different:      {len(mismatches)} messages')
+    for i in mismatches[:args.show]:
+        print(f'  input: {corpus[i]!r}')
+        print(f'    old: {old_output[i]!r}')
+        print(f'    new: {new_output[i]!r}')
+
+parser = argparse.ArgumentParser(
+    description = 'Benchmark message text transformation'
+)
+parser.add_argument(
+    '--messages',
+    type = int,
+    help = 'Number of synthetic messages. Default 2000',
+    default = 2000
+)
+parser.add_argument(
+    '--users',
+    type = int,
+    help = 'Number of workspace users. Default 2000',
+    default = 2000
+)
+parser.add_argument(
+    '--show',
+    type = int,
+    help = 'Number of differing messages to print. Default 3',
+    default = 3
+)
+parser.add_argument(
+    '--seed',
+    type = int,
+    default = 0
+)
+
+if __name__ == '__main__':
+    main(parser.parse_args())
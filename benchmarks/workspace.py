@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Synthetic Slack workspaces for the benchmarks. make_workspace builds
+# channels, users, custom emoji, shared files, message history and threads
+# shaped like the API's responses; fake_slack.py serves them and
+# write_loose_files writes them out the way the old archiver did, for
+# convert_old.py. File URLs are relative until fake_slack.py knows its
+# address.
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.split(os.path.split(os.path.realpath(__file__))[0])[0])
+from archiver import load_emoji_table
+
+words = [
+    'the', 'results', 'are', 'in', 'gel', 'looks', 'good', 'see', 'figure',
+    'ratio', '1:10', '12:30', 'note:', 'meeting', 'tomorrow', 'at', 'ok',
+    'thanks!', 'lunch?', 'TODO:', 'plate', 'reader', 'buffer', 'column',
+    'protein', 'sample', 'freezer', 'order', 'cells', 'again', 'why', 'is'
+]
+urls = [
+    'https://www.example.com/paper.pdf',
+    'http://docs.google.com/spreadsheets/d/abc',
+    'https://www.biorxiv.org/content/10.1101/2020.01.01|preprint'
+]
+
+def make_text(rng:random.Random, user_ids:list, shortcodes:list, emoji_density:float) -> str:
+    tokens = []
+    for _ in range(rng.randint(2, 40)):
+        roll = rng.random()
+        if roll < emoji_density:
+            tokens.append(f':{rng.choice(shortcodes)}:')
+        elif roll < emoji_density + 0.03:
+            tokens.append(f'<@{rng.choice(user_ids)}>')
+        elif roll < emoji_density + 0.05:
+            tokens.append(f'<{rng.choice(urls)}>')
+        else:
+            tokens.append(rng.choice(words))
+    return ' '.join(tokens)
+
+def make_file(rng:random.Random, i:int) -> dict:
+    name, mimetype = rng.choice([
+        (f'gel_{i}.png', 'image/png'),
+        (f'plate_layout_{i}.pdf', 'application/pdf'),
+        (f'results_{i}.csv', 'text/csv')
+    ])
+    file_id = f'F{i:08X}'
+    return {
+        'id': file_id, 'name': name, 'title': name, 'mimetype': mimetype,
+        'filetype': name.rsplit('.', 1)[1], 'mode': 'hosted',
+        'size': rng.randint(1000, 200000),
+        'url_private': f'files/{file_id}/{name}',
+        'url_private_download': f'files/{file_id}/download/{name}'
+    }
+
+def make_message(rng:random.Random, ts:str, user_ids:list, shortcodes:list, options, files:list = None) -> dict:
+    if rng.random() < options.bot_ratio:
+        message = {
+            'type': 'message', 'subtype': 'bot_message', 'ts': ts, 'bot_id': 'B00000001',
+            'bot_profile': {'id': 'B00000001', 'name': 'Lab Bot'}
+        }
+    else:
+        message = {'type': 'message', 'ts': ts, 'user': rng.choice(user_ids)}
+    message['text'] = make_text(rng, user_ids, shortcodes, options.emoji_density)
+
+    if files and rng.random() < options.file_ratio:
+        # some files are shared more than once
+        message['files'] = rng.sample(files, rng.randint(1, 2))
+
+    if rng.random() < options.reaction_ratio:
+        message['reactions'] = []
+        for name in rng.sample(shortcodes, rng.randint(1, 3)):
+            users = rng.sample(user_ids, rng.randint(1, min(5, len(user_ids))))
+            message['reactions'].append({'name': name, 'users': users, 'count': len(users)})
+
+    return message
+
+def make_workspace(options) -> dict:
+    rng = random.Random(options.seed)
+
+    users = [
+        {
+            'id': f'U{i:08X}', 'name': f'user{i}', 'deleted': False,
+            'profile': {'real_name': f'User {i}', 'display_name': f'user{i}'}
+        }
+        for i in range(options.users)
+    ]
+    user_ids = [user['id'] for user in users]
+
+    emoji = {f'custom{i}': f'https://emoji.example.com/custom{i}.png' for i in range(options.custom_emoji)}
+    shortcodes = list(load_emoji_table().keys())[:300] + list(emoji.keys())
+
+    n_files = int(options.file_ratio * options.channels * options.messages * 0.8)
+    files = [make_file(rng, i) for i in range(n_files)] if n_files else []
+
+    channels = [{'id': f'C{i:08X}', 'name': f'bench-{i}'} for i in range(options.channels)]
+    history = {}
+    replies = {}
+    for channel in channels:
+        messages = []
+        ts = 1600000000.0
+        for _ in range(options.messages):
+            ts += rng.uniform(1, 3600)
+            message = make_message(rng, f'{ts:.6f}', user_ids, shortcodes, options, files)
+
+            if rng.random() < options.thread_ratio:
+                thread = []
+                reply_ts = ts
+                for _ in range(rng.randint(1, 2 * options.replies)):
+                    reply_ts += rng.uniform(0.001, 60)
+                    reply = make_message(rng, f'{reply_ts:.6f}', user_ids, shortcodes, options, files)
+                    reply['thread_ts'] = message['ts']
+                    thread.append(reply)
+                message['thread_ts'] = message['ts']
+                message['reply_count'] = len(thread)
+                message['latest_reply'] = thread[-1]['ts']
+                # conversations.replies starts with the parent
+                replies[(channel['id'], message['ts'])] = [dict(message)] + thread
+
+            messages.append(message)
+        history[channel['id']] = messages
+
+    return {
+        'channels': channels,
+        'users': users,
+        'emoji': emoji,
+        'files': files,
+        'history': history,
+        'replies': replies
+    }
+
+def count_messages(workspace:dict) -> int:
+    # every message the scraper sees, replies included
+    return (
+        sum(len(messages) for messages in workspace['history'].values()) +
+        sum(len(thread) - 1 for thread in workspace['replies'].values())
+    )
+
+def write_loose_files(workspace:dict, directory:str) -> None:
+    # the old archiver's format: per channel, the users list and a dict of
+    # thread ts -> [parent, replies...]
+    for channel in workspace['channels']:
+        with open(os.path.join(directory, f"{channel['name']}_users.json"), 'w') as f:
+            json.dump(workspace['users'], f)
+
+        threads = {}
+        for message in workspace['history'][channel['id']]:
+            thread = workspace['replies'].get((channel['id'], message['ts']), [message])
+            threads[message['ts']] = thread
+        with open(os.path.join(directory, f"{channel['name']}_replies.json"), 'w') as f:
+            json.dump(threads, f)
+
+def add_workspace_arguments(parser:argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--channels',
+        type = int,
+        help = 'Number of channels. Default 4',
+        default = 4
+    )
+    parser.add_argument(
+        '--messages',
+        type = int,
+        help = 'Top level messages per channel. Default 1000',
+        default = 1000
+    )
+    parser.add_argument(
+        '--thread-ratio',
+        type = float,
+        help = 'Fraction of messages with a thread. Default 0.2',
+        default = 0.2
+    )
+    parser.add_argument(
+        '--replies',
+        type = int,
+        help = 'Average replies per thread. Default 5',
+        default = 5
+    )
+    parser.add_argument(
+        '--reaction-ratio',
+        type = float,
+        help = 'Fraction of messages with reactions. Default 0.2',
+        default = 0.2
+    )
+    parser.add_argument(
+        '--bot-ratio',
+        type = float,
+        help = 'Fraction of messages from a bot. Default 0.02',
+        default = 0.02
+    )
+    parser.add_argument(
+        '--users',
+        type = int,
+        help = 'Number of workspace users. Default 500',
+        default = 500
+    )
+    parser.add_argument(
+        '--emoji-density',
+        type = float,
+        help = 'Chance of each word being an emoji shortcode. Default 0.05',
+        default = 0.05
+    )
+    parser.add_argument(
+        '--custom-emoji',
+        type = int,
+        help = 'Number of custom emoji. Default 50',
+        default = 50
+    )
+    parser.add_argument(
+        '--file-ratio',
+        type = float,
+        help = 'Fraction of messages with files shared in them. Default 0',
+        default = 0
+    )
+    parser.add_argument(
+        '--seed',
+        type = int,
+        default = 0
+    )
+
+parser = argparse.ArgumentParser(
+    description = 'Write a synthetic workspace as the old archiver\'s loose JSON files'
+)
+parser.add_argument(
+    'output',
+    help = 'Directory to write the files to'
+)
+add_workspace_arguments(parser)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok = True)
+    workspace = make_workspace(args)
+    write_loose_files(workspace, args.output)
+    print(f"{len(workspace['channels'])} channels, {count_messages(workspace)} messages written to {args.output}")
@@ -6,50 +6,279 @@ import json
 import argparse
 import logging
 import time
+import shutil
+import tempfile
 from datetime import datetime
-from archiver import Scraper, archive_logger
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from archiver import Scraper, archive_logger, load_emoji_table, resolve_custom_emoji, load_render_inputs
+from storage import JSONStore, SQLiteStore, is_sqlite, open_store, atomic_write, iter_json_items, ts_key
 
 script_dir = os.path.split(os.path.realpath(__file__))[0]
 
-def main(args):
-    json_files = [os.path.realpath(x) for x in glob.glob(args.input) if os.path.exists(x) and x.endswith('.json') and ('replies' in x or 'users' in x)]
-    
-    converter = Scraper({}, None, [], no_connection = True)
+# threads per transaction when converting into a database
+sqlite_batch_size = 1000
 
-    base_dir = os.path.split(json_files[0])[0]
-    channels = list(set('_'.join(os.path.split(x)[1].split('_')[:-1]) for x in json_files))
+def find_channels(inputs:list) -> dict:
+    # channel -> [(users file, replies file), ...], one pair for each
+    # input directory that has the channel, in the order they were given
+    channels = {}
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.json')
+        for path in sorted(glob.glob(pattern)):
+            name = os.path.split(path)[1]
+            if not name.endswith(('_replies.json', '_users.json')):
+                continue
+            directory = os.path.split(os.path.realpath(path))[0]
+            channel = '_'.join(name.split('_')[:-1])
+            pair = (os.path.join(directory, channel + '_users.json'), os.path.join(directory, channel + '_replies.json'))
+            if pair not in channels.setdefault(channel, []):
+                channels[channel].append(pair)
+    return channels
 
-    for channel in channels:
-        message_data = {}
-        archive_logger.debug(f'Loading replies for {channel}')
+# each process converting channels has its own scraper to process messages
+converter = None
 
+def start_converter() -> None:
+    global converter
+    converter = Scraper({}, None, [], no_connection = True)
+
+def convert_channel(channel:str, sources:list, part_path:str) -> tuple:
+    # converts one channel and writes its threads to part_path as a JSON
+    # object, for the main process to copy into the output. Reply files
+    # are read a thread at a time; the converted channel is held until
+    # it's sorted, so memory goes with the biggest channel, not the whole
+    # export. Returns (channel, part_path, threads, users, seconds), or
+    # None if there was nothing to convert.
+    start = time.perf_counter()
+    threads = {}
+    users = {}
+    for users_path, replies_path in sources:
         try:
-            with open(os.path.join(base_dir, channel + '_users.json'), 'r') as f:
+            with open(users_path, 'r') as f:
                 converter.users = {user['id']: user['profile']['real_name'] for user in json.load(f)}
         except FileNotFoundError:
-            archive_logger.warning(f"Couldn't find users for {channel}. Skipping.")
+            archive_logger.warning(f"Couldn't find users for {channel} in {os.path.split(users_path)[0]}. Skipping.")
             continue
 
+        archive_logger.debug(f'Loading replies for {channel} from {replies_path}')
         try:
-            with open(os.path.join(base_dir, channel + '_replies.json'), 'r') as f:
-                data = json.load(f)
+            with open(replies_path, 'r') as f:
+                for ts, messages in iter_json_items(f):
+                    messages = [converter.process_message_object(message) for message in messages]
+                    # a thread in a later directory replaces the same one in an earlier one
+                    threads[ts] = {
+                        'message': messages[0],
+                        'replies': messages[1:]
+                    }
         except FileNotFoundError:
-            archive_logger.warning(f"Couldn't find messages for {channel}. Skipping.")
+            archive_logger.warning(f"Couldn't find messages for {channel} in {os.path.split(replies_path)[0]}. Skipping.")
             continue
+        users.update(converter.users)
+
+    if not threads:
+        return None
+
+    with open(part_path, 'w', encoding = 'utf-8') as f:
+        f.write('{')
+        for i, ts in enumerate(sorted(threads, key = ts_key)):
+            if i:
+                f.write(', ')
+            f.write(f'{json.dumps(ts)}: {json.dumps(threads[ts])}')
+        f.write('}')
+
+    return channel, part_path, len(threads), users, time.perf_counter() - start
+
+def convert_channels(channels:dict, part_dir:str, jobs:int):
+    # yields each channel's result as soon as it's converted
+    jobs_list = [
+        (channel, sources, os.path.join(part_dir, f'{i}.json'))
+        for i, (channel, sources) in enumerate(sorted(channels.items()))
+    ]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers = jobs, initializer = start_converter) as pool:
+            futures = [pool.submit(convert_channel, *job) for job in jobs_list]
+            try:
+                for future in as_completed(futures):
+                    if future.result() is not None:
+                        yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+    else:
+        start_converter()
+        for job in jobs_list:
+            result = convert_channel(*job)
+            if result is not None:
+                yield result
+
+def write_json_output(results, output:str) -> int:
+    # copies each channel's part file into the output as it comes in
+    n_channels = 0
+    with atomic_write(output) as out:
+        out.write('{')
+        for channel, part_path, _, _, _ in results:
+            if n_channels:
+                out.write(', ')
+            out.write(f'{json.dumps(channel)}: ')
+            with open(part_path, 'r', encoding = 'utf-8') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part_path)
+            n_channels += 1
+        out.write('}')
+    return n_channels
+
+def write_sqlite_output(results, output:str) -> int:
+    destination = SQLiteStore(output)
+    users = {}
+    n_channels = 0
+    for channel, part_path, _, channel_users, _ in results:
+        destination.add_channel(channel)
+        with open(part_path, 'r', encoding = 'utf-8') as f:
+            batch = {}
+            for ts, thread in iter_json_items(f):
+                batch[ts] = thread
+                if len(batch) >= sqlite_batch_size:
+                    destination.put_threads(channel, batch)
+                    batch = {}
+            destination.put_threads(channel, batch)
+        os.remove(part_path)
+        users.update(channel_users)
+        n_channels += 1
+    destination.put_users(users)
+    destination.close()
+    return n_channels
+
+def log_results(results):
+    for result in results:
+        channel, _, n_threads, _, seconds = result
+        archive_logger.info(f'{channel}: {n_threads} threads in {seconds:.2f} seconds')
+        yield result
+
+def main(args):
+    channels = find_channels(args.input)
+    if not channels:
+        archive_logger.error('No loose JSON files found.')
+        sys.exit(1)
+    archive_logger.info(f'Converting {len(channels)} channels.')
+
+    # channels are converted into part files, which are copied into the
+    # output as they finish, so the output is never all in memory
+    output = os.path.realpath(args.output)
+    part_dir = tempfile.mkdtemp(prefix = '.convert-', dir = os.path.split(output)[0])
+    start = time.perf_counter()
+    try:
+        results = log_results(convert_channels(channels, part_dir, args.jobs))
+        if is_sqlite(output):
+            n_channels = write_sqlite_output(results, output)
+        else:
+            n_channels = write_json_output(results, output)
+    finally:
+        shutil.rmtree(part_dir, ignore_errors = True)
+
+    archive_logger.info(f'Converted {n_channels} channels in {time.perf_counter() - start:.2f} seconds.')
+
+class Unprocessor(object):
+    # Undoes process_message_object as far as it can: names go back to
+    # user IDs, links and emoji back to slack's markup, and format_ts is
+    # dropped, which is what marks a message as raw for visualize. Names
+    # and emoji it doesn't know are left as they are.
+    def __init__(self, users:dict, custom_emoji:dict) -> None:
+        self.user_ids = {name: user_id for user_id, name in users.items()}
+
+        emoji = load_emoji_table()
+        emoji.update(resolve_custom_emoji(custom_emoji, emoji))
+        # primary short names come first in the table, so they win over aliases
+        self.emoji_names = {}
+        for name, html in emoji.items():
+            self.emoji_names.setdefault(html, name)
+            # custom emoji used to be written with alt=":name:"
+            if html.startswith('<img'):
+                self.emoji_names.setdefault(html.replace(f'alt="{name}"', f'alt=":{name}:"'), name)
+
+        self.emoji_pattern = self.alternatives(self.emoji_names)
+        self.mention_pattern = self.alternatives(self.user_ids, '@', r'(?!\w)')
+        self.link_pattern = re.compile(r'<a href="([^"]*)">\1</a>')
 
-        for ts, messages in data.items():
-            for i in range(len(messages)):
-                messages[i] = converter.process_message_object(messages[i])
+    def alternatives(self, strings, before:str = '', after:str = ''):
+        # longest first, so a name is never matched by one it starts with
+        if not strings:
+            return None
+        return re.compile(
+            before + '(' + '|'.join(re.escape(x) for x in sorted(strings, key = len, reverse = True)) + ')' + after
+        )
 
-            message_data[ts] = {
-                'message': messages[0],
-                'replies': messages[1:] if len(messages) > 1 else []
+    def text(self, text:str) -> str:
+        if self.emoji_pattern is not None:
+            text = self.emoji_pattern.sub(lambda m: f':{self.emoji_names[m.group(1)]}:', text)
+        text = self.link_pattern.sub(r'<\1>', text)
+        if self.mention_pattern is not None:
+            text = self.mention_pattern.sub(lambda m: f'<@{self.user_ids[m.group(1)]}>', text)
+        return text
+
+    def reaction_name(self, name:str) -> str:
+        if name in self.emoji_names:
+            return self.emoji_names[name]
+        shortcode = re.search(r'alt=":?([^:"]+):?"', name) or re.search(r':([^:\s<>]+):', name)
+        return shortcode.group(1) if shortcode else name
+
+    def message(self, message:dict) -> dict:
+        if 'format_ts' not in message:
+            return message
+
+        message = dict(message)
+        del message['format_ts']
+        if 'text' in message:
+            message['text'] = self.text(message['text'])
+
+        if message.get('user') in self.user_ids:
+            message['user'] = self.user_ids[message['user']]
+        elif 'bot_id' in message:
+            # the name came from the bot profile
+            message.pop('user', None)
+
+        if 'reactions' in message:
+            message['reactions'] = [
+                dict(
+                    reaction,
+                    name = self.reaction_name(reaction['name']),
+                    users = [self.user_ids.get(name, name) for name in reaction['users']]
+                )
+                for reaction in message['reactions']
+            ]
+
+        return message
+
+def migrate(args):
+    if len(args.input) != 1:
+        archive_logger.error('Give one archive to migrate.')
+        sys.exit(1)
+    args.input = args.input[0]
+    if os.path.realpath(args.input) == os.path.realpath(args.output):
+        archive_logger.error('Give a different output file to migrate into.')
+        sys.exit(1)
+
+    source = open_store(os.path.realpath(args.input))
+    users, custom_emoji = load_render_inputs(source, args.user_cache, args.emoji_cache)
+    unprocessor = Unprocessor(users, custom_emoji)
+
+    destination = SQLiteStore(args.output) if is_sqlite(args.output) else JSONStore()
+    for channel in source.channels():
+        archive_logger.info(f'Migrating {channel}')
+        destination.add_channel(channel)
+        destination.put_threads(channel, {
+            thread['message']['ts']: {
+                'message': unprocessor.message(thread['message']),
+                'replies': [unprocessor.message(reply) for reply in thread['replies']]
             }
-        
-        converter.message_data[channel] = message_data
+            for thread in source.threads(channel)
+        })
+    destination.put_users(users)
+
+    destination.save(args.output)
+    destination.close()
+    source.close()
 
-    converter.write_json(args.output)
-        
 
 parser = argparse.ArgumentParser(
     description='Convert old loose JSON files into modern single-file format.'
@@ -81,11 +310,34 @@ vxg.add_argument(
 
 parser.add_argument(
     'input',
-    help = 'Loose JSON files. Glob format.'
+    nargs = '+',
+    help = 'Loose JSON files, in glob format, or directories of them. Channels found in more than one are merged, later ones winning. With --migrate, an archive'
+)
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type = int,
+    help = 'Number of processes to convert channels with. Default is the number of CPUs',
+    default = os.cpu_count()
+)
+parser.add_argument(
+    '--migrate',
+    action = 'store_true',
+    help = 'Turn an archive of processed messages into raw ones, like scrape --raw makes, so visualize applies the current transformations'
+)
+parser.add_argument(
+    '--user-cache',
+    help = 'User cache from the scraper, for --migrate. Default is slack_users.json in current directory',
+    default = 'slack_users.json'
+)
+parser.add_argument(
+    '--emoji-cache',
+    help = 'Custom emoji cache from the scraper, for --migrate. Default is slack_emoji.json in current directory',
+    default = 'slack_emoji.json'
 )
 parser.add_argument(
     '--output',
-    help = 'Output JSON file. Default "slack_data.json" in current dir',
+    help = 'Output JSON file, or SQLite database (.db, .sqlite). Default "slack_data.json" in current dir',
     default = 'slack_data.json'
 )
 
@@ -103,4 +355,9 @@ if __name__ == '__main__':
     except KeyError:
         level = logging.INFO
 
-    main(args)
\ No newline at end of file
+    archive_logger.setLevel(level)
+
+    if args.migrate:
+        migrate(args)
+    else:
+        main(args)
\ No newline at end of file
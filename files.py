@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from storage import atomic_write
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Attachment archiving. Files shared in messages are downloaded by a pool
+# of worker threads, each keeping a connection open to every host it's
+# talked to, into a content-addressed store:
+#   files_dir/objects/ab/ab12...ef.png   named for the sha256 of the content
+#   files_dir/index.json                 slack file ID -> where it's stored
+# A file posted again, or in another channel, is only stored once, and
+# files already in the index aren't downloaded again on later runs.
+
+archive_logger = logging.getLogger('archiver')
+
+index_name = 'index.json'
+objects_dir = 'objects'
+max_redirects = 5
+# hosts a redirect can send the token on to, besides the one it came from
+token_domains = ('slack.com', 'slack-edge.com')
+max_retries = 3
+chunk_size = 1 << 16
+# longest side of a thumbnail, in pixels
+thumbnail_size = 360
+thumbnail_dir = 'thumbs'
+
+def parse_size(text:str) -> int:
+    # bytes, from e.g. 500000, 500K, 20M or 2G
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def message_files(message:dict) -> list:
+    # the files in a message that can be downloaded. External files (from
+    # Google Drive and the like) and deleted ones have nothing to fetch.
+    return [
+        f for f in message.get('files') or []
+        if f.get('id') and not f.get('is_external') and f.get('mode') not in ('tombstone', 'hidden_by_limit') and
+        (f.get('url_private_download') or f.get('url_private'))
+    ]
+
+def extension(name:str) -> str:
+    # kept on the stored copy so browsers know what to do with it
+    ext = os.path.splitext(name or '')[1].lower()
+    return ext if ext[1:].isalnum() and len(ext) <= 10 else ''
+
+def object_path(sha256:str, ext:str) -> str:
+    # relative to the files directory
+    return '/'.join((objects_dir, sha256[:2], sha256 + ext))
+
+def load_index(files_dir:str) -> dict:
+    try:
+        with open(os.path.join(files_dir, index_name), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def sends_token(host:str, origin:str) -> bool:
+    # only to the host we were asked for and slack's own; a redirect to a
+    # CDN or anywhere else mustn't get the token
+    if host is None:
+        return False
+    return host == origin or any(host == domain or host.endswith('.' + domain) for domain in token_domains)
+
+class FileArchive(object):
+    # Downloads files as they're added, with at most `concurrency` at once,
+    # and stops taking new ones once `max_bytes` have been queued this run.
+    # Files that fail are left out of the index, so the next run tries them
+    # again.
+    def __init__(self, files_dir:str, token:str = None, concurrency:int = 4, max_bytes:int = None, timeout:float = 60) -> None:
+        self.files_dir = files_dir
+        self.token = token
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        os.makedirs(os.path.join(files_dir, objects_dir), exist_ok = True)
+        self.index = load_index(files_dir)
+
+        self.pool = ThreadPoolExecutor(max_workers = concurrency, thread_name_prefix = 'files')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.queued = set()
+        self.futures = []
+        self.queued_bytes = 0
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.over_limit = 0
+
+    def add(self, files:list) -> None:
+        for f in files:
+            if f['id'] in self.index or f['id'] in self.queued:
+                continue
+            size = f.get('size') or 0
+            if self.max_bytes is not None and self.queued_bytes + size > self.max_bytes:
+                self.over_limit += 1
+                continue
+            self.queued.add(f['id'])
+            self.queued_bytes += size
+            self.futures.append(self.pool.submit(self.download, f))
+
+    def connection(self, scheme:str, host:str) -> http.client.HTTPConnection:
+        # one kept-alive connection per worker thread and host
+        connections = self.local.__dict__.setdefault('connections', {})
+        if (scheme, host) not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connections[scheme, host] = connection_class(host, timeout = self.timeout)
+        return connections[scheme, host]
+
+    def request(self, url:str) -> http.client.HTTPResponse:
+        origin = urlsplit(url).hostname
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            path = parts.path + ('?' + parts.query if parts.query else '')
+            headers = {'Authorization': f'Bearer {self.token}'} if self.token and sends_token(parts.hostname, origin) else {}
+            connection = self.connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers = headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                # the server may have closed a kept-alive connection; try
+                # once more on a new one
+                connection.close()
+                connection.request('GET', path, headers = headers)
+                response = connection.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                url = response.getheader('Location')
+                if url.startswith('/'):
+                    url = f'{parts.scheme}://{parts.netloc}{url}'
+                continue
+            return response
+        raise http.client.HTTPException(f'Too many redirects for {url}')
+
+    def download(self, f:dict) -> None:
+        url = f.get('url_private_download') or f['url_private']
+        temp_path = os.path.join(self.files_dir, objects_dir, f"{f['id']}.part")
+        try:
+            response = self.request(url)
+            for _ in range(max_retries):
+                if response.status != 429:
+                    break
+                response.read()
+                time.sleep(float(response.getheader('Retry-After') or 1))
+                response = self.request(url)
+            if response.status != 200:
+                response.read()
+                raise http.client.HTTPException(f'HTTP {response.status}')
+            # a login page instead of the file means the token can't see it
+            if not (f.get('mimetype') or '').startswith('text/') and response.getheader('Content-Type', '').startswith('text/html'):
+                response.read()
+                raise http.client.HTTPException('got a web page, not the file. Does the token have files:read?')
+
+            digest = hashlib.sha256()
+            size = 0
+            with open(temp_path, 'wb') as out:
+                while True:
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except (http.client.HTTPException, OSError) as e:
+            archive_logger.warning(f"Couldn't download {f.get('name', f['id'])} ({f['id']}): {e}")
+            with self.lock:
+                self.failed += 1
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        path = object_path(digest.hexdigest(), extension(f.get('name')))
+        full_path = os.path.join(self.files_dir, path)
+        with self.lock:
+            if os.path.exists(full_path):
+                os.remove(temp_path)
+                self.duplicates += 1
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok = True)
+                os.replace(temp_path, full_path)
+            self.index[f['id']] = {
+                'path': path,
+                'name': f.get('name'),
+                'mimetype': f.get('mimetype'),
+                'size': size
+            }
+            self.downloaded += 1
+            self.downloaded_bytes += size
+
+    def save(self) -> None:
+        # a long-running watcher saves many times; forget downloads that are done
+        self.futures = [future for future in self.futures if not future.done()]
+        with self.lock:
+            index = dict(self.index)
+        with atomic_write(os.path.join(self.files_dir, index_name)) as f:
+            json.dump(index, f)
+
+    def finish(self) -> None:
+        # waits for the downloads still going, then saves the index
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.pool.shutdown()
+        self.save()
+
+    def report(self) -> None:
+        archive_logger.info(
+            f'Files: downloaded {self.downloaded} ({self.downloaded_bytes} bytes), '
+            f'{self.duplicates} already stored under another ID, {self.failed} failed.'
+        )
+        if self.over_limit:
+            archive_logger.warning(f'Skipped {self.over_limit} files over the limit of {self.max_bytes} bytes for this run.')
+
+class FileLinks(object):
+    # Local copies of files for visualize: links to them relative to the
+    # HTML, and thumbnails for images. Thumbnails are made the first time
+    # a page showing them is rendered and kept in output_dir/thumbs. They
+    # need Pillow; without it pages show the images themselves, scaled down.
+    def __init__(self, files_dir:str, output_dir:str) -> None:
+        self.files_dir = files_dir
+        self.output_dir = output_dir
+        self.index = load_index(files_dir)
+        self.prefix = os.path.relpath(files_dir, output_dir).replace(os.sep, '/')
+
+    def local_file(self, f:dict) -> dict:
+        # {'name', 'href', 'thumb'} for a file in a message, or None if it
+        # wasn't downloaded. thumb is None for files that aren't images.
+        stored = self.index.get(f.get('id'))
+        if stored is None:
+            return None
+        href = f"{self.prefix}/{stored['path']}"
+        thumb = None
+        if (stored.get('mimetype') or '').startswith('image/'):
+            thumb = self.thumbnail(stored['path']) or href
+        return {'name': stored.get('name') or f.get('name'), 'href': href, 'thumb': thumb}
+
+    def thumbnail(self, path:str) -> str:
+        if Image is None:
+            return None
+        name = os.path.splitext(os.path.basename(path))[0] + '.png'
+        thumb_path = os.path.join(self.output_dir, thumbnail_dir, name)
+        if not os.path.exists(thumb_path):
+            try:
+                with Image.open(os.path.join(self.files_dir, path)) as image:
+                    image.thumbnail((thumbnail_size, thumbnail_size))
+                    os.makedirs(os.path.dirname(thumb_path), exist_ok = True)
+                    # pages are rendered in several processes at once
+                    temp_path = f'{thumb_path}.{os.getpid()}.tmp'
+                    image.save(temp_path, 'PNG')
+                os.replace(temp_path, thumb_path)
+            except (OSError, ValueError) as e:
+                archive_logger.debug(f"Couldn't make a thumbnail of {path}: {e}")
+                return None
+        return f'{thumbnail_dir}/{name}'
+
+    def index_hash(self) -> str:
+        return hashlib.sha256(json.dumps(self.index, sort_keys = True).encode()).hexdigest()
@@ -1,13 +1,26 @@
 const reactions = document.getElementsByClassName('react');
 const hoverContainer = document.getElementById('mouseover-container');
 
+// pages rendered with --compact have a table of the people on the page,
+// and name them by their place in it instead of repeating their names
+const usersTable = document.getElementById('users');
+const pageUsers = usersTable ? JSON.parse(usersTable.textContent) : null;
+
+if (pageUsers) {
+    for (let name of document.querySelectorAll('.username[data-u]')) {
+        name.textContent = pageUsers[name.dataset.u];
+    }
+}
+
 for (let reaction of reactions) {
     reaction.addEventListener('mouseover', (event) => {
 
-        let userArray = reaction.getAttribute('data-users').split(',');
+        let userArray = pageUsers ?
+            reaction.dataset.u.split(',').map((i) => pageUsers[i]) :
+            reaction.getAttribute('data-users').split(',');
         for (let user of userArray) {
             newUser = document.createElement('p');
-            newUser.innerText = user.replace('_', ' ');
+            newUser.innerText = user;
             hoverContainer.appendChild(newUser);
         }
 
@@ -28,4 +41,123 @@ for (let reaction of reactions) {
         }
         hoverContainer.classList.add('hidden');
     })
-}
\ No newline at end of file
+}
+// Search ----------------------------------------------------------------------
+// visualize writes an inverted index to search/. meta.js lists the pages,
+// shards/<prefix>.js maps the terms starting with <prefix> to
+// [page number, message ts] postings, and docs/<page>.js has the snippets
+// for a page. The files are scripts that call searchFileLoaded, so they
+// load on pages opened from disk, and only the ones a search needs are
+// loaded.
+
+const searchBox = document.getElementById('search');
+const searchResults = document.getElementById('search-results');
+const maxResults = 50;
+const searchFiles = {};
+const searchFileCallbacks = {};
+let searchNumber = 0;
+
+function searchFileLoaded(name, data) {
+    searchFileCallbacks[name](data);
+}
+
+function loadSearchFile(name) {
+    if (!(name in searchFiles)) {
+        searchFiles[name] = new Promise((resolve) => {
+            searchFileCallbacks[name] = resolve;
+            let script = document.createElement('script');
+            script.src = 'search/' + name + '.js';
+            // no shard means no terms with that prefix
+            script.onerror = () => resolve({});
+            document.head.appendChild(script);
+        });
+    }
+    return searchFiles[name];
+}
+
+function shardName(term, prefix) {
+    // matches shard_name in archiver.py
+    return Array.from(term).slice(0, prefix).map((c) =>
+        /[a-z0-9]/.test(c) ? c : '_' + c.codePointAt(0).toString(16)
+    ).join('');
+}
+
+async function search(query) {
+    let terms = query.toLowerCase().match(/[\p{L}\p{N}_]{2,}/gu) || [];
+    if (terms.length === 0) {
+        return [];
+    }
+
+    let meta = await loadSearchFile('meta');
+    let shards = await Promise.all(
+        terms.map((term) => loadSearchFile('shards/' + shardName(term, meta.prefix)))
+    );
+
+    // every term has to match, and a term matches any indexed word it
+    // starts, so results show up while the last word is still being typed
+    let matches = null;
+    terms.forEach((term, i) => {
+        let found = new Set();
+        for (let [word, postings] of Object.entries(shards[i])) {
+            if (word.startsWith(term)) {
+                for (let [file, ts] of postings) {
+                    found.add(file + ' ' + ts);
+                }
+            }
+        }
+        matches = matches === null ? found : new Set([...matches].filter((m) => found.has(m)));
+    });
+
+    let results = [...matches].map((match) => {
+        let [file, ts] = match.split(' ');
+        return {channel: meta.files[file][0], page: meta.files[file][1], ts: ts};
+    });
+    results.sort((a, b) => parseFloat(b.ts) - parseFloat(a.ts));
+    return results;
+}
+
+async function showResults(query) {
+    let thisSearch = ++searchNumber;
+    let results = await search(query);
+    let shown = results.slice(0, maxResults);
+    let docs = await Promise.all(
+        shown.map((result) => loadSearchFile('docs/' + result.page.replace(/\.html$/, '')))
+    );
+    // a newer search finished first
+    if (thisSearch !== searchNumber) {
+        return;
+    }
+
+    while (searchResults.firstChild) {
+        searchResults.removeChild(searchResults.firstChild);
+    }
+    shown.forEach((result, i) => {
+        let link = document.createElement('a');
+        link.href = result.page + '#' + result.ts;
+        let heading = document.createElement('span');
+        heading.className = 'timestamp';
+        heading.innerText = '#' + result.channel + ' ' + new Date(parseFloat(result.ts) * 1000).toLocaleString();
+        link.appendChild(heading);
+        link.appendChild(document.createTextNode(' ' + (docs[i][result.ts] || '')));
+        searchResults.appendChild(link);
+    });
+    if (results.length > maxResults) {
+        let more = document.createElement('p');
+        more.innerText = (results.length - maxResults) + ' more results';
+        searchResults.appendChild(more);
+    }
+    if (query.trim() !== '' && results.length === 0) {
+        let none = document.createElement('p');
+        none.innerText = 'No results';
+        searchResults.appendChild(none);
+    }
+    searchResults.classList.toggle('hidden', query.trim() === '');
+}
+
+if (searchBox) {
+    let searchTimer = null;
+    searchBox.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => showResults(searchBox.value), 200);
+    })
+}
@@ -0,0 +1,109 @@
+import time
+import json
+from contextlib import contextmanager
+from storage import atomic_write
+
+# Run metrics: how long each phase of a run took, API calls by method,
+# and counts of messages and bytes. `metrics` is shared by the whole
+# process; the archiver adds to it as it goes and writes it out at the
+# end of a run as JSON or a Prometheus textfile.
+#
+# Phases can overlap. With the async scraper several history pages and
+# threads are in flight at once, so their times are summed over workers
+# and can add up to more than the run took.
+
+prometheus_prefix = 'slack_archiver'
+
+class Metrics(object):
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.start = time.perf_counter()
+        # phase -> [times entered, seconds]
+        self.phases = {}
+        # method -> {'calls', 'retries', 'wait'}
+        self.api = {}
+        # name -> amount
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, phase:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase:str, seconds:float, times:int = 1) -> None:
+        totals = self.phases.setdefault(phase, [0, 0.0])
+        totals[0] += times
+        totals[1] += seconds
+
+    def count(self, name:str, amount:float = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_api(self, method:str, stat:str, amount:float = 1) -> None:
+        method_stats = self.api.setdefault(method, {'calls': 0, 'retries': 0, 'wait': 0})
+        method_stats[stat] += amount
+
+    def summary(self, command:str = None) -> dict:
+        return {
+            'command': command,
+            'started': self.started,
+            'seconds': time.perf_counter() - self.start,
+            'phases': {
+                phase: {'count': count, 'seconds': seconds}
+                for phase, (count, seconds) in sorted(self.phases.items())
+            },
+            'api': dict(sorted(self.api.items())),
+            'counters': dict(sorted(self.counters.items()))
+        }
+
+    def describe(self) -> str:
+        # one line for the log
+        return ', '.join(
+            f'{phase} {seconds:.2f}s' for phase, (_, seconds) in
+            sorted(self.phases.items(), key = lambda p: -p[1][1])
+        )
+
+    def write_json(self, path:str, command:str = None) -> None:
+        with atomic_write(path) as f:
+            json.dump(self.summary(command), f, indent = 2)
+
+    def write_prometheus(self, path:str, command:str = None) -> None:
+        # textfile collector format. The file is replaced atomically, so
+        # the collector never reads half of it.
+        summary = self.summary(command)
+        lines = []
+
+        def metric(name:str, kind:str, description:str, samples:list) -> None:
+            name = f'{prometheus_prefix}_{name}'
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        run = {'command': command} if command else {}
+        metric('run_seconds', 'gauge', 'Length of the last run.', [(run, summary['seconds'])])
+        metric('run_start_time_seconds', 'gauge', 'When the last run started.', [(run, summary['started'])])
+        metric('phase_seconds', 'gauge', 'Time spent in each phase of the last run.', [
+            (dict(run, phase = phase), values['seconds']) for phase, values in summary['phases'].items()
+        ])
+        metric('phase_count', 'gauge', 'Times each phase was entered in the last run.', [
+            (dict(run, phase = phase), values['count']) for phase, values in summary['phases'].items()
+        ])
+        for stat, description in (
+            ('calls', 'Slack API calls in the last run, retries included.'),
+            ('retries', 'Slack API calls retried in the last run.'),
+            ('wait', 'Seconds spent waiting on rate limits and retries in the last run.')
+        ):
+            metric(f'api_{stat}', 'gauge', description, [
+                (dict(run, method = method), values[stat]) for method, values in summary['api'].items()
+            ])
+        for name, value in summary['counters'].items():
+            metric(name, 'gauge', f'{name.replace("_", " ").capitalize()} in the last run.', [(run, value)])
+
+        with atomic_write(path) as f:
+            f.write('\n'.join(lines) + '\n')
+
+metrics = Metrics()
@@ -0,0 +1,670 @@
+import os
+import io
+import gzip
+import json
+import heapq
+import sqlite3
+from array import array
+from itertools import islice
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archive storage. Both stores hold the same data:
+# { 'channel':
+#   {'timestamp':
+#       {
+#           'message' {message},
+#           'replies': [
+#               {reply},
+#               {reply}
+#           ]
+#       }
+#   }
+# }
+# JSONStore keeps all of it in memory, as compact records, and writes one
+# JSON file. SQLiteStore keeps it in indexed tables and writes as it goes.
+#
+# JSON files ending in .gz or .zst are compressed as they're written, a
+# buffer at a time, and any JSON file is decompressed as it's read if its
+# first bytes say it's compressed, whatever it's called. zstd needs the
+# zstandard package.
+
+sqlite_extensions = ('.db', '.sqlite', '.sqlite3')
+compression_extensions = {'.gz': 'gzip', '.zst': 'zstd'}
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+gzip_level = 6
+zstd_level = 3
+
+def is_sqlite(path:str) -> bool:
+    return path.endswith(sqlite_extensions)
+
+def compression(path:str) -> str:
+    # 'gzip', 'zstd' or None, from the file name
+    return compression_extensions.get(os.path.splitext(path)[1].lower())
+
+def check_zstandard() -> None:
+    if zstandard is None:
+        raise ImportError('zstd compressed archives need the zstandard package: pip install zstandard')
+
+def open_text(path:str):
+    # path opened for reading as text, decompressing it as it's read
+    with open(path, 'rb') as f:
+        magic = f.read(len(zstd_magic))
+    if magic.startswith(gzip_magic):
+        return gzip.open(path, 'rt', encoding = 'utf-8')
+    if magic == zstd_magic:
+        check_zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd = True)
+        return io.TextIOWrapper(io.BufferedReader(reader), encoding = 'utf-8')
+    return open(path, 'r', encoding = 'utf-8')
+
+def compressed_writer(raw, kind:str):
+    # a binary file object that compresses into raw, and leaves it open
+    # when it's closed
+    if kind == 'gzip':
+        # no name or time in the header, so the same archive always
+        # compresses to the same bytes
+        return gzip.GzipFile(filename = '', mode = 'wb', fileobj = raw, compresslevel = gzip_level, mtime = 0)
+    check_zstandard()
+    return zstandard.ZstdCompressor(level = zstd_level).stream_writer(raw, closefd = False)
+
+@contextmanager
+def atomic_write(path:str):
+    # write to a temporary file and rename it over path, so a crash
+    # part way through never leaves a truncated file behind. The
+    # temporary file is per process, as visualize's workers can write
+    # the same cache at once.
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    kind = compression(path)
+    if kind is None:
+        with open(temp_path, 'w', encoding = 'utf-8') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        with open(temp_path, 'wb') as raw:
+            compressed = compressed_writer(raw, kind)
+            f = io.TextIOWrapper(compressed, encoding = 'utf-8')
+            yield f
+            f.flush()
+            f.detach()
+            compressed.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+    os.replace(temp_path, path)
+
+def ts_key(ts:str) -> tuple:
+    # sorts slack timestamps as numbers, exactly: comparing the strings
+    # goes wrong when the seconds have different numbers of digits, and a
+    # float can't tell every microsecond apart. Fractions compare as
+    # digit strings once trailing zeros are gone.
+    seconds, _, fraction = ts.partition('.')
+    return int(seconds), fraction.rstrip('0')
+
+def open_store(path:str):
+    if is_sqlite(path):
+        return SQLiteStore(path)
+    return JSONStore.load(path)
+
+def copy_store(source, out_file:str) -> None:
+    if is_sqlite(out_file):
+        destination = SQLiteStore(out_file)
+        for channel in source.channels():
+            destination.add_channel(channel)
+            destination.put_threads(channel, {t['message']['ts']: t for t in source.threads(channel)})
+        destination.put_users(source.users())
+        destination.close()
+    else:
+        write_json(source, out_file)
+
+def write_json(source, out_file:str) -> None:
+    # streams the archive out a thread at a time, so exporting a
+    # database never needs the whole archive in memory
+    with atomic_write(out_file) as f:
+        f.write('{')
+        for i, channel in enumerate(source.channels()):
+            if i:
+                f.write(', ')
+            f.write(f'{json.dumps(channel)}: {{')
+            for j, thread in enumerate(source.threads(channel)):
+                if j:
+                    f.write(', ')
+                f.write(f"{json.dumps(thread['message']['ts'])}: {json.dumps(thread)}")
+            f.write('}')
+        f.write('}')
+
+# what can follow the part of a number the decoder has read, if the
+# number goes on into the next chunk
+number_characters = set('0123456789.eE+-')
+
+def iter_json_items(f, chunk_size:int = 1 << 20):
+    # (key, value) pairs of the JSON object in file f, read a chunk at a
+    # time so only one value has to fit in memory, not the whole file
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    expect = '{'
+    while True:
+        # skip whitespace and the punctuation between items
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position == len(buffer):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError('JSON object ends early')
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        character = buffer[position]
+        if expect == '{':
+            if character != '{':
+                raise ValueError(f'Expected a JSON object, found {character!r}')
+            position += 1
+            expect = 'key'
+        elif expect in ('key', ',') and character == '}':
+            return
+        elif expect == ',':
+            if character != ',':
+                raise ValueError(f'Expected "," between items, found {character!r}')
+            position += 1
+            expect = 'key'
+        elif expect == ':':
+            if character != ':':
+                raise ValueError(f'Expected ":" after a key, found {character!r}')
+            position += 1
+            expect = 'value'
+        else:
+            # a key or value. It only counts once something follows it,
+            # so a number cut off at the end of the buffer isn't taken
+            # for a whole one. Nor is one cut off part way, like "3." or
+            # "1e", which decodes as far as the digits go.
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                rest = end
+                if isinstance(item, (int, float)):
+                    while rest < len(buffer) and buffer[rest] in number_characters:
+                        rest += 1
+                complete = rest < len(buffer)
+            except ValueError:
+                complete = False
+            if not complete:
+                # read bigger chunks while a value doesn't fit, so a long
+                # value isn't parsed over and over
+                chunk = f.read(max(chunk_size, len(buffer)))
+                if not chunk:
+                    raise ValueError('JSON object ends early')
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+
+            position = end
+            if expect == 'key':
+                key = item
+                expect = ':'
+            else:
+                yield key, item
+                expect = ','
+
+class NameTable(object):
+    # Strings shared by many messages: user names (or IDs) and the key
+    # order of each shape of message. Each is stored once; records point
+    # at the one copy, and reactions refer to users by index.
+    def __init__(self) -> None:
+        self.names = []
+        self.indexes = {}
+        self.shapes = {}
+
+    def add(self, name:str) -> int:
+        try:
+            return self.indexes[name]
+        except KeyError:
+            self.indexes[name] = len(self.names)
+            self.names.append(name)
+            return self.indexes[name]
+
+    def intern(self, name:str) -> str:
+        return self.names[self.add(name)]
+
+    def shape(self, keys:tuple) -> tuple:
+        return self.shapes.setdefault(keys, keys)
+
+# Message fields kept as attributes of a MessageRecord. Everything else
+# is only needed to save the archive again, so it's kept as one compact
+# JSON string and only decoded when the message is read back as a dict.
+record_fields = ('ts', 'user', 'text', 'format_ts')
+reaction_keys = ['name', 'users', 'count']
+compact_encoder = json.JSONEncoder(separators = (',', ':'))
+
+class MessageRecord(object):
+    # One message. shape is the message's keys in their original order,
+    # so to_dict gives back exactly the dict that went in. Reactions are
+    # (name, count, array of user indexes in the NameTable) tuples.
+    __slots__ = ('shape', 'ts', 'user', 'text', 'format_ts', 'reactions', 'extra')
+
+    def __init__(self, message:dict, names:NameTable) -> None:
+        self.shape = names.shape(tuple(message))
+        extra = {
+            key: value for key, value in message.items()
+            if key not in record_fields or not isinstance(value, str)
+        }
+        # a field that isn't a string is left in extra, and its attribute is None
+        self.ts = message.get('ts') if 'ts' not in extra else None
+        self.user = names.intern(message['user']) if 'user' in message and 'user' not in extra else None
+        self.text = message.get('text') if 'text' not in extra else None
+        self.format_ts = message.get('format_ts') if 'format_ts' not in extra else None
+        self.reactions = None
+        if 'reactions' in extra and self.compact_reactions(extra['reactions']):
+            self.reactions = tuple(
+                (names.intern(r['name']), r['count'], array('I', [names.add(user) for user in r['users']]))
+                for r in extra.pop('reactions')
+            )
+        self.extra = compact_encoder.encode(extra) if extra else None
+
+    @staticmethod
+    def compact_reactions(reactions) -> bool:
+        return isinstance(reactions, list) and all(
+            isinstance(r, dict) and list(r) == reaction_keys and
+            isinstance(r['name'], str) and all(isinstance(user, str) for user in r['users'])
+            for r in reactions
+        )
+
+    def to_dict(self, names:NameTable) -> dict:
+        extra = json.loads(self.extra) if self.extra is not None else {}
+        message = {}
+        for key in self.shape:
+            if key in extra:
+                message[key] = extra[key]
+            elif key == 'reactions':
+                message[key] = [
+                    {'name': name, 'users': [names.names[user] for user in users], 'count': count}
+                    for name, count, users in self.reactions
+                ]
+            else:
+                message[key] = getattr(self, key)
+        return message
+
+class JSONStore(object):
+    # Threads are kept as (MessageRecord, tuple of reply MessageRecords)
+    # and turned back into dicts a thread at a time as they're read, so a
+    # big archive takes a fraction of the memory of the parsed JSON.
+    #
+    # Each channel's dict is kept in ts order. Threads new to a channel
+    # are added at the end and noted in `unsorted`, with the channel's
+    # last ts before them, until finish_channel puts them in place.
+    def __init__(self, data:dict = None) -> None:
+        self.names = NameTable()
+        self.data = {}
+        self.unsorted = {}
+        for channel, threads in (data or {}).items():
+            self.put_threads(channel, threads)
+            self.finish_channel(channel)
+
+    @classmethod
+    def load(cls, path:str):
+        # a channel at a time, so the whole file is never parsed at once
+        store = cls()
+        with open_text(path) as f:
+            for channel, threads in iter_json_items(f):
+                store.put_threads(channel, threads)
+                store.finish_channel(channel)
+        return store
+
+    def compact_thread(self, thread:dict) -> tuple:
+        return (
+            MessageRecord(thread['message'], self.names),
+            tuple(MessageRecord(reply, self.names) for reply in thread['replies'])
+        )
+
+    def expand_thread(self, thread:tuple) -> dict:
+        message, replies = thread
+        return {
+            'message': message.to_dict(self.names),
+            'replies': [reply.to_dict(self.names) for reply in replies]
+        }
+
+    def channels(self) -> list:
+        return list(self.data.keys())
+
+    def add_channel(self, channel:str) -> None:
+        if channel not in self.data:
+            self.data[channel] = {}
+
+    def has_message(self, channel:str, ts:str) -> bool:
+        return channel in self.data and ts in self.data[channel]
+
+    def get_thread(self, channel:str, ts:str) -> dict:
+        try:
+            return self.expand_thread(self.data[channel][ts])
+        except KeyError:
+            return None
+
+    def newest_ts(self, channel:str) -> str:
+        if not self.data.get(channel):
+            return None
+        if channel not in self.unsorted:
+            return next(reversed(self.data[channel]))
+        last_sorted, new = self.unsorted[channel]
+        return max(new if last_sorted is None else new + [last_sorted], key = ts_key)
+
+    def timestamps_after(self, channel:str, oldest:str) -> list:
+        # ts of the channel's threads newer than oldest, newest first.
+        # Walks back from the newest, so it only touches those.
+        if channel in self.unsorted:
+            self.finish_channel(channel)
+        oldest = ts_key(oldest)
+        timestamps = []
+        for ts in reversed(self.data.get(channel, {})):
+            if ts_key(ts) <= oldest:
+                break
+            timestamps.append(ts)
+        return timestamps
+
+    def put_threads(self, channel:str, threads:dict) -> None:
+        self.add_channel(channel)
+        channel_data = self.data[channel]
+        for ts, thread in threads.items():
+            if ts not in channel_data:
+                if channel not in self.unsorted:
+                    self.unsorted[channel] = (next(reversed(channel_data), None), [])
+                self.unsorted[channel][1].append(ts)
+            channel_data[ts] = self.compact_thread(thread)
+
+    def finish_channel(self, channel:str) -> None:
+        # Puts the channel's new threads in order. Only the old threads
+        # newer than the oldest new one have to move, so when new threads
+        # are all newer than the old ones, as they usually are, this takes
+        # time proportional to the new threads, not the whole channel.
+        if channel not in self.unsorted:
+            return
+        _, new = self.unsorted.pop(channel)
+        new.sort(key = ts_key)
+        channel_data = self.data[channel]
+
+        oldest_new = ts_key(new[0])
+        new_set = set(new)
+        tail = []
+        for ts in reversed(channel_data):
+            if ts in new_set:
+                continue
+            if ts_key(ts) < oldest_new:
+                break
+            tail.append(ts)
+        tail.reverse()
+
+        # moving a thread to the end of the dict puts it after the rest
+        for ts in heapq.merge(tail, new, key = ts_key):
+            channel_data[ts] = channel_data.pop(ts)
+
+    def threads(self, channel:str, start:int = 0, count:int = None):
+        # threads skipped over to get to start aren't expanded
+        stop = None if count is None else start + count
+        return (self.expand_thread(thread) for thread in islice(self.data[channel].values(), start, stop))
+
+    def put_users(self, users:dict) -> None:
+        # the JSON format only has names, which are already in the messages
+        pass
+
+    def users(self) -> dict:
+        return {}
+
+    def save(self, out_file:str) -> None:
+        for channel in list(self.unsorted):
+            self.finish_channel(channel)
+        if is_sqlite(out_file):
+            copy_store(self, out_file)
+        else:
+            write_json(self, out_file)
+
+    def close(self) -> None:
+        pass
+
+class SQLiteStore(object):
+    # Messages, replies, reactions and users each get a table. Columns the
+    # archiver looks things up by are pulled out of the message dicts, and
+    # every other field is kept in `extra` as JSON, so export back to the
+    # JSON format is lossless.
+    schema = '''
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            channel_id INTEGER NOT NULL REFERENCES channels(id),
+            ts TEXT NOT NULL,
+            user TEXT,
+            text TEXT,
+            extra TEXT NOT NULL,
+            PRIMARY KEY (channel_id, ts)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS replies (
+            channel_id INTEGER NOT NULL REFERENCES channels(id),
+            thread_ts TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            user TEXT,
+            text TEXT,
+            extra TEXT NOT NULL,
+            PRIMARY KEY (channel_id, thread_ts, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS reactions (
+            channel_id INTEGER NOT NULL REFERENCES channels(id),
+            thread_ts TEXT NOT NULL,
+            message_position INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            count INTEGER,
+            users TEXT NOT NULL,
+            PRIMARY KEY (channel_id, thread_ts, message_position, position)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            name TEXT
+        );
+    '''
+    # message_position in reactions is 0 for the thread's root message
+    # and the reply's position (from 1) for replies
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # with a write-ahead log, readers like serve see the last commit
+        # while a scrape or watch is writing, rather than waiting on it
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(self.schema)
+        self.channel_ids = dict(
+            (name, channel_id) for channel_id, name in
+            self.connection.execute('SELECT id, name FROM channels')
+        )
+
+    def channels(self) -> list:
+        return list(self.channel_ids.keys())
+
+    def add_channel(self, channel:str) -> None:
+        if channel not in self.channel_ids:
+            with self.connection:
+                cursor = self.connection.execute('INSERT INTO channels (name) VALUES (?)', (channel,))
+            self.channel_ids[channel] = cursor.lastrowid
+
+    def has_message(self, channel:str, ts:str) -> bool:
+        if channel not in self.channel_ids:
+            return False
+        return self.connection.execute(
+            'SELECT 1 FROM messages WHERE channel_id = ? AND ts = ?',
+            (self.channel_ids[channel], ts)
+        ).fetchone() is not None
+
+    def newest_ts(self, channel:str) -> str:
+        if channel not in self.channel_ids:
+            return None
+        row = self.connection.execute(
+            'SELECT ts FROM messages WHERE channel_id = ? ORDER BY ts DESC LIMIT 1',
+            (self.channel_ids[channel],)
+        ).fetchone()
+        return row[0] if row else None
+
+    def timestamps_after(self, channel:str, oldest:str) -> list:
+        if channel not in self.channel_ids:
+            return []
+        # compared as text so the index is used. That's the same as
+        # comparing them as numbers until the year 2286, when timestamps
+        # get an 11th digit.
+        return [row[0] for row in self.connection.execute(
+            'SELECT ts FROM messages WHERE channel_id = ? AND ts > ? ORDER BY ts DESC',
+            (self.channel_ids[channel], oldest)
+        )]
+
+    def split_message(self, message:dict) -> tuple:
+        # pull out user, text and reactions; everything else goes in extra
+        extra = dict(message)
+        user = extra.pop('user') if extra.get('user') is not None else None
+        text = extra.pop('text') if extra.get('text') is not None else None
+        reactions = []
+        if extra.get('reactions') and all(set(r) == {'name', 'count', 'users'} for r in extra['reactions']):
+            reactions = extra.pop('reactions')
+        return user, text, json.dumps(extra), reactions
+
+    def join_message(self, user:str, text:str, extra:str, reactions:list) -> dict:
+        message = json.loads(extra)
+        if user is not None:
+            message['user'] = user
+        if text is not None:
+            message['text'] = text
+        if reactions:
+            message['reactions'] = reactions
+        return message
+
+    def put_threads(self, channel:str, threads:dict) -> None:
+        self.add_channel(channel)
+        channel_id = self.channel_ids[channel]
+        with self.connection:
+            for ts, thread in threads.items():
+                for table in ('messages', 'replies', 'reactions'):
+                    column = 'ts' if table == 'messages' else 'thread_ts'
+                    self.connection.execute(
+                        f'DELETE FROM {table} WHERE channel_id = ? AND {column} = ?',
+                        (channel_id, ts)
+                    )
+
+                user, text, extra, reactions = self.split_message(thread['message'])
+                self.connection.execute(
+                    'INSERT INTO messages VALUES (?, ?, ?, ?, ?)',
+                    (channel_id, ts, user, text, extra)
+                )
+                self.put_reactions(channel_id, ts, 0, reactions)
+
+                for position, reply in enumerate(thread['replies'], start = 1):
+                    user, text, extra, reactions = self.split_message(reply)
+                    self.connection.execute(
+                        'INSERT INTO replies VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (channel_id, ts, position, reply['ts'], user, text, extra)
+                    )
+                    self.put_reactions(channel_id, ts, position, reactions)
+
+    def put_reactions(self, channel_id:int, thread_ts:str, message_position:int, reactions:list) -> None:
+        self.connection.executemany(
+            'INSERT INTO reactions VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (channel_id, thread_ts, message_position, position, r['name'], r['count'], json.dumps(r['users']))
+                for position, r in enumerate(reactions)
+            ]
+        )
+
+    def finish_channel(self, channel:str) -> None:
+        # threads are read back in ts order, so there's nothing to sort
+        pass
+
+    def get_thread(self, channel:str, ts:str) -> dict:
+        if channel not in self.channel_ids:
+            return None
+        threads = list(self.read_threads(self.channel_ids[channel], ts))
+        return threads[0] if threads else None
+
+    def threads(self, channel:str, start:int = 0, count:int = None):
+        channel_id = self.channel_ids[channel]
+        if not start and count is None:
+            return self.read_threads(channel_id)
+        # the first thread is found on the index, so the threads before
+        # it are never read
+        first = self.connection.execute(
+            'SELECT ts FROM messages WHERE channel_id = ? ORDER BY ts LIMIT 1 OFFSET ?',
+            (channel_id, start)
+        ).fetchone()
+        if first is None:
+            return iter(())
+        return self.read_threads(channel_id, oldest = first[0], limit = count)
+
+    def read_threads(self, channel_id:int, ts:str = None, oldest:str = None, limit:int = None):
+        # one query per table, walked in step, rather than a query per
+        # thread. Either the thread at ts, or up to limit threads from
+        # oldest on.
+        where = 'channel_id = ?'
+        arguments = (channel_id,)
+        if ts is not None:
+            where += ' AND {} = ?'
+            arguments += (ts,)
+        elif oldest is not None:
+            where += ' AND {} >= ?'
+            arguments += (oldest,)
+        messages = self.connection.execute(
+            f"SELECT ts, user, text, extra FROM messages WHERE {where.format('ts')} ORDER BY ts" +
+            (' LIMIT ?' if limit is not None else ''),
+            arguments + ((limit,) if limit is not None else ())
+        )
+        replies = self.connection.execute(
+            f"SELECT thread_ts, position, user, text, extra FROM replies WHERE {where.format('thread_ts')} ORDER BY thread_ts, position",
+            arguments
+        )
+        reactions = self.connection.execute(
+            f"SELECT thread_ts, message_position, name, count, users FROM reactions WHERE {where.format('thread_ts')} ORDER BY thread_ts, message_position, position",
+            arguments
+        )
+
+        next_reply = replies.fetchone()
+        next_reaction = reactions.fetchone()
+        for ts, user, text, extra in messages:
+            # reactions for this thread, by message position
+            thread_reactions = {}
+            while next_reaction is not None and next_reaction[0] == ts:
+                _, position, name, count, users = next_reaction
+                thread_reactions.setdefault(position, []).append(
+                    {'name': name, 'users': json.loads(users), 'count': count}
+                )
+                next_reaction = reactions.fetchone()
+
+            thread = {
+                'message': self.join_message(user, text, extra, thread_reactions.get(0)),
+                'replies': []
+            }
+            while next_reply is not None and next_reply[0] == ts:
+                _, position, user, text, extra = next_reply
+                thread['replies'].append(
+                    self.join_message(user, text, extra, thread_reactions.get(position))
+                )
+                next_reply = replies.fetchone()
+
+            yield thread
+
+    def put_users(self, users:dict) -> None:
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO users VALUES (?, ?)',
+                users.items()
+            )
+
+    def users(self) -> dict:
+        return dict(self.connection.execute('SELECT id, name FROM users'))
+
+    def save(self, out_file:str) -> None:
+        self.connection.commit()
+        if os.path.realpath(out_file) != os.path.realpath(self.path):
+            copy_store(self, out_file)
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()